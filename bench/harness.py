@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+"""
+Benchmarks gentainer against fake btrfs, emerge, useradd and lxc-start executables,
+a temporary lxc-usernet file, a fake passwd database and an in-memory netlink backend.
+
+Synthetic config_dirs are generated with N containers in base_image chains of depth K.
+Reports config load time, build scheduling overhead, usernet update cost, interface preparation cost
+and container start overhead as N grows.
+Root and real hardware are not needed.
+"""
+
+import sys
+from argparse import ArgumentParser
+from collections import namedtuple
+from contextlib import redirect_stdout
+from io import StringIO
+from json import dumps, loads
+from os import environ, pathsep
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "src"))
+
+import gentainer.runner  # noqa: E402
+import gentainer.users  # noqa: E402
+import gentainer.vdb  # noqa: E402
+from gentainer import Gentainer  # noqa: E402
+from gentainer.nets import NetlinkSession  # noqa: E402
+from gentainer.scheduler import BuildScheduler  # noqa: E402
+from gentainer.usernet import UsernetDB  # noqa: E402
+
+BENCH_PACKAGE = "app-misc/bench"
+MODULES = ["users.UserManager", "layers.Layers", "nets.ContainerNet", "nets.HostNet", "builder.Builder"]
+FakeUser = namedtuple("FakeUser", ["pw_name", "pw_uid", "pw_gid", "pw_dir"])
+
+
+class FakeMessage(dict):
+    """Netlink message with the get_attr interface of pyroute2 messages"""
+
+    def get_attr(self, name):
+        for attr_name, value in self["attrs"]:
+            if attr_name == name:
+                return value
+
+
+class FakeIPRoute:
+    """In-memory netlink backend, implements the parts of pyroute2.IPRoute used by NetlinkSession"""
+
+    def __init__(self):
+        self.links = {}  # {index: {"name": str, "kind": str, "addresses": set}}
+        self.next_index = 1
+        self.dumps = 0  # Full link dumps, the expensive operation on hosts with many interfaces
+
+    def get_message(self, index):
+        link = self.links[index]
+        link_info = FakeMessage(attrs=[("IFLA_INFO_KIND", link["kind"])])
+        return FakeMessage(index=index, attrs=[("IFLA_IFNAME", link["name"]), ("IFLA_LINKINFO", link_info)])
+
+    def get_links(self, *indexes):
+        if not indexes:
+            self.dumps += 1
+        return [self.get_message(index) for index in (indexes or list(self.links))]
+
+    def link(self, command, index=None, ifname=None, kind=None):
+        if ifname is not None and index is None:
+            index = next((i for i, link in self.links.items() if link["name"] == ifname), None)
+        match command:
+            case "add":
+                self.links[self.next_index] = {"name": ifname, "kind": kind, "addresses": set()}
+                self.next_index += 1
+            case "get":
+                return [self.get_message(index)]
+            case "del":
+                self.links.pop(index)
+
+    def get_addr(self, family=None, index=None):
+        addresses = self.links[index]["addresses"]
+        return [FakeMessage(prefixlen=mask, attrs=[("IFA_ADDRESS", address)]) for address, mask in addresses]
+
+    def addr(self, command, index=None, address=None, mask=None):
+        if command == "add":
+            self.links[index]["addresses"].add((address, mask))
+        else:
+            self.links[index]["addresses"].discard((address, mask))
+
+    def close(self):
+        pass
+
+
+def install_fake_passwd(passwd_file):
+    """Replaces the passwd lookups used by gentainer.users with the file written by the fake useradd"""
+
+    def getpwall():
+        with open(passwd_file) as passwd:
+            return [FakeUser(e["name"], e["uid"], e["gid"], e["home"]) for e in map(loads, passwd)]
+
+    def getpwnam(name):
+        for user in getpwall():
+            if user.pw_name == name:
+                return user
+        raise KeyError(name)
+
+    gentainer.users.getpwall = getpwall
+    gentainer.users.getpwnam = getpwnam
+    gentainer.runner.getpwnam = getpwnam
+
+
+def install_fake_use_config():
+    """Replaces the portage USE lookup of the VDB index, installed packages always have the configured USE flags"""
+
+    def get_configured_use(self, cpv):
+        for installed in self.packages.values():
+            for package in installed:
+                if package["cpv"] == cpv:
+                    return package["use"]
+
+    gentainer.vdb.VDBIndex.get_configured_use = get_configured_use
+
+
+def write_environment(directory, containers, depth, users, bridges, jobs):
+    """Writes a synthetic config, config_dir, network config and package index, returns the config file"""
+    config_dir = directory / "config"
+    config_dir.mkdir()
+    for index in range(containers):
+        lines = [
+            'username = "bench%d"' % (index % users),
+            'packages = ["%s"]' % BENCH_PACKAGE,
+            'usernet_allocation = { "benchbr%d" = 2 }' % (index % bridges),
+        ]
+        if index % depth:
+            lines.append('base_image = "container_%d"' % (index - 1))
+        lines.append('[networks.benchbr%d]\ntype = "veth"' % (index % bridges))
+        (config_dir / ("container_%d.toml" % index)).write_text("\n".join(lines) + "\n")
+
+    network_file = directory / "networks.toml"
+    network_file.write_text(
+        "".join('[benchbr%d]\ntype = "bridge"\naddress = "10.%d.0.1"\nmask = 24\n' % (i, i) for i in range(bridges))
+    )
+
+    # The package index is valid for this timestamp file, so portage is not needed
+    timestamp_file = directory / "timestamp.chk"
+    timestamp_file.write_text("bench\n")
+    timestamp = "bench %d" % timestamp_file.stat().st_mtime_ns
+    (directory / "cache").mkdir()
+    (directory / "cache" / "package_index.json").write_text(
+        dumps({"timestamp": timestamp, "packages": {BENCH_PACKAGE: [BENCH_PACKAGE + "-1.0"]}})
+    )
+
+    # Distfiles are fetched from a local mirror
+    (directory / "mirror" / "distfiles").mkdir(parents=True)
+    (directory / "mirror" / "distfiles" / ("%s-1.0.tar" % BENCH_PACKAGE.split("/")[-1])).write_bytes(b"bench")
+
+    (directory / "passwd").touch()
+    subids = "".join("bench%d:%d:65536\n" % (user, 100000 + user * 65536) for user in range(users))
+    (directory / "subuid").write_text(subids)
+    (directory / "subgid").write_text(subids)
+    (directory / "home").mkdir()
+    config_file = directory / "config.toml"
+    config = {
+        "build_dir": str(directory / "build"),
+        "cache_dir": str(directory / "cache"),
+        "config_dir": str(config_dir),
+        "lxc_usernet_file": str(directory / "lxc-usernet"),
+        "network_config_file": str(network_file),
+        "portage_timestamp_file": str(timestamp_file),
+        "portage_config_files": [],
+        "binpkg_pool": False,
+        "distfiles_dir": str(directory / "distfiles"),
+        "gentoo_mirrors": (directory / "mirror").as_uri(),
+        "net_reconcile": True,
+        "build_jobs": jobs,
+        "run_jobs": jobs,
+        "subuid_file": str(directory / "subuid"),
+        "subgid_file": str(directory / "subgid"),
+        "lxc_includes": [],
+        "modules": MODULES,
+    }
+    config_file.write_text("\n".join("%s = %s" % (key, dumps(value)) for key, value in config.items()))
+    return config_file
+
+
+def timed(function, *args, **kwargs):
+    """Returns the time in ms taken by a function, and its result"""
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    return (perf_counter() - start) * 1000, result
+
+
+def run_benchmark(directory, containers, depth, users, bridges, jobs):
+    """Runs all benchmarks for a number of containers, returns {benchmark: value}"""
+    config_file = write_environment(directory, containers, depth, users, bridges, jobs)
+    environ["FAKE_PASSWD"] = str(directory / "passwd")
+    environ["FAKE_HOME_DIR"] = str(directory / "home")
+    install_fake_passwd(directory / "passwd")
+    install_fake_use_config()
+
+    # The host already has a veth for each container
+    ip_route = FakeIPRoute()
+    for index in range(containers):
+        ip_route.link("add", ifname="benchveth%d" % index, kind="veth")
+    netlink = NetlinkSession(backend=lambda: ip_route)
+
+    results = {"containers": containers}
+    results["load_cold"], _ = timed(Gentainer, config=str(config_file), netlink=netlink)
+    results["load_warm"], gentainer = timed(Gentainer, config=str(config_file), netlink=netlink)
+
+    scheduler = BuildScheduler(gentainer.containers, lambda container: None, jobs=jobs)
+    results["schedule"], _ = timed(scheduler.run, list(gentainer.containers))
+
+    results["prepare_all"], _ = timed(gentainer.prepare_all)
+    results["net_reconcile"], _ = timed(gentainer.net_reconcile)
+    results["link_dumps"] = ip_route.dumps
+
+    usernet_db = UsernetDB(gentainer.usernet_file)
+
+    def update_usernets():
+        with usernet_db:
+            for index in range(containers):
+                usernet_db.set("bench%d" % (index % users), "veth", "benchbr%d" % (index % bridges), 3)
+
+    results["usernet_update"], _ = timed(update_usernets)
+    results["build_all"], _ = timed(gentainer.build_all)
+    with redirect_stdout(StringIO()):  # The start report lists every container
+        results["run_all"], _ = timed(gentainer.run_all)
+        results["run_all_cached"], _ = timed(gentainer.run_all)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Gentainer scaling benchmarks")
+    parser.add_argument("--sizes", default="10,100,1000", help="Comma separated container counts")
+    parser.add_argument("--depth", type=int, default=3, help="Depth of base_image chains")
+    parser.add_argument("--users", type=int, default=10, help="Number of container users")
+    parser.add_argument("--bridges", type=int, default=3, help="Number of host bridges")
+    parser.add_argument("--jobs", type=int, default=4, help="Parallel layer builds")
+    parser.add_argument("--emerge-delay", type=float, default=0, help="Seconds the fake emerge spends per package")
+    parser.add_argument("--fetch-delay", type=float, default=0, help="Seconds the fake emerge spends fetching a distfile")
+    args = parser.parse_args()
+
+    environ["PATH"] = str(BENCH_DIR / "fakes") + pathsep + environ["PATH"]
+    environ["FAKE_EMERGE_DELAY"] = str(args.emerge_delay)
+    environ["FAKE_FETCH_DELAY"] = str(args.fetch_delay)
+
+    columns = ["containers", "load_cold", "load_warm", "schedule", "prepare_all", "net_reconcile",
+               "usernet_update", "build_all", "run_all", "run_all_cached", "link_dumps"]
+    print(" ".join("%14s" % column for column in columns))
+    for size in map(int, args.sizes.split(",")):
+        with TemporaryDirectory() as directory:
+            results = run_benchmark(Path(directory), size, args.depth, args.users, args.bridges, args.jobs)
+        print(" ".join("%14.1f" % results[column] if isinstance(results[column], float) else "%14d" % results[column]
+                       for column in columns))
+    print("Times are in ms")
+
+
+if __name__ == "__main__":
+    main()
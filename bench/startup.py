@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+"""
+Measures the startup time of `gentainer list` against a generated config_dir.
+Exits with an error if the median time exceeds --max-ms, or if heavy modules were imported.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from statistics import median
+from subprocess import run
+from sys import executable, exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+HEAVY_MODULES = ["portage", "pyroute2"]  # Should only be imported by actions which use them
+
+LIST_SCRIPT = """
+import sys
+from gentainer import Gentainer
+
+Gentainer(config=sys.argv[1]).list()
+heavy_modules = [module for module in %r if module in sys.modules]
+if heavy_modules:
+    sys.exit("Heavy modules imported by list: %%s" %% heavy_modules)
+""" % HEAVY_MODULES
+
+
+def write_config(directory, containers):
+    """Writes a gentainer config with the specified number of containers, returns the config file path"""
+    config_dir = directory / "config"
+    config_dir.mkdir()
+    for index in range(containers):
+        base_image = 'base_image = "container_%d"\n' % (index - 1) if index else ""
+        (config_dir / ("container_%d.toml" % index)).write_text(base_image + 'packages = ["app-misc/test"]\n')
+
+    network_file = directory / "networks.toml"
+    network_file.write_text('[lxcbr0]\ntype = "bridge"\naddress = "10.0.0.1"\nmask = 24\n')
+
+    config_file = directory / "config.toml"
+    config_file.write_text(
+        "\n".join(
+            [
+                'build_dir = "%s"' % (directory / "build"),
+                'cache_dir = "%s"' % (directory / "cache"),
+                'config_dir = "%s"' % config_dir,
+                'network_config = "%s"' % network_file,
+                'modules = ["users.UserManager", "layers.Layers", "nets.ContainerNet", "nets.HostNet", "builder.Builder"]',
+            ]
+        )
+    )
+    return config_file
+
+
+def main():
+    parser = ArgumentParser(description="Gentainer startup benchmark")
+    parser.add_argument("--containers", type=int, default=100, help="Number of container configs to generate")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if the median time exceeds this")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        config_file = write_config(Path(directory), args.containers)
+        times = []
+        for _ in range(args.runs):
+            start = perf_counter()
+            cmd_out = run([executable, "-c", LIST_SCRIPT, str(config_file)], capture_output=True)
+            times.append((perf_counter() - start) * 1000)
+            if cmd_out.returncode != 0:
+                exit(cmd_out.stderr.decode("utf-8"))
+
+    print("gentainer list, %d containers, %d runs" % (args.containers, args.runs))
+    print("min: %.1fms median: %.1fms max: %.1fms" % (min(times), median(times), max(times)))
+    if args.max_ms and median(times) > args.max_ms:
+        exit("Median startup time %.1fms exceeds %.1fms" % (median(times), args.max_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from hashlib import sha256
+from os import environ, utime
+from pathlib import Path
+from re import compile, escape
+from threading import Lock
+
+from zenlib.logging import loggify
+
+from gentainer.tracing import traced_run
+
+# Settings which change the contents of binary packages, pools are separated by these
+BINPKG_KEY_SETTINGS = ["CHOST", "CFLAGS", "CXXFLAGS", "LDFLAGS", "USE"]
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """Parses a size such as 20G into bytes"""
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper().removesuffix("B")
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+@loggify
+class BinpkgPool:
+    """Shared binary package pool for layer builds.
+    Binary packages are kept in a subdirectory keyed on the settings which change their contents."""
+
+    def __init__(self, pool_dir, max_size=None, *args, **kwargs):
+        self.pool_dir = Path(pool_dir)
+        self.max_size = parse_size(max_size) if max_size else None
+        self.lock = Lock()
+        self.pkgdir = None  # Set by get_pkgdir, so portage is only loaded when the pool is used
+
+    def get_key(self):
+        """Gets a key for the current portage settings"""
+        import portage
+
+        settings = {setting: portage.settings.get(setting, "") for setting in BINPKG_KEY_SETTINGS}
+        self.logger.debug("Binary package settings: %s" % settings)
+        key_data = "\n".join("%s=%s" % (setting, value) for setting, value in settings.items())
+        return sha256(key_data.encode()).hexdigest()[:16]
+
+    def get_pkgdir(self):
+        """Gets the binary package directory for the current portage settings"""
+        with self.lock:
+            if self.pkgdir is None:
+                self.pkgdir = self.pool_dir / self.get_key()
+                self.logger.info("Binary package pool: %s" % self.pkgdir)
+        return self.pkgdir
+
+    def get_env(self):
+        """Gets the environment for emerge to use this pool"""
+        pkgdir = self.get_pkgdir()
+        pkgdir.mkdir(parents=True, exist_ok=True)
+        return {**environ, "PKGDIR": str(pkgdir)}
+
+    def get_emerge_args(self):
+        """Gets the emerge arguments to build and use binary packages"""
+        return ["--buildpkg", "--usepkg"]
+
+    def get_package_files(self, cpv):
+        """Gets the binary package files for a package version, in both the flat and multi-instance layouts"""
+        category, pf = cpv.split("/", 1)
+        file_name = compile(escape(pf) + r"(-\d+)?\.(tbz2|xpak|gpkg\.tar)$")
+        category_dir = self.get_pkgdir() / category
+        if not category_dir.is_dir():
+            return []
+        return [file for file in category_dir.rglob(pf + "*") if file_name.match(file.name)]
+
+    def record_build(self, container, hits, misses):
+        """Records the binary package hits and misses of a build.
+        Binary packages which were used are touched so they are evicted last."""
+        for cpv in hits:
+            for package_file in self.get_package_files(cpv):
+                utime(package_file)
+
+        self.logger.info("[%s] Binary packages used: %d, built from source: %d" % (container, len(hits), len(misses)))
+        self.logger.debug("[%s] Binary package hits: %s; Misses: %s" % (container, hits, misses))
+        return hits, misses
+
+    def evict(self):
+        """Removes the least recently used binary packages until the pool is under max_size"""
+        if not self.max_size:
+            return []
+
+        with self.lock:
+            files = {file: file.stat() for file in self.pool_dir.rglob("*") if file.is_file()}
+            pool_size = sum(stat.st_size for stat in files.values())
+            package_files = sorted(
+                (file for file in files if file.name != "Packages"), key=lambda file: files[file].st_mtime
+            )
+
+            evicted = []
+            for package_file in package_files:
+                if pool_size <= self.max_size:
+                    break
+                pool_size -= files[package_file].st_size
+                self.logger.info("Evicting binary package: %s" % package_file)
+                package_file.unlink()
+                evicted.append(package_file)
+
+            # Rebuild the Packages index of every pool which had packages removed
+            for pkgdir in {package_file.relative_to(self.pool_dir).parts[0] for package_file in evicted}:
+                self.fix_index(self.pool_dir / pkgdir)
+
+        return evicted
+
+    def fix_index(self, pkgdir):
+        """Rebuilds the Packages index for a binary package directory"""
+        self.logger.debug("Rebuilding binary package index: %s" % pkgdir)
+        cmd_out = traced_run(["emaint", "--fix", "binhost"], capture_output=True, env={**environ, "PKGDIR": str(pkgdir)})
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode("utf-8"))
@@ -2,39 +2,217 @@ __author__ = "desultory"
 __version__ = "0.1.0"
 
 
+from collections import deque
+from logging import Formatter, getLogger
+from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from subprocess import run
+from re import compile
+from subprocess import DEVNULL, PIPE, STDOUT, Popen
+from time import perf_counter_ns
 
-import portage
 from zenlib.logging import loggify
 
+from gentainer.package_index import is_plain_atom
+from gentainer.tracing import tracer
+from gentainer.vdb import VDBIndex
+
+# Matches emerge progress lines, such as:
+# >>> Emerging binary (1 of 2) sys-libs/glibc-2.38-r10::gentoo
+# >>> Completed (1 of 2) sys-libs/glibc-2.38-r10::gentoo
+EMERGE_PROGRESS = compile(
+    r"^>>> (?P<event>Emerging|Completed) (?P<binary>binary )?\((?P<index>\d+) of (?P<total>\d+)\) (?P<cpv>[^\s:]+)"
+)
+EMERGE_FAILED = compile(r"^>>> Failed to emerge (?P<cpv>[^\s:,]+)")
+EMERGE_EVENTS = {"Emerging": "start", "Completed": "finish"}
+WORLD_FILE = Path("var", "lib", "portage", "world")
+OUTPUT_TAIL_LINES = 100  # Lines of emerge output kept in memory for error messages
+
+
+def get_world_atom(atom):
+    """Gets the world file entry for an atom, which is its category/package and slot, like emerge records"""
+    if is_plain_atom(atom):
+        return atom
+
+    from portage.dep import Atom
+
+    atom = Atom(atom)
+    return "%s:%s" % (atom.cp, atom.slot) if atom.slot else atom.cp
+
 
 @loggify
 class Builder:
     parameters = {"packages": list}  # Packages to install in the container
 
-    def __init__(self, container, build_dir, packages, force=False, *args, **kwargs):
+    def __init__(
+        self,
+        container,
+        build_dir,
+        packages,
+        force=False,
+        binpkg_pool=None,
+        log_dir=None,
+        log_size=50 << 20,
+        log_count=3,
+        job_budget=None,
+        skip_installed=True,
+        prefetcher=None,
+        *args,
+        **kwargs,
+    ):
         self.container = container
         self.build_dir = Path(build_dir)
         self.packages = packages
+        self.binpkg_pool = binpkg_pool  # Shared BinpkgPool, if set
+        self.log_dir = Path(log_dir) if log_dir else None  # Emerge output is written to <log_dir>/<container>.log
+        self.log_size = log_size
+        self.log_count = log_count
+        self.job_budget = job_budget  # Shared JobBudget, if set the build uses a share of its jobs
+        self.skip_installed = skip_installed  # Don't pass packages already installed with matching USE to emerge
+        self.prefetcher = prefetcher  # Shared DistfilePrefetcher, if set builds use its distfiles dir and mirrors
+        self.binpkg_hits = []
+        self.binpkg_misses = []
+        self.package_starts = {}  # {cpv: perf_counter_ns start time}
+        self.package_results = []  # [{cpv, binary, status, duration}]
+        self.total_packages = 0
         self.logger.info("[%s] Build directory: %s" % (self.container, self.build_dir))
 
+    def get_output_logger(self):
+        """Gets a logger which writes emerge output to a rotating log file for this layer"""
+        output_logger = getLogger("gentainer.emerge.%s" % self.container)
+        output_logger.propagate = False
+        output_logger.setLevel(1)
+        if self.log_dir:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(
+                self.log_dir / ("%s.log" % self.container), maxBytes=self.log_size, backupCount=self.log_count
+            )
+            handler.setFormatter(Formatter("%(asctime)s %(message)s"))
+            output_logger.addHandler(handler)
+        return output_logger
+
+    def handle_output_line(self, line):
+        """Parses an emerge output line, handling package progress events"""
+        if match := EMERGE_PROGRESS.match(line):
+            event = {
+                "event": EMERGE_EVENTS[match["event"]],
+                "cpv": match["cpv"],
+                "index": int(match["index"]),
+                "total": int(match["total"]),
+                "binary": bool(match["binary"]),
+            }
+        elif match := EMERGE_FAILED.match(line):
+            event = {"event": "fail", "cpv": match["cpv"], "index": None, "total": self.total_packages, "binary": None}
+        else:
+            return
+
+        event["container"] = self.container
+        self.handle_event(event)
+
+    def handle_event(self, event):
+        """Records package events, logs progress.
+        Merged and failed packages are recorded as package spans when tracing is enabled."""
+        cpv = event["cpv"]
+        self.total_packages = event["total"] or self.total_packages
+        if event["event"] == "start":
+            self.package_starts[cpv] = perf_counter_ns()
+            (self.binpkg_hits if event["binary"] else self.binpkg_misses).append(cpv)
+            self.logger.info(
+                "[%s] (%d of %d) Emerging%s: %s"
+                % (self.container, event["index"], event["total"], " binary" if event["binary"] else "", cpv)
+            )
+            return
+
+        start_time, end_time = self.package_starts.pop(cpv, None), perf_counter_ns()
+        event["duration"] = (end_time - start_time) / 1e9 if start_time else None
+        package_result = {
+            "cpv": cpv,
+            "binary": cpv in self.binpkg_hits,
+            "status": "complete" if event["event"] == "finish" else "failed",
+            "duration": event["duration"],
+        }
+        self.package_results.append(package_result)
+        if start_time:
+            tracer.add_span(cpv, "package", start_time, end_time, container=self.container, **package_result)
+        completed = len([result for result in self.package_results if result["status"] == "complete"])
+        if event["event"] == "finish":
+            self.logger.info(
+                "[%s] (%d of %d) Completed in %.1fs: %s"
+                % (self.container, completed, self.total_packages, event["duration"] or 0, cpv)
+            )
+        else:
+            self.logger.error("[%s] Failed to emerge: %s" % (self.container, cpv))
+
+    def get_missing_packages(self):
+        """Gets the packages which are not already installed in the build dir with matching USE flags"""
+        with tracer.span("vdb_index", container=self.container):
+            packages = VDBIndex(self.build_dir, logger=self.logger).filter_installed(self.packages)
+        if installed := [package for package in self.packages if package not in packages]:
+            self.logger.info("[%s] Skipping installed packages: %s" % (self.container, ", ".join(installed)))
+            self.add_world_atoms(installed)
+        return packages
+
+    def add_world_atoms(self, packages):
+        """Adds packages to the world file of the build dir, as emerge does for the packages it merges.
+        Skipped packages were requested by the config, so depclean must not remove them."""
+        world_file = self.build_dir / WORLD_FILE
+        world = set(world_file.read_text().split()) if world_file.exists() else set()
+        atoms = sorted({get_world_atom(package) for package in packages} - world)
+        if not atoms:
+            return
+        self.logger.info("[%s] Adding skipped packages to the world file: %s" % (self.container, ", ".join(atoms)))
+        world_file.parent.mkdir(parents=True, exist_ok=True)
+        world_file.write_text("".join("%s\n" % atom for atom in sorted(world.union(atoms))))
+
     def build(self):
-        """Build the image layer for a specific container"""
+        """Build the image layer for a specific container.
+        Packages already installed by the base image are skipped, emerge is not run if no packages remain.
+        Emerge output is streamed to the logger and the layer log file, only the last lines are kept in memory."""
         if not self.build_dir.exists():
             raise FileNotFoundError("Build directory does not exist: %s" % self.build_dir)
 
-        args = ["emerge", "--root", str(self.build_dir), *self.packages]
-        cmd_out = run(args, capture_output=True)
+        packages = self.get_missing_packages() if self.skip_installed else self.packages
+        if not packages:
+            self.logger.info("[%s] All packages are already installed, skipping emerge" % self.container)
+            return
+
+        args = ["emerge", "--color", "n", "--root", str(self.build_dir)]
+        env = None
+        if self.binpkg_pool:
+            args.extend(self.binpkg_pool.get_emerge_args())
+            env = self.binpkg_pool.get_env()
+        if self.prefetcher:
+            env = self.prefetcher.get_env(env)
 
-        if cmd_out.returncode != 0:
-            raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+        output_logger = self.get_output_logger()
+        output_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        job_share = self.job_budget.acquire(self.container) if self.job_budget else None
+        try:
+            if job_share:
+                args.extend(self.job_budget.get_emerge_args(job_share))
+                env = self.job_budget.get_env(job_share, env)
+            args.extend(packages)
+            with (
+                tracer.span("emerge", category="subprocess", container=self.container, command=" ".join(args)),
+                Popen(args, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, env=env, text=True, errors="replace") as cmd,
+            ):
+                for line in cmd.stdout:
+                    line = line.rstrip("\n")
+                    output_tail.append(line)
+                    output_logger.info(line)
+                    self.logger.log(5, "[%s] %s" % (self.container, line))
+                    self.handle_output_line(line)
+        finally:
+            if job_share:
+                self.job_budget.release(self.container)
+            for handler in output_logger.handlers[:]:
+                output_logger.removeHandler(handler)
+                handler.close()
 
-        self.logger.debug("[%s] Build output: %s" % (self.container, cmd_out.stdout.decode("utf-8")))
-        self.logger.info("[%s] Built packages: %s" % (self.container, self.packages))
+        if cmd.returncode != 0:
+            raise RuntimeError(
+                "[%s] Emerge failed with exit code %d:\n%s" % (self.container, cmd.returncode, "\n".join(output_tail))
+            )
 
-    def validate_packages(self, packages):
-        """Checks if the package exists in the portage database"""
-        for package in packages:
-            if not portage.db[portage.root]["porttree"].dbapi.xmatch("match-all", package):
-                raise KeyError("Package does not exist: %s" % package)
+        if self.binpkg_pool:
+            self.binpkg_pool.record_build(self.container, self.binpkg_hits, self.binpkg_misses)
+        self.logger.info("[%s] Built packages: %s" % (self.container, packages))
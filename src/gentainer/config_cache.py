@@ -0,0 +1,122 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from json import dump, dumps, load
+from os import replace
+from pathlib import Path
+
+from zenlib.logging import loggify
+
+from gentainer.container_config import read_config_file
+
+PARALLEL_LOAD_THRESHOLD = 16  # Fewer files than this are parsed serially, starting workers costs more
+
+
+def read_config_files(config_files, workers=None):
+    """Reads and parses config files, in parallel if there are enough of them.
+    Returns a dict of {config_file: (toml_data, file_info)}."""
+    if len(config_files) < PARALLEL_LOAD_THRESHOLD or workers == 1:
+        return {config_file: read_config_file(config_file) for config_file in config_files}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(config_files, executor.map(read_config_file, config_files, chunksize=16)))
+
+
+def get_cache_file(cache_dir, config_dir):
+    """Gets the config cache file for a config dir, so config dirs sharing a cache_dir don't evict each other"""
+    config_dir_hash = sha256(str(Path(config_dir).resolve()).encode()).hexdigest()[:16]
+    return Path(cache_dir) / ("container_configs-%s.json" % config_dir_hash)
+
+
+@loggify
+class ConfigCache:
+    """Cache of parsed and validated container configs.
+    Entries are keyed on the config file path, and are valid while the file mtime and size,
+    or the file hash, are unchanged."""
+
+    def __init__(self, cache_file, signature, *args, **kwargs):
+        self.cache_file = Path(cache_file)
+        self.signature = signature  # ContainerConfig.get_signature(), entries are dropped if this changes
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        """Loads the cache file, if it exists and the signature matches"""
+        if not self.cache_file.exists():
+            self.logger.debug("Config cache does not exist: %s" % self.cache_file)
+            return
+
+        try:
+            with open(self.cache_file, "r") as cache_file:
+                cache_data = load(cache_file)
+        except ValueError as e:
+            self.logger.warning("Ignoring invalid config cache '%s': %s" % (self.cache_file, e))
+            return
+
+        if cache_data.get("signature") != self.signature:
+            self.logger.info("Config parameters changed, ignoring config cache: %s" % self.cache_file)
+            self.changed = True
+            return
+
+        self.entries = cache_data["entries"]
+        self.logger.debug("Loaded %d cached configs: %s" % (len(self.entries), self.cache_file))
+
+    def get(self, config_file):
+        """Gets cached TOML data for a config file, or None if the file changed"""
+        entry = self.entries.get(str(config_file))
+        if entry is None:
+            return None
+
+        stat = Path(config_file).stat()
+        if entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry["data"]
+
+        if entry["size"] == stat.st_size and entry["sha256"] == sha256(Path(config_file).read_bytes()).hexdigest():
+            self.logger.debug("Config file touched but unchanged: %s" % config_file)
+            entry["mtime_ns"] = stat.st_mtime_ns
+            self.changed = True
+            return entry["data"]
+
+        self.logger.debug("Config file changed: %s" % config_file)
+        return None
+
+    def set(self, config_file, toml_data, file_info):
+        """Caches validated TOML data for a config file.
+        Data which can't be stored as JSON is not cached."""
+        try:
+            dumps(toml_data)
+        except TypeError as e:
+            self.logger.debug("Not caching config '%s': %s" % (config_file, e))
+            return
+
+        self.entries[str(config_file)] = {**file_info, "data": toml_data}
+        self.changed = True
+
+    def prune(self, config_files):
+        """Removes entries for config files which no longer exist"""
+        config_files = {str(config_file) for config_file in config_files}
+        for config_file in [config_file for config_file in self.entries if config_file not in config_files]:
+            self.logger.debug("Removing cached config: %s" % config_file)
+            self.entries.pop(config_file)
+            self.changed = True
+
+    def save(self):
+        """Saves the cache if it changed, failures are not fatal"""
+        if not self.changed:
+            return
+
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+            with open(temp_file, "w") as cache_file:
+                dump({"signature": self.signature, "entries": self.entries}, cache_file)
+            replace(temp_file, self.cache_file)
+        except OSError as e:
+            self.logger.warning("Unable to save config cache: %s" % e)
+        else:
+            self.changed = False
+            self.logger.debug("Saved config cache: %s" % self.cache_file)
@@ -2,14 +2,25 @@ __author__ = "desultory"
 __version__ = "0.1.0"
 
 
+from hashlib import sha256
 from importlib import import_module
 from pathlib import Path
-from tomllib import load
+from tomllib import loads
 
 from zenlib.logging import loggify
 from zenlib.util import pretty_print
 
 
+def read_config_file(config_file):
+    """Reads and parses a TOML config file.
+    Returns the TOML data and a dict with the file mtime, size and hash, used by the ConfigCache."""
+    config_file = Path(config_file)
+    stat = config_file.stat()
+    config_bytes = config_file.read_bytes()
+    file_info = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": sha256(config_bytes).hexdigest()}
+    return loads(config_bytes.decode("utf-8")), file_info
+
+
 @loggify
 class ContainerConfig(dict):
     """Dictionary for gentoo container configuration"""
@@ -18,11 +29,11 @@ class ContainerConfig(dict):
                   "config_file": Path,
                   "name": str}
 
-    def __init__(self, parent_config, config_file, *args, **kwargs):
-        """Initialize the config by loading the config file"""
+    def __init__(self, parent_config, config_file, toml_data=None, validated=False, *args, **kwargs):
+        """Initialize the config by loading the config file, or already parsed TOML data"""
         self.parent_config = parent_config
         self.config_file = Path(config_file)
-        self.load_config()
+        self.load_config(toml_data, validated)
 
     def __setattr__(self, key, value):
         """Set an attribute"""
@@ -53,18 +64,28 @@ class ContainerConfig(dict):
                 if hasattr(class_object, f"validate_{parameter}"):
                     setattr(ContainerConfig, f"validate_{parameter}", getattr(class_object, f"validate_{parameter}"))
 
-    def load_config(self):
-        """Reads a container config file"""
+    @staticmethod
+    def get_signature():
+        """Gets a signature of the registered parameters and validators.
+        Cached configs are only valid if this is unchanged."""
+        return sorted(
+            "%s:%s:%s" % (parameter, value.__name__, hasattr(ContainerConfig, f"validate_{parameter}"))
+            for parameter, value in ContainerConfig.parameters.items()
+        )
+
+    def load_config(self, toml_data=None, validated=False):
+        """Reads a container config file, unless the TOML data is supplied.
+        Validation functions are skipped if the data was already validated."""
         self.logger.info("Loading container config: %s" % self.config_file)
-        with open(self.config_file, "rb") as config_file:
-            toml_data = load(config_file)
+        if toml_data is None:
+            toml_data, _ = read_config_file(self.config_file)
 
         # Get the file name of the config file - the extension
         self.name = self.config_file.name.split(".")[0]
         self.logger.debug("[%s] Read TOML data: %s" % (self.name, toml_data))
 
         for key, value in toml_data.items():
-            if hasattr(self, f"validate_{key}"):
+            if not validated and hasattr(self, f"validate_{key}"):
                 self.logger.debug("[%s] Validating parameter '%s':\n%s" % (self.name, key, pretty_print(value)))
                 getattr(self, f"validate_{key}")(value)
 
@@ -0,0 +1,244 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from json import dumps, loads
+from os import chmod
+from pathlib import Path
+from socket import AF_UNIX, SOCK_STREAM, socket
+from threading import Condition, Event, Lock
+
+from zenlib.logging import loggify
+
+from gentainer.tracing import tracer
+
+DEFAULT_SOCKET = "/run/gentainer/gentainer.sock"
+CONTAINER_ACTIONS = ["prepare", "build", "run", "export", "import"]  # Lock the container and its base image chain
+INTERFACE_ACTIONS = ["net_prepare", "net_clean", "net_reconcile"]  # Lock the interface, or everything if none is set
+# Run alone, other actions share state
+EXCLUSIVE_ACTIONS = ["prepare_all", "build_all", "run_all", "gc", "reload", "shutdown"]
+
+
+class ConfigMismatchError(ValueError):
+    """Raised for requests for a config other than the one the daemon serves"""
+
+
+def send_request(socket_path, request):
+    """Sends a request to a gentainer daemon, returns the response.
+    Raises FileNotFoundError or ConnectionRefusedError if no daemon is listening."""
+    with socket(AF_UNIX, SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall(dumps(request).encode() + b"\n")
+        client.shutdown(1)
+        with client.makefile("rb") as response:
+            return loads(response.readline())
+
+
+class SharedLock:
+    """Lock which can be held by many shared holders, or one exclusive holder"""
+
+    def __init__(self):
+        self.condition = Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.exclusive_waiting = 0  # Shared holders wait for pending exclusive holders, so they are not starved
+
+    @contextmanager
+    def hold_shared(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.exclusive and not self.exclusive_waiting)
+            self.shared += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def hold_exclusive(self):
+        with self.condition:
+            self.exclusive_waiting += 1
+            self.condition.wait_for(lambda: not self.exclusive and not self.shared)
+            self.exclusive_waiting -= 1
+            self.exclusive = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive = False
+                self.condition.notify_all()
+
+
+@loggify
+class GentainerDaemon:
+    """
+    Serves gentainer actions over a Unix socket, keeping loaded configs, the package index,
+    the netlink session and the layer manifest between requests.
+
+    Each request is a line of JSON, such as {"action": "prepare", "container_name": "foo"}, answered with a line of JSON.
+    Requests are queued for a pool of workers. Actions on different containers run concurrently,
+    actions on the same container or base image chain are run one at a time,
+    and actions on all containers, or with force, run alone.
+    """
+
+    def __init__(self, gentainer, socket_path=DEFAULT_SOCKET, workers=8, *args, **kwargs):
+        self.gentainer = gentainer
+        self.socket_path = Path(socket_path)
+        self.workers = workers
+        self.state_lock = SharedLock()
+        self.locks = {}  # {(kind, name): Lock}
+        self.locks_lock = Lock()
+        self.stopping = Event()
+
+    def get_lock(self, kind, name):
+        """Gets the lock for a container or interface"""
+        with self.locks_lock:
+            return self.locks.setdefault((kind, name), Lock())
+
+    def get_lock_keys(self, action, name):
+        """Gets the container or interface locks needed for an action, in a consistent order"""
+        if action in CONTAINER_ACTIONS:
+            if name not in self.gentainer.containers:
+                raise KeyError("Container does not exist: %s" % name)
+            return sorted(("container", container) for container in self.gentainer.get_base_chain(name))
+        if action in INTERFACE_ACTIONS:
+            return [("interface", name)]
+        return []
+
+    @contextmanager
+    def lock_request(self, request):
+        """Holds the locks needed to run a request"""
+        action, name = request["action"], request.get("container_name")
+        exclusive = (
+            action in EXCLUSIVE_ACTIONS
+            or request.get("force", False) != self.gentainer.force
+            or (action in INTERFACE_ACTIONS and not name)
+        )
+        with ExitStack() as stack:
+            stack.enter_context(self.state_lock.hold_exclusive() if exclusive else self.state_lock.hold_shared())
+            for kind, lock_name in self.get_lock_keys(action, name):
+                stack.enter_context(self.get_lock(kind, lock_name))
+            yield
+
+    def run_action(self, request):
+        """Runs an action, returns (result, output)"""
+        gentainer, name = self.gentainer, request.get("container_name")
+        match request["action"]:
+            case "ping":
+                return None, "pong"
+            case "list":
+                return None, gentainer.format_list()
+            case "du":
+                usage = gentainer.get_layer_gc().get_usage()
+                return None, gentainer.format_usage(usage)
+            case "reload":
+                return gentainer.reload(), None
+            case "shutdown":
+                self.stopping.set()
+                return None, "Stopping daemon"
+            case "prepare_all":
+                return gentainer.prepare_all(), None
+            case "build_all":
+                return gentainer.build_all(), None
+            case "run_all":
+                return gentainer.get_run_report()
+            case "gc":
+                return gentainer.get_gc_report(request.get("dry_run", False))
+            case "history":
+                return None, gentainer.format_history(name)
+            case "stats":
+                return None, gentainer.format_stats()
+            case "plan":
+                return None, gentainer.get_plan([name] if name else None)
+            case "optimize":
+                return None, gentainer.get_optimization(request.get("file"))
+            case "prepare":
+                return gentainer.prepare(name), None
+            case "build":
+                return gentainer.build(name), None
+            case "run":
+                return gentainer.get_run_report([name])
+            case "net_prepare":
+                return gentainer.net_prepare(name), None
+            case "net_clean":
+                return gentainer.net_clean(name), None
+            case "net_reconcile":
+                return gentainer.net_reconcile(name), None
+            case "export":
+                return gentainer.export_layer(name, request.get("file")), None
+            case "import":
+                return gentainer.import_layer(name, request.get("file")), None
+        raise ValueError("Unknown action: %s" % request["action"])
+
+    def handle_request(self, request):
+        """Runs a request under its locks, returns the response"""
+        if Path(request.get("config", self.gentainer.config_file)).resolve() != self.gentainer.config_file:
+            raise ConfigMismatchError("Daemon is serving a different config: %s" % self.gentainer.config_file)
+
+        # Links may have been changed by other tools since the last request, the table is read again when needed
+        self.gentainer.netlink.invalidate()
+        with self.lock_request(request), tracer.span(
+            "daemon_request", action=request["action"], container=request.get("container_name")
+        ):
+            force = self.gentainer.force
+            self.gentainer.set_force(request.get("force", force))
+            try:
+                result, output = self.run_action(request)
+            finally:
+                self.gentainer.set_force(force)
+        return {"status": "ok", "result": result, "output": output}
+
+    def handle_connection(self, connection):
+        """Reads a request from a connection and writes the response"""
+        with connection, connection.makefile("rb") as request_file:
+            try:
+                request = loads(request_file.readline())
+                self.logger.info("Request: %s" % request)
+                response = self.handle_request(request)
+            except Exception as e:
+                self.logger.error("Request failed: %s" % e)
+                response = {"status": "error", "error": str(e), "type": e.__class__.__name__}
+            try:
+                connection.sendall(dumps(response, default=str).encode() + b"\n")
+            except OSError as e:
+                self.logger.warning("Unable to send response: %s" % e)
+
+    def bind(self):
+        """Binds the socket, replacing a stale socket file if no daemon is listening on it"""
+        if self.socket_path.exists():
+            try:
+                send_request(self.socket_path, {"action": "ping"})
+            except (ConnectionRefusedError, FileNotFoundError):
+                self.logger.warning("Removing stale daemon socket: %s" % self.socket_path)
+                self.socket_path.unlink()
+            else:
+                raise RuntimeError("A daemon is already listening on: %s" % self.socket_path)
+
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        server = socket(AF_UNIX, SOCK_STREAM)
+        server.bind(str(self.socket_path))
+        chmod(self.socket_path, 0o600)
+        server.listen(128)
+        server.settimeout(1)  # So the accept loop notices shutdown requests
+        return server
+
+    def serve(self):
+        """Accepts connections until a shutdown request is received"""
+        server = self.bind()
+        self.logger.info("Listening on: %s" % self.socket_path)
+        try:
+            with server, ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while not self.stopping.is_set():
+                    try:
+                        connection, _ = server.accept()
+                    except TimeoutError:
+                        continue
+                    connection.settimeout(None)
+                    executor.submit(self.handle_connection, connection)
+        finally:
+            self.socket_path.unlink(missing_ok=True)
+            self.gentainer.close()
+            self.logger.info("Daemon stopped")
@@ -0,0 +1,224 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from pathlib import Path
+from subprocess import PIPE, Popen
+from tempfile import TemporaryFile
+
+from zenlib.logging import loggify
+
+from gentainer.tracing import traced_run, tracer
+
+EXPORT_SUFFIXES = {"btrfs": "btrfs.zst", "tar": "tar.zst", "squashfs": "squashfs"}
+TAR_ARGS = ["--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls"]  # Preserve ownership, xattrs and ACLs
+
+
+def run_pipeline(commands, stdin=None, stdout=None, container=None):
+    """Runs commands with the stdout of each piped to the stdin of the next.
+    Raises a RuntimeError with the stderr of every command which failed."""
+    processes = []
+    with tracer.span("pipeline", category="subprocess", command=" | ".join(map(" ".join, commands)), container=container):
+        try:
+            for index, args in enumerate(commands):
+                last = index == len(commands) - 1
+                stderr = TemporaryFile()  # Not a pipe, so a command writing a lot of errors can't block the pipeline
+                process = Popen(args, stdin=stdin, stdout=stdout if last else PIPE, stderr=stderr)
+                if processes:
+                    processes[-1][0].stdout.close()  # Only the next command holds the pipe, so it gets SIGPIPE if that exits
+                stdin = process.stdout
+                processes.append((process, stderr))
+        finally:
+            errors = []
+            for process, stderr in processes:
+                if process.stdout:
+                    process.stdout.close()
+                if process.wait() != 0:
+                    stderr.seek(0)
+                    errors.append("%s: %s" % (process.args[0], stderr.read().decode("utf-8", errors="replace").strip()))
+                stderr.close()
+
+    if errors:
+        raise RuntimeError("Pipeline failed:\n%s" % "\n".join(errors))
+
+
+@loggify
+class LayerExporter:
+    """
+    Exports and imports layers as compressed files.
+
+    btrfs layers are exported as a send stream of a read-only snapshot, relative to the snapshot of the base image layer,
+    so only the changes made by the layer are included.
+    Snapshots are kept, along with the digest of the layer build they were taken from, and are only taken again when
+    the layer is rebuilt, so every export of a layer uses the same parent snapshot as the imports made from it.
+    Other backings are exported as a tarball or squashfs image. For overlay layers, only the upper dir is exported.
+    Streams are compressed with multi-threaded zstd.
+    """
+
+    def __init__(self, layer, export_format="tar", threads=0, compression_level=3, manifest=None, *args, **kwargs):
+        self.layer = layer  # Layers object of the layer being exported or imported
+        self.manifest = manifest  # LayerManifest, used to find snapshots of previous layer builds
+        self.container = layer.container
+        self.export_format = "btrfs" if layer.directory_backing == "btrfs" else export_format
+        if self.export_format not in EXPORT_SUFFIXES:
+            raise ValueError("Unknown export format: %s" % self.export_format)
+        self.threads = threads  # zstd and mksquashfs threads, 0 uses all CPUs
+        self.compression_level = compression_level
+        self.snapshot_dir = layer.build_dir / ".snapshots"  # Read-only snapshots of exported btrfs layers
+
+    def get_suffix(self):
+        """Gets the file suffix for the export format"""
+        return EXPORT_SUFFIXES[self.export_format]
+
+    def get_source_dir(self):
+        """Gets the directory which holds the layer contents, the upper dir for overlay layers"""
+        return self.layer.upper_dir if self.layer.directory_backing == "overlay" else self.layer.layer_dir
+
+    def get_compress_args(self):
+        return ["zstd", "-q", "-c", "-T%d" % self.threads, "-%d" % self.compression_level]
+
+    def btrfs(self, *args):
+        """Runs a btrfs command"""
+        cmd_out = traced_run(["btrfs", *map(str, args)], container=self.container, capture_output=True)
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+
+    def get_digest(self, container):
+        """Gets the digest of the current build of a layer, or None if it is not in the manifest"""
+        return self.manifest.get(container) if self.manifest else None
+
+    def write_snapshot_digest(self, container, digest):
+        """Records the digest of the layer build a snapshot was taken from"""
+        digest_file = self.snapshot_dir / ("%s.digest" % container)
+        if digest:
+            digest_file.write_text(digest)
+        else:
+            digest_file.unlink(missing_ok=True)
+
+    def snapshot(self, container, layer_dir):
+        """Gets the read-only snapshot of a layer.
+        An existing snapshot is used unless it was taken from a different build of the layer,
+        so layers exported relative to it can still be imported where it was received."""
+        snapshot = self.snapshot_dir / container
+        digest = self.get_digest(container)
+        if snapshot.exists():
+            digest_file = self.snapshot_dir / ("%s.digest" % container)
+            snapshot_digest = digest_file.read_text() if digest_file.exists() else None
+            if digest is None or snapshot_digest == digest:
+                self.logger.debug("[%s] Using existing snapshot: %s" % (self.container, snapshot))
+                return snapshot
+            self.logger.info("[%s] Replacing snapshot of a previous layer build: %s" % (self.container, snapshot))
+            self.btrfs("subvolume", "delete", snapshot)
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.logger.info("[%s] Creating read-only snapshot: %s" % (self.container, snapshot))
+        self.btrfs("subvolume", "snapshot", "-r", layer_dir, snapshot)
+        self.write_snapshot_digest(container, digest)
+        return snapshot
+
+    def export(self, export_file):
+        """Exports the layer to a file, returns info about the export"""
+        export_file = Path(export_file)
+        export_file.parent.mkdir(parents=True, exist_ok=True)
+        self.logger.info("[%s] Exporting layer as %s: %s" % (self.container, self.export_format, export_file))
+        parent = getattr(self, "export_%s" % self.export_format)(export_file)
+        size = export_file.stat().st_size
+        self.logger.info("[%s] Exported %d bytes: %s" % (self.container, size, export_file))
+        return {
+            "container": self.container,
+            "base_image": self.layer.base_image,
+            "backing": self.layer.directory_backing,
+            "format": self.export_format,
+            "parent": parent,
+            "size": size,
+        }
+
+    def export_btrfs(self, export_file):
+        """Sends a read-only snapshot of the layer, relative to the base image snapshot if there is a base image"""
+        snapshot = self.snapshot(self.container, self.layer.layer_dir)
+        args = ["btrfs", "send", "-q"]
+        if self.layer.base_image:
+            parent = self.snapshot(self.layer.base_image, self.layer.build_dir / self.layer.base_image)
+            self.logger.info("[%s] Sending changes relative to: %s" % (self.container, parent))
+            args.extend(["-p", str(parent)])
+        with open(export_file, "wb") as output:
+            run_pipeline([[*args, str(snapshot)], self.get_compress_args()], stdout=output, container=self.container)
+        return self.layer.base_image
+
+    def export_tar(self, export_file):
+        """Exports the layer contents as a zstd compressed tarball"""
+        args = ["tar", "--create", "--file", "-", "--directory", str(self.get_source_dir()), *TAR_ARGS, "."]
+        with open(export_file, "wb") as output:
+            run_pipeline([args, self.get_compress_args()], stdout=output, container=self.container)
+        return self.layer.base_image if self.layer.directory_backing == "overlay" else None
+
+    def export_squashfs(self, export_file):
+        """Exports the layer contents as a zstd compressed squashfs image"""
+        args = ["mksquashfs", str(self.get_source_dir()), str(export_file), "-noappend", "-comp", "zstd"]
+        args.extend(["-Xcompression-level", str(self.compression_level)])
+        if self.threads:
+            args.extend(["-processors", str(self.threads)])
+        cmd_out = traced_run(args, container=self.container, capture_output=True)
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+        return self.layer.base_image if self.layer.directory_backing == "overlay" else None
+
+    def check_import(self, export_file, parent=None):
+        """Checks a layer can be imported from a file before the current layer is removed.
+        btrfs exports relative to a parent need the snapshot of the parent, which is received when it is imported."""
+        if not Path(export_file).exists():
+            raise FileNotFoundError("Export file does not exist: %s" % export_file)
+        if self.export_format == "btrfs" and parent and not (self.snapshot_dir / parent).exists():
+            raise FileNotFoundError(
+                "[%s] Parent snapshot does not exist, import or export the base image layer '%s' first: %s"
+                % (self.container, parent, self.snapshot_dir / parent)
+            )
+
+    def import_layer(self, export_file, digest=None):
+        """Imports the layer from a file, the base image layer must already exist.
+        The digest is recorded for the received btrfs snapshot."""
+        export_file = Path(export_file)
+        self.check_import(export_file, self.layer.base_image)
+        self.logger.info("[%s] Importing %s layer: %s" % (self.container, self.export_format, export_file))
+        getattr(self, "import_%s" % self.export_format)(export_file)
+        if self.export_format == "btrfs":
+            self.write_snapshot_digest(self.container, digest)
+
+    def import_btrfs(self, export_file):
+        """Receives the snapshot, then creates the layer as a writable snapshot of it"""
+        snapshot = self.snapshot_dir / self.container
+        if snapshot.exists():
+            self.btrfs("subvolume", "delete", snapshot)
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        with open(export_file, "rb") as input_file:
+            run_pipeline(
+                [["zstd", "-q", "-d", "-c"], ["btrfs", "receive", str(self.snapshot_dir)]],
+                stdin=input_file,
+                container=self.container,
+            )
+        self.btrfs("subvolume", "snapshot", snapshot, self.layer.layer_dir)
+
+    def prepare_target(self):
+        """Prepares the directory the layer contents are imported into"""
+        if self.layer.directory_backing == "overlay":
+            self.layer.prepare()  # Stacks an empty upper dir on the base image chain
+        else:
+            self.layer.build_dir.mkdir(parents=True, exist_ok=True)
+            self.layer.layer_dir.mkdir()
+        return self.get_source_dir()
+
+    def import_tar(self, export_file):
+        """Extracts the tarball into the layer"""
+        target_dir = self.prepare_target()
+        args = ["tar", "--extract", "--file", "-", "--directory", str(target_dir), *TAR_ARGS, "--same-permissions"]
+        with open(export_file, "rb") as input_file:
+            run_pipeline([["zstd", "-q", "-d", "-c"], args], stdin=input_file, container=self.container)
+
+    def import_squashfs(self, export_file):
+        """Extracts the squashfs image into the layer"""
+        target_dir = self.prepare_target()
+        args = ["unsquashfs", "-force", "-dest", str(target_dir), str(export_file)]
+        if self.threads:
+            args.extend(["-processors", str(self.threads)])
+        cmd_out = traced_run(args, container=self.container, capture_output=True)
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode("utf-8"))
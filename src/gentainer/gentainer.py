@@ -2,37 +2,94 @@ __author__ = "desultory"
 __version__ = "0.1.0"
 
 
+from json import dump, load as load_json
+from datetime import datetime
 from pathlib import Path
+from statistics import median
+from threading import RLock
+from time import time
 from tomllib import load
 
 from zenlib.logging import loggify
 from zenlib.util import handle_plural, pretty_print
 
+from gentainer.binpkgs import BinpkgPool, parse_size
 from gentainer.builder import Builder
+from gentainer.config_cache import ConfigCache, get_cache_file, read_config_files
 from gentainer.container_config import ContainerConfig
+from gentainer.export import LayerExporter
+from gentainer.history import BuildHistory, format_duration
+from gentainer.jobs import JobBudget
+from gentainer.layer_gc import LayerGC, format_size
 from gentainer.layers import Layers
-from gentainer.nets import ContainerNet, HostNet
-from gentainer.users import UserManager
+from gentainer.manifest import LayerManifest, get_layer_digest, hash_paths
+from gentainer.nets import ContainerNet, HostNet, netlink_session
+from gentainer.optimize import LayerOptimizer
+from gentainer.prefetch import DistfilePrefetcher
+from gentainer.package_index import PackageIndex
+from gentainer.runner import ContainerRunner
+from gentainer.scheduler import BuildScheduler
+from gentainer.tracing import traced, tracer
+from gentainer.usernet import UsernetDB
+from gentainer.watch import ConfigWatcher
+from gentainer.users import UserManager, UserProvisioner
+from gentainer.vdb import get_installed_size
 
 
 @loggify
 class Gentainer:
-    def __init__(self, config="config.toml", force=False, *args, **kwargs):
+    def __init__(self, config="config.toml", force=False, jobs=None, netlink=None, *args, **kwargs):
         self.containers = {}
         self.force = force  # Force operations
+        self.jobs = jobs  # Parallel layer builds, overrides build_jobs
+        self.netlink = netlink or netlink_session  # Netlink session shared by all network operations
         self.preparation_tasks = []
+        self.prepared = set()  # Containers and interfaces prepared during this run
+        self.prepare_lock = RLock()
+        self.layer_digests = {}
+        self.package_index = None
+        self.build_history = None
         self.load_config(config)
 
+    @traced("load_containers")
     def load_containers(self):
-        """Loads all containers from self.config_dir"""
+        """
+        Loads all containers from self.config_dir.
+        Configs which are unchanged since they were cached are not parsed or validated again,
+        other configs are parsed in parallel.
+        """
         if not self.config_dir.exists():
             raise FileNotFoundError("Container directory does not exist: %s" % self.config_dir)
 
         self.logger.info("Loading containers from: %s" % self.config_dir)
-        for container in Path(self.config_dir).glob("*.toml"):
-            self.containers[container.stem] = ContainerConfig(
-                parent_config=self.config, config_file=container, logger=self.logger
-            )
+        config_files = sorted(Path(self.config_dir).glob("*.toml"))
+        config_cache = ConfigCache(
+            get_cache_file(self.cache_dir, self.config_dir), ContainerConfig.get_signature(), logger=self.logger
+        )
+        cached_configs = {config_file: config_cache.get(config_file) for config_file in config_files}
+        changed_files = [config_file for config_file, toml_data in cached_configs.items() if toml_data is None]
+        if changed_files:
+            self.logger.info("Parsing %d changed container configs" % len(changed_files))
+        parsed_configs = read_config_files(changed_files, workers=self.config.get("config_load_workers"))
+
+        for config_file in config_files:
+            if config_file in parsed_configs:
+                toml_data, file_info = parsed_configs[config_file]
+                self.containers[config_file.stem] = ContainerConfig(
+                    parent_config=self.config, config_file=config_file, toml_data=toml_data, logger=self.logger
+                )
+                config_cache.set(config_file, toml_data, file_info)
+            else:
+                self.containers[config_file.stem] = ContainerConfig(
+                    parent_config=self.config,
+                    config_file=config_file,
+                    toml_data=cached_configs[config_file],
+                    validated=True,
+                    logger=self.logger,
+                )
+
+        config_cache.prune(config_files)
+        config_cache.save()
 
         if not self.containers:
             self.logger.warning("No container config loaded")
@@ -40,6 +97,31 @@ class Gentainer:
             self.logger.info("Loaded %d containers" % len(self.containers))
             self.logger.debug("Loaded containers: %s" % ", ".join(self.containers.keys()))
 
+    def get_package_index(self):
+        """Gets the package index, loading it on first use"""
+        if self.package_index is None:
+            self.package_index = PackageIndex(
+                self.cache_dir / "package_index.json", self.portage_timestamp_file, logger=self.logger
+            )
+        return self.package_index
+
+    def get_history(self):
+        """Gets the build history database, opening it on first use"""
+        if self.build_history is None:
+            self.build_history = BuildHistory(
+                self.config.get("history_db", self.cache_dir / "history.db"),
+                samples=self.config.get("history_samples", 5),
+                logger=self.logger,
+            )
+        return self.build_history
+
+    @traced("validate_packages")
+    def validate_packages(self):
+        """Validates the packages of all containers against the package index in one batch.
+        Done before actions which use packages, so other actions don't need portage."""
+        packages = {package for container in self.containers.values() for package in container.get("packages", [])}
+        self.get_package_index().validate(sorted(packages))
+
     @handle_plural
     def load_modules(self, module):
         """Loads a module
@@ -48,9 +130,11 @@ class Gentainer:
         self.logger.info("Loading module: %s" % module)
         ContainerConfig.load_module(module)
 
+    @traced("load_config")
     def load_config(self, config):
         """Load a configuration"""
         self.logger.info("Loading configuration file: %s" % config)
+        self.config_file = Path(config).resolve()
         with open(config, "rb") as config_file:
             self.config = load(config_file)
 
@@ -58,25 +142,159 @@ class Gentainer:
         self.logger.debug("Parameters: %s" % ContainerConfig.parameters)
 
         self.build_dir = Path(self.config.get("build_dir", "/tmp/gentainer_build"))
+        self.cache_dir = Path(self.config.get("cache_dir", "/var/cache/gentainer"))
+        self.log_dir = Path(self.config.get("log_dir", self.build_dir / ".logs"))
+        self.build_log_size = parse_size(self.config.get("build_log_size", "50M"))
+        self.build_log_count = self.config.get("build_log_count", 3)
         self.config_dir = Path(self.config.get("config_dir", "./config"))
         self.usernet_file = Path(self.config.get("lxc_usernet_file", "/etc/lxc/lxc-usernet"))
+        self.usernet_db = UsernetDB(self.usernet_file, logger=self.logger)
+        self.net_reconcile_mode = self.config.get("net_reconcile", False)
         self.host_network = HostNet(
-            self.config.get("network_config", "networks.toml"), force=self.force, logger=self.logger
+            self.config.get("network_config_file", self.config.get("network_config", "networks.toml")),
+            force=self.force,
+            netlink=self.netlink,
+            logger=self.logger,
+        )
+
+        self.directory_backing = self.config.get("dir_back", self.config.get("dir_backing", "btrfs"))
+        self.copy_workers = self.config.get("dir_copy_workers")
+        self.overlay_max_depth = self.config.get("overlay_max_depth", 16)
+        self.build_jobs = self.jobs or self.config.get("build_jobs", 1)
+        self.skip_installed = self.config.get("build_skip_installed", True)
+        self.job_budget = None
+        job_budget = self.config.get("build_job_budget", True)  # true uses the CPU count
+        if job_budget is not False:
+            self.job_budget = JobBudget(
+                None if job_budget is True else job_budget,
+                load_average=self.config.get("build_load_average"),
+                state_file=self.cache_dir / "job_budget.json",
+                builds=self.build_jobs,
+                reserve=self.config.get("build_job_reserve", 1),
+                logger=self.logger,
+            )
+        self.layer_manifest = LayerManifest(
+            self.config.get("layer_manifest", self.build_dir / ".manifest.json"), logger=self.logger
+        )
+        self.export_dir = Path(self.config.get("export_dir", self.build_dir / ".exports"))
+        self.export_format = self.config.get("export_format", "tar")
+        self.export_threads = self.config.get("export_threads", 0)
+        self.export_compression_level = self.config.get("export_compression_level", 3)
+        self.gc_keep_days = self.config.get("gc_keep_days", 7)
+        self.run_jobs = self.config.get("run_jobs", 16)
+        self.emerge_log = Path(self.config.get("emerge_log", "/var/log/emerge.log"))
+        self.optimize_min_shared = self.config.get("optimize_min_shared", 3)
+        self.portage_timestamp_file = Path(
+            self.config.get("portage_timestamp_file", "/var/db/repos/gentoo/metadata/timestamp.chk")
         )
+        self.portage_config_files = self.config.get(
+            "portage_config_files", ["/etc/portage/make.conf", "/etc/portage/package.use"]
+        )
+        self.portage_digest = None
+        self.binpkg_pool = None
+        if self.config.get("binpkg_pool", True):
+            self.binpkg_pool = BinpkgPool(
+                self.config.get("binpkg_dir", self.cache_dir / "binpkgs"),
+                max_size=self.config.get("binpkg_pool_size"),
+                logger=self.logger,
+            )
 
-        self.directory_backing = self.config.get("dir_backing", "btrfs")
+        self.prefetcher = DistfilePrefetcher(
+            self.config.get("distfiles_dir"),
+            mirrors=self.config.get("gentoo_mirrors"),
+            jobs=self.config.get("prefetch_jobs", 2),  # 0 disables prefetching
+            binpkg_pool=self.binpkg_pool,
+            logger=self.logger,
+        )
 
         self.logger.debug("Configuration: %s" % pretty_print(self.config))
         self.load_containers()  # Now that the config_dir is set, load the containers
 
+    def format_list(self):
+        """Formats all containers and networks"""
+        return "\n".join(
+            ["Containers:", pretty_print(self.containers), "=" * 80, "Networks:", str(self.host_network)]
+        )
+
     def list(self, filter_string=None):
         """List all containers"""
-        print("Containers:")
-        pretty_print(self.containers, print_out=True)
+        print(self.format_list())
+
+    def close(self):
+        """Closes the netlink session"""
+        self.netlink.close()
+
+    def set_force(self, force):
+        """Sets whether operations are forced"""
+        self.force = force
+        self.host_network.force = force
+
+    def reload(self):
+        """
+        Reloads container configs, keeping loaded modules, the package index, netlink session and manifest.
+        Containers which changed are prepared again when next used.
+        Returns the names of containers which were added, changed or removed.
+        """
+        old_containers, self.containers = self.containers, {}
+        self.load_containers()
+        changed = [
+            name for name in self.containers if dict(self.containers[name]) != dict(old_containers.get(name, {}))
+        ]
+        changed.extend(name for name in old_containers if name not in self.containers)
+        with self.prepare_lock:
+            self.prepared.difference_update(changed)
+        self.invalidate_digests()
+        self.logger.info("Reloaded containers, changed: %s" % ", ".join(changed))
+        return changed
+
+    def reload_config_files(self, config_files):
+        """
+        Reloads specific container config files, removing containers whose file was deleted.
+        If a config is invalid, the previously loaded config is kept.
+        Returns the names of containers which were added, changed or removed.
+        """
+        changed = []
+        for config_file in map(Path, config_files):
+            name = config_file.stem
+            old_config = self.containers.get(name)
+            if config_file.exists():
+                try:
+                    self.containers[name] = ContainerConfig(
+                        parent_config=self.config, config_file=config_file, logger=self.logger
+                    )
+                except Exception as e:
+                    self.logger.error("Invalid container config, keeping the loaded config '%s': %s" % (config_file, e))
+                    continue
+            elif old_config is not None:
+                self.logger.info("Container config removed: %s" % config_file)
+                self.containers.pop(name)
+            if dict(self.containers.get(name, {})) != dict(old_config or {}):
+                changed.append(name)
+
+        with self.prepare_lock:
+            self.prepared.difference_update(changed)
+        self.invalidate_digests()
+        self.logger.info("Reloaded container configs, changed: %s" % ", ".join(changed))
+        return changed
 
-        print("=" * 80)
-        print("Networks:")
-        print(self.host_network)
+    def reload_network(self):
+        """Reloads the network config, then reconciles host interfaces with it"""
+        self.host_network = HostNet(
+            self.host_network.config_file, force=self.force, netlink=self.netlink, logger=self.logger
+        )
+        with self.prepare_lock:
+            self.prepared.difference_update([item for item in self.prepared if isinstance(item, tuple)])
+        self.host_network.reconcile()
+
+    def watch(self):
+        """Watches configs and the portage tree, reconfiguring and rebuilding affected containers as they change"""
+        ConfigWatcher(self, debounce=self.config.get("watch_debounce", 1.0), logger=self.logger).run()
+
+    def invalidate_digests(self):
+        """Clears layer digests and the package index, so they are computed again when next used"""
+        self.layer_digests = {}
+        self.portage_digest = None
+        self.package_index = None  # Checked against the portage timestamp when next used
 
     def net_clean(self, interface=None):
         """Cleans the specified network interface"""
@@ -85,8 +303,21 @@ class Gentainer:
         else:
             self.host_network.clean()
 
+    def net_reconcile(self, interface=None):
+        """Reconciles network interfaces with the network config, applying only the changes needed"""
+        if interface:
+            if isinstance(interface, str):
+                interface = [interface]
+            self.host_network.reconcile_interfaces(list(interface))
+        else:
+            self.host_network.reconcile()
+
     def net_prepare(self, interface=None):
-        """Prepares network interfaces for the containers on the host"""
+        """Prepares network interfaces for the containers on the host.
+        Reconciles the interfaces instead if net_reconcile is enabled."""
+        if self.net_reconcile_mode:
+            return self.net_reconcile(interface)
+
         if interface:
             if isinstance(interface, dict):
                 self.host_network.configure_interface(interface.keys())
@@ -95,45 +326,576 @@ class Gentainer:
         else:
             self.host_network.prepare()
 
+    def prepare_interfaces(self, interfaces):
+        """
+        Prepares the host interfaces used by containers, once per run.
+        Unless net_reconcile or force is set, interfaces which already exist are treated as prepared,
+        so preparing containers again does not fail on their existing interfaces.
+        """
+        interfaces = [interface for interface in interfaces if ("net", interface) not in self.prepared]
+        if not self.net_reconcile_mode and not self.force:
+            existing = [interface for interface in interfaces if self.netlink.link_lookup(interface) is not None]
+            if existing:
+                self.logger.debug("Network interfaces already exist: %s" % ", ".join(existing))
+                self.prepared.update(("net", interface) for interface in existing)
+                interfaces = [interface for interface in interfaces if interface not in existing]
+        if interfaces:
+            self.net_prepare(interfaces)
+            self.prepared.update(("net", interface) for interface in interfaces)
+
     def prepare(self, container):
         """
         Prepare a container.
         Checks if the user exists and creates it if it doesn't.
+        Containers and interfaces are only prepared once per run.
         """
         if container not in self.containers:
             raise KeyError("Container does not exist: %s" % container)
 
-        if "networks" in self.containers[container]:
-            net = ContainerNet(self.containers[container], force=self.force, logger=self.logger)
-            self.net_prepare(net.networks)
+        with self.prepare_lock, tracer.span("prepare", container=container):
+            if container in self.prepared:
+                self.logger.debug("Container already prepared: %s" % container)
+                return
+
+            if "networks" in self.containers[container]:
+                net = ContainerNet(
+                    self.containers[container], force=self.force, netlink=self.netlink, logger=self.logger
+                )
+                self.prepare_interfaces(net.networks)
+
+            if "username" in self.containers[container]:
+                user = UserManager(
+                    self.containers[container],
+                    force=self.force,
+                    lxc_usernet_file=self.usernet_file,
+                    usernet_db=self.usernet_db,
+                    logger=self.logger,
+                )
+                user.prepare()
+
+            self.prepared.add(container)
+
+    @traced("prepare_all")
+    def prepare_all(self, containers=None):
+        """
+        Prepares the specified containers, or all containers, in one pass.
+        Network interfaces for all containers are prepared together,
+        users and LXC directories are prepared in bulk, and usernet changes are written once.
+        Returns a report of the user preparation.
+        """
+        containers = containers or list(self.containers)
+        with self.prepare_lock, self.usernet_db:
+            containers = [container for container in containers if container not in self.prepared]
+            for container in containers:
+                if container not in self.containers:
+                    raise KeyError("Container does not exist: %s" % container)
+
+            interfaces = []
+            for container in containers:
+                for interface in self.containers[container].get("networks", {}):
+                    if interface not in interfaces:
+                        interfaces.append(interface)
+            self.prepare_interfaces(interfaces)
 
-        if "username" in self.containers[container]:
-            user = UserManager(
-                self.containers[container], force=self.force, lxc_usernet_file=self.usernet_file, logger=self.logger
+            provisioner = UserProvisioner(
+                [self.containers[container] for container in containers],
+                force=self.force,
+                lxc_usernet_file=self.usernet_file,
+                usernet_db=self.usernet_db,
+                logger=self.logger,
             )
-            user.prepare()
+            report = provisioner.prepare()
+            self.prepared.update(containers)
+        return report
+
+    def get_layer_gc(self):
+        """Gets the LayerGC for the build dir and loaded containers"""
+        return LayerGC(
+            self.build_dir,
+            self.containers,
+            self.directory_backing,
+            keep_days=self.gc_keep_days,
+            workers=self.copy_workers,
+            logger=self.logger,
+        )
+
+    def get_layer_status(self, name):
+        """Gets the status of a layer: orphan, unbuilt, current or stale"""
+        if name not in self.containers:
+            return "orphan"
+        if name not in self.layer_manifest:
+            return "unbuilt"
+        return "current" if self.layer_manifest.get(name) == self.get_layer_digest(name) else "stale"
+
+    def format_usage(self, usage):
+        """Formats layer usage from LayerGC.get_usage as a table"""
+        lines = ["%-10s %-32s %-8s %12s %12s" % ("Kind", "Layer", "Status", "Exclusive", "Shared")]
+        for (kind, name), layer_usage in usage.items():
+            status = "orphan" if layer_usage["orphan"] else self.get_layer_status(name)
+            sizes = [
+                format_size(layer_usage[key]) if layer_usage[key] is not None else "-" for key in ("exclusive", "shared")
+            ]
+            lines.append("%-10s %-32s %-8s %12s %12s" % (kind, name, status, *sizes))
+        exclusive = sum(layer_usage["exclusive"] or 0 for layer_usage in usage.values())
+        orphaned = sum(layer_usage["exclusive"] or 0 for layer_usage in usage.values() if layer_usage["orphan"])
+        lines.append("Total exclusive: %s, unreferenced: %s" % (format_size(exclusive), format_size(orphaned)))
+        return "\n".join(lines)
+
+    def du(self):
+        """Prints the space used by each layer, and whether it is referenced by a container config"""
+        usage = self.get_layer_gc().get_usage()
+        print(self.format_usage(usage))
+        return usage
+
+    def format_gc_report(self, report, dry_run=False):
+        """Formats the report from LayerGC.collect as a table"""
+        lines = ["%-10s %-32s %s" % ("Kind", "Layer", "Action")]
+        for action, key in [("would delete" if dry_run else "deleted", "deleted"), ("kept", "kept")]:
+            lines.extend("%-10s %-32s %s" % (kind, name, action) for kind, name in report[key])
+        lines.append(
+            "%s %d unreferenced layers, kept %d"
+            % ("Would delete" if dry_run else "Deleted", len(report["deleted"]), len(report["kept"]))
+        )
+        return "\n".join(lines)
+
+    def get_gc_report(self, dry_run=False):
+        """
+        Deletes layers which are not referenced by any container config, and are older than gc_keep_days.
+        With --force, all unreferenced layers are deleted.
+        Manifest entries for deleted or missing layers are removed.
+        With dry_run, nothing is deleted, the report lists the layers which would be deleted.
+        Returns the report from LayerGC.collect and the formatted report.
+        """
+        report = self.get_layer_gc().collect(force=self.force, dry_run=dry_run)
+        if not dry_run:
+            for kind, name in report["deleted"]:
+                if kind == "layer":
+                    self.layer_manifest.remove(name)
+            for name in [name for name in self.layer_manifest.layers if not (self.build_dir / name).exists()]:
+                self.logger.info("Removing missing layer from the manifest: %s" % name)
+                self.layer_manifest.remove(name)
+        return report, self.format_gc_report(report, dry_run)
+
+    def gc(self, dry_run=False):
+        """Deletes unreferenced layers, or lists them with dry_run, and prints the report"""
+        report, output = self.get_gc_report(dry_run)
+        print(output)
+        return report
+
+    def get_runner(self):
+        """Gets the ContainerRunner using the LXC settings from the config"""
+        runner_kwargs = {
+            key: self.config[key]
+            for key in ["lxc_path", "lxc_includes", "subuid_file", "subgid_file", "start_timeout"]
+            if key in self.config
+        }
+        return ContainerRunner(self, logger=self.logger, **runner_kwargs)
+
+    def format_run_report(self, report):
+        """Formats the report from ContainerRunner.start_all as a table"""
+        lines = ["%-32s %-8s %10s  %s" % ("Container", "Status", "Start ms", "Error")]
+        for container, result in report.items():
+            latency = "%.1f" % (result["latency"] * 1000) if result["latency"] is not None else "-"
+            lines.append("%-32s %-8s %10s  %s" % (container, result["status"], latency, result["error"] or ""))
+        latencies = [result["latency"] for result in report.values() if result["latency"] is not None]
+        if latencies:
+            lines.append("Started %d of %d, slowest: %.1fms" % (len(latencies), len(report), max(latencies) * 1000))
+        return "\n".join(lines)
+
+    def run(self, container):
+        """Prepares and starts a built container"""
+        return self.run_all([container])
+
+    def get_run_report(self, containers=None):
+        """
+        Prepares and starts the specified containers, or all containers which are not a base image of another container.
+        Containers are started concurrently, limited by run_jobs, and the start latency of each is reported.
+        Returns the report from ContainerRunner.start_all and the formatted report.
+        Raises a RuntimeError including the formatted report if any container failed to start.
+        """
+        if containers is None:
+            base_images = {config["base_image"] for config in self.containers.values() if "base_image" in config}
+            containers = [container for container in self.containers if container not in base_images]
+        for container in containers:
+            if container not in self.containers:
+                raise KeyError("Container does not exist: %s" % container)
+
+        self.prepare_all(containers)
+        report = self.get_runner().start_all(containers, jobs=self.run_jobs)
+        output = self.format_run_report(report)
+        failed = [container for container, result in report.items() if result["status"] != "running"]
+        if failed:
+            raise RuntimeError("Failed to start containers: %s\n%s" % (", ".join(failed), output))
+        return report, output
+
+    def run_all(self, containers=None):
+        """Prepares and starts the specified containers, or all runnable containers, and prints the start latencies"""
+        report, output = self.get_run_report(containers)
+        print(output)
+        return report
+
+    def get_layer_optimizer(self):
+        """Gets the LayerOptimizer for the loaded containers, reading package sizes from built layers"""
+        layer_roots = []
+        for container in self.containers:
+            layer = self.get_layer(container)
+            layer_root = layer.upper_dir if layer.directory_backing == "overlay" else layer.layer_dir
+            if layer_root.exists():
+                layer_roots.append(layer_root)
+        return LayerOptimizer(
+            self.containers,
+            emerge_log=self.emerge_log,
+            durations=self.get_history().get_package_durations(),
+            min_shared=self.optimize_min_shared,
+            layer_roots=layer_roots,
+            logger=self.logger,
+        )
+
+    def get_optimization(self, output_dir=None):
+        """
+        Proposes intermediate base layers for packages built in more than one sibling layer.
+        If output_dir is set, configs for new layers and rebased containers are written to it.
+        Returns the formatted proposals and projected savings.
+        """
+        self.validate_packages()
+        optimizer = self.get_layer_optimizer()
+        report = optimizer.optimize()
+        if output_dir:
+            optimizer.write_configs(report, output_dir)
+        return optimizer.format_report(report)
+
+    def optimize(self, output_dir=None):
+        """Prints proposed intermediate base layers and the projected savings"""
+        print(self.get_optimization(output_dir))
+
+    def get_portage_digest(self):
+        """Gets the digest of the portage tree timestamp and portage config, computed once per run"""
+        if self.portage_digest is None:
+            self.portage_digest = hash_paths([self.portage_timestamp_file, *self.portage_config_files])
+            self.logger.debug("Portage digest: %s" % self.portage_digest)
+        return self.portage_digest
+
+    def get_layer_digest(self, container):
+        """
+        Gets the digest of a container layer.
+        Includes the base image layer digest, so changes invalidate all descendant layers.
+        """
+        if container not in self.layer_digests:
+            config = self.containers[container]
+            parent_digest = self.get_layer_digest(config["base_image"]) if "base_image" in config else None
+            self.layer_digests[container] = get_layer_digest(
+                config["packages"], parent_digest=parent_digest, portage_digest=self.get_portage_digest()
+            )
+        return self.layer_digests[container]
+
+    def get_base_chain(self, container):
+        """Gets the base image chain of a container, from the root layer to the container"""
+        chain = [container]
+        while "base_image" in self.containers[chain[0]]:
+            base_image = self.containers[chain[0]]["base_image"]
+            if base_image in chain:
+                raise ValueError("Base image loop detected: %s" % " -> ".join([base_image, *chain]))
+            chain.insert(0, base_image)
+        return chain
 
     def build(self, container):
         """
-        Build a container
+        Build a container, along with its base image chain
         """
         if container not in self.containers:
             raise KeyError("Container does not exist: %s" % container)
 
-        self.prepare(container)
+        self.build_all([container])
 
-        layer_args = [container, self.build_dir, self.directory_backing]
-        layer_kwargs = {"force": self.force, "logger": self.logger}
-        if "base_image" in self.containers[container]:
-            base_image = self.containers[container]["base_image"]
-            self.logger.info("Building base image `%s` for container: %s" % (base_image, container))
-            self.build(base_image)
-            layer_kwargs["base_image"] = base_image
+    @traced("build_all")
+    def build_all(self, containers=None):
+        """
+        Builds the specified containers, or all containers.
+        Base image chains are resolved into a graph, each layer is built once.
+        Independent layers are built in parallel, limited by build_jobs,
+        layers on the longest estimated path through the graph are started first.
+        """
+        self.validate_packages()
+        targets = containers or list(self.containers)
+        scheduler = BuildScheduler(self.containers, self.build_layer, jobs=self.build_jobs, logger=self.logger)
+        graph = scheduler.resolve(targets)
+        scheduler.estimates, _ = self.get_build_estimates(graph)
+        self.prepare_all(list(graph))
+
+        # Distfiles for layers which will be built are fetched in build order while earlier layers compile
+        prefetch_layers = []
+        if self.prefetcher.jobs:
+            prefetch_layers = [
+                (container, self.containers[container]["packages"])
+                for container in scheduler.get_build_order(graph)
+                if not self.is_layer_current(container)
+            ]
+
+        try:
+            with self.prefetcher.prefetch(prefetch_layers):
+                return scheduler.run(targets)
+        finally:
+            if self.binpkg_pool:
+                self.binpkg_pool.evict()
+
+    def get_build_estimates(self, graph):
+        """
+        Estimates the build seconds of each layer in a resolved graph from the build history.
+        Up to date layers are estimated at 0, layers without history use the median of the others,
+        or 1 if there is no history, so the longest base image chains are built first.
+        Returns ({container: seconds}, {container: source}), the source is current, history, median or none.
+        """
+        history_estimates = self.get_history().get_estimates(graph)
+        default = median(history_estimates.values()) if history_estimates else 1
+        estimates, sources = {}, {}
+        for container in graph:
+            if self.is_layer_current(container):
+                estimates[container], sources[container] = 0, "current"
+            elif container in history_estimates:
+                estimates[container], sources[container] = history_estimates[container], "history"
+            else:
+                estimates[container], sources[container] = default, "median" if history_estimates else "none"
+        return estimates, sources
+
+    def get_plan(self, containers=None):
+        """Estimates the build of the specified containers, or all containers, without building.
+        Returns the formatted build order, with estimated start and finish times and the total build time."""
+        targets = containers or list(self.containers)
+        scheduler = BuildScheduler(self.containers, None, jobs=self.build_jobs, logger=self.logger)
+        graph = scheduler.resolve(targets)
+        scheduler.estimates, sources = self.get_build_estimates(graph)
+        paths = scheduler.get_critical_paths(graph, scheduler.get_children(graph))
+        times = scheduler.simulate(graph)
+
+        lines = [
+            "%-32s %-8s %-8s %10s %10s %10s %10s"
+            % ("Layer", "Status", "Source", "Estimate", "Start", "Finish", "Path")
+        ]
+        for container in sorted(times, key=lambda container: times[container]):
+            start, finish = times[container]
+            lines.append(
+                "%-32s %-8s %-8s %10s %10s %10s %10s"
+                % (
+                    container,
+                    self.get_layer_status(container),
+                    sources[container],
+                    format_duration(scheduler.estimates[container]),
+                    format_duration(start),
+                    format_duration(finish),
+                    format_duration(paths[container]),
+                )
+            )
+        if "none" in sources.values():
+            lines.append("No build history, layers are estimated at 1s to order the longest base image chains first")
+        lines.append(
+            "Estimated build time: %s with %d jobs, %s of layer builds, %d of %d layers to build"
+            % (
+                format_duration(max((finish for _, finish in times.values()), default=0)),
+                self.build_jobs,
+                format_duration(sum(scheduler.estimates.values())),
+                len([source for source in sources.values() if source != "current"]),
+                len(graph),
+            )
+        )
+        return "\n".join(lines)
+
+    def plan(self, container=None):
+        """Prints the estimated build order and build time for a container and its base images, or all containers"""
+        print(self.get_plan([container] if container else None))
 
-        layer = Layers(*layer_args, **layer_kwargs)
-        layer.prepare()
+    def format_history(self, container=None, limit=20):
+        """Formats the most recent layer builds as a table"""
+        lines = [
+            "%-16s %-32s %-8s %10s %8s %8s %10s"
+            % ("Started", "Layer", "Status", "Duration", "Packages", "Binpkgs", "Size")
+        ]
+        for build in self.get_history().get_builds(container, limit=limit):
+            lines.append(
+                "%-16s %-32s %-8s %10s %8d %8d %10s"
+                % (
+                    datetime.fromtimestamp(build["started"]).strftime("%Y-%m-%d %H:%M"),
+                    build["container"],
+                    build["status"],
+                    format_duration(build["duration"]),
+                    build["packages"],
+                    build["binpkg_hits"],
+                    format_size(build["size"]) if build["size"] is not None else "-",
+                )
+            )
+            if build["error"]:
+                lines.append("  %s" % build["error"].splitlines()[0])
+        return "\n".join(lines)
+
+    def history(self, container=None):
+        """Prints the most recent layer builds, of a container or all containers"""
+        print(self.format_history(container))
+
+    def format_stats(self):
+        """Formats build statistics of each layer as a table"""
+        lines = [
+            "%-32s %6s %8s %10s %10s %10s %8s" % ("Layer", "Builds", "Failures", "Mean", "Last", "Size", "Binpkgs")
+        ]
+        for container, stats in self.get_history().get_stats().items():
+            lines.append(
+                "%-32s %6d %8d %10s %10s %10s %8s"
+                % (
+                    container,
+                    stats["builds"],
+                    stats["failures"],
+                    format_duration(stats["mean"]) if stats["mean"] is not None else "-",
+                    format_duration(stats["last"]) if stats["last"] is not None else "-",
+                    format_size(stats["size"]) if stats["size"] is not None else "-",
+                    "%.0f%%" % (stats["binpkg_rate"] * 100) if stats["binpkg_rate"] is not None else "-",
+                )
+            )
+        return "\n".join(lines)
+
+    def stats(self):
+        """Prints build statistics of each layer from the build history"""
+        print(self.format_stats())
+
+    def is_layer_current(self, container):
+        """Checks if a layer is built with its current digest, so a build would be skipped"""
+        if self.force or container not in self.layer_manifest:
+            return False
+        if not self.get_layer(container).layer_dir.exists():
+            return False
+        return self.layer_manifest.get(container) == self.get_layer_digest(container)
+
+    def get_layer(self, container):
+        """Gets the Layers object for a container"""
+        layer_kwargs = {
+            "force": self.force,
+            "copy_workers": self.copy_workers,
+            "overlay_max_depth": self.overlay_max_depth,
+            "logger": self.logger,
+        }
+        if "base_image" in self.containers[container]:
+            layer_kwargs["base_image"] = self.containers[container]["base_image"]
+        return Layers(container, self.build_dir, self.directory_backing, **layer_kwargs)
 
-        builder = Builder(
-            container, layer.layer_dir, self.containers[container]["packages"], force=self.force, logger=self.logger
+    def get_layer_exporter(self, container, export_format=None):
+        """Gets the LayerExporter for a container layer"""
+        return LayerExporter(
+            self.get_layer(container),
+            export_format=export_format or self.export_format,
+            threads=self.export_threads,
+            compression_level=self.export_compression_level,
+            manifest=self.layer_manifest,
+            logger=self.logger,
         )
-        builder.build()
+
+    @traced("export")
+    def export_layer(self, container, export_file=None):
+        """
+        Exports a built layer to a file, defaults to <export_dir>/<container>.<format suffix>.
+        Info about the export, including the layer digest, is written to <export_file>.json.
+        """
+        if container not in self.containers:
+            raise KeyError("Container does not exist: %s" % container)
+
+        exporter = self.get_layer_exporter(container)
+        if not exporter.layer.layer_dir.exists():
+            raise FileNotFoundError("Layer does not exist for container: %s" % container)
+        export_file = Path(export_file or self.export_dir / ("%s.%s" % (container, exporter.get_suffix())))
+        export_info = exporter.export(export_file)
+        export_info["digest"] = self.layer_manifest.get(container)
+        with open(export_file.with_name(export_file.name + ".json"), "w") as info_file:
+            dump(export_info, info_file, indent=2)
+        return export_info
+
+    @traced("import")
+    def import_layer(self, container, export_file):
+        """
+        Imports a layer exported with export_layer.
+        The base image layer must already exist, and must be the layer the export was made from.
+        If the export info file exists, the layer digest is added to the layer manifest.
+        """
+        if container not in self.containers:
+            raise KeyError("Container does not exist: %s" % container)
+        if not export_file:
+            raise ValueError("An export file must be specified to import a layer")
+
+        export_file = Path(export_file)
+        info_file = export_file.with_name(export_file.name + ".json")
+        export_info = {}
+        if info_file.exists():
+            with open(info_file, "r") as f:
+                export_info = load_json(f)
+            if export_info.get("base_image") != self.containers[container].get("base_image"):
+                raise ValueError(
+                    "[%s] Export base image '%s' does not match the container config"
+                    % (container, export_info.get("base_image"))
+                )
+
+        exporter = self.get_layer_exporter(container, export_format=export_info.get("format"))
+        layer = exporter.layer
+        if layer.base_image and not (self.build_dir / layer.base_image).exists():
+            raise FileNotFoundError("[%s] Base image layer must be imported first: %s" % (container, layer.base_image))
+        exporter.check_import(export_file, layer.base_image)
+        if layer.layer_dir.exists():
+            if not self.force:
+                raise RuntimeError("Layer already exists for container: %s" % container)
+            layer.clean()
+
+        self.layer_manifest.remove(container)
+        exporter.import_layer(export_file, export_info.get("digest"))
+        if export_info.get("digest"):
+            self.layer_manifest.set(container, export_info["digest"])
+        self.logger.info("[%s] Imported layer: %s" % (container, export_file))
+
+    def build_layer(self, container):
+        """
+        Builds the layer for a single container.
+        The base image layer must already be built.
+        Skips the build if the layer was already built with the same digest.
+        """
+        chain = " > ".join(self.get_base_chain(container))
+        with tracer.span("build_layer", container=container, chain=chain):
+            self.prepare(container)
+            digest = self.get_layer_digest(container)
+
+            layer = self.get_layer(container)
+            if layer.base_image:
+                self.logger.info("Using base image `%s` for container: %s" % (layer.base_image, container))
+
+            if layer.layer_dir.exists() and container in self.layer_manifest:
+                if self.layer_manifest.get(container) == digest and not self.force:
+                    self.logger.info("[%s] Layer is up to date, skipping build: %s" % (container, digest))
+                    return
+                self.logger.info("[%s] Layer is out of date, rebuilding: %s" % (container, digest))
+                layer.clean()
+
+            self.prefetcher.wait(container)
+            started = time()
+            self.layer_manifest.remove(container)
+            layer.prepare()
+
+            builder = Builder(
+                container,
+                layer.layer_dir,
+                self.containers[container]["packages"],
+                force=self.force,
+                binpkg_pool=self.binpkg_pool,
+                log_dir=self.log_dir,
+                log_size=self.build_log_size,
+                log_count=self.build_log_count,
+                job_budget=self.job_budget,
+                skip_installed=self.skip_installed,
+                prefetcher=self.prefetcher,
+                logger=self.logger,
+            )
+            try:
+                with layer.mounted():
+                    builder.build()
+                    merged = [result["cpv"] for result in builder.package_results if result["status"] == "complete"]
+                    size = get_installed_size(layer.layer_dir, merged)
+            except Exception as e:
+                self.get_history().record_layer(
+                    container, digest, started, "failed", error=str(e), package_results=builder.package_results
+                )
+                raise
+            self.get_history().record_layer(
+                container, digest, started, "built", size=size, package_results=builder.package_results
+            )
+            self.layer_manifest.set(container, digest)
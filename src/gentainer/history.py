@@ -0,0 +1,165 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from pathlib import Path
+from sqlite3 import connect
+from threading import Lock
+from time import time
+
+from zenlib.logging import loggify
+
+from gentainer.vdb import get_cp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS layer_builds (
+    id INTEGER PRIMARY KEY,
+    container TEXT NOT NULL,
+    digest TEXT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    size INTEGER,
+    packages INTEGER NOT NULL,
+    binpkg_hits INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS layer_builds_container ON layer_builds (container, started);
+CREATE TABLE IF NOT EXISTS package_builds (
+    id INTEGER PRIMARY KEY,
+    layer_build INTEGER NOT NULL REFERENCES layer_builds (id),
+    cpv TEXT NOT NULL,
+    cp TEXT NOT NULL,
+    binary INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL
+);
+CREATE INDEX IF NOT EXISTS package_builds_cp ON package_builds (cp);
+"""
+LAYER_COLUMNS = ["container", "digest", "started", "duration", "status", "error", "size", "packages", "binpkg_hits"]
+INSERT_LAYER = "INSERT INTO layer_builds (%s) VALUES (%s)" % (", ".join(LAYER_COLUMNS), ", ".join("?" * 9))
+INSERT_PACKAGE = "INSERT INTO package_builds (layer_build, cpv, cp, binary, status, duration) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def format_duration(seconds):
+    """Formats seconds, such as 1h02m03s"""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm%02ds" % (hours, minutes, seconds)
+    return "%dm%02ds" % (minutes, seconds) if minutes else "%ds" % seconds
+
+
+@loggify
+class BuildHistory:
+    """
+    SQLite history of layer and package builds.
+
+    Each layer build records its duration, status, config digest, installed size and binary package hits,
+    along with the duration and status of each package it merged.
+    Estimates are the mean duration of the most recent successful builds of a layer.
+    """
+
+    def __init__(self, db_file, samples=5, *args, **kwargs):
+        self.db_file = Path(db_file)
+        self.samples = samples  # Recent successful builds used for estimates
+        self.lock = Lock()  # Layers are built in threads, which share the connection
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.db = connect(self.db_file, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")  # Other gentainer processes can read while builds are recorded
+        self.db.executescript(SCHEMA)
+
+    def record_layer(self, container, digest, started, status, error=None, size=None, package_results=None):
+        """Records a layer build which started at the started timestamp, and the packages it merged"""
+        package_results = package_results or []
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                INSERT_LAYER,
+                (
+                    container,
+                    digest,
+                    started,
+                    time() - started,
+                    status,
+                    error,
+                    size,
+                    len(package_results),
+                    len([result for result in package_results if result["binary"]]),
+                ),
+            )
+            self.db.executemany(
+                INSERT_PACKAGE,
+                [
+                    (
+                        cursor.lastrowid,
+                        result["cpv"],
+                        get_cp(result["cpv"]),
+                        result["binary"],
+                        result["status"],
+                        result["duration"],
+                    )
+                    for result in package_results
+                ],
+            )
+        self.logger.debug("[%s] Recorded %s layer build" % (container, status))
+
+    def get_estimates(self, containers=None):
+        """Gets the estimated build seconds of layers with successful builds. Returns {container: seconds}."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT container, duration FROM layer_builds WHERE status = 'built' ORDER BY started DESC"
+            ).fetchall()
+        durations = {}
+        for container, duration in rows:
+            if containers is None or container in containers:
+                container_durations = durations.setdefault(container, [])
+                if len(container_durations) < self.samples:
+                    container_durations.append(duration)
+        return {container: sum(samples) / len(samples) for container, samples in durations.items()}
+
+    def get_package_durations(self):
+        """Gets the mean source build seconds of each category/package. Returns {cp: seconds}."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT cp, AVG(duration) FROM package_builds"
+                " WHERE status = 'complete' AND NOT binary AND duration IS NOT NULL GROUP BY cp"
+            ).fetchall()
+        return dict(rows)
+
+    def get_builds(self, container=None, limit=20):
+        """Gets the most recent layer builds, newest first"""
+        query = "SELECT %s FROM layer_builds" % ", ".join(LAYER_COLUMNS)
+        parameters = []
+        if container:
+            query += " WHERE container = ?"
+            parameters.append(container)
+        query += " ORDER BY started DESC LIMIT ?"
+        parameters.append(limit)
+        with self.lock:
+            return [dict(zip(LAYER_COLUMNS, row)) for row in self.db.execute(query, parameters)]
+
+    def get_stats(self):
+        """Gets build counts, durations, sizes and binary package hit rates of each layer.
+        Returns {container: {"builds", "failures", "mean", "last", "size", "binpkg_rate"}}."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT container, COUNT(*), SUM(status != 'built'), AVG(CASE WHEN status = 'built' THEN duration END),"
+                " SUM(binpkg_hits), SUM(packages) FROM layer_builds GROUP BY container ORDER BY container"
+            ).fetchall()
+            last_builds = dict(
+                (container, (duration, size))
+                for container, duration, size in self.db.execute(
+                    "SELECT container, duration, size FROM layer_builds WHERE status = 'built' ORDER BY started"
+                )
+            )
+        return {
+            container: {
+                "builds": builds,
+                "failures": failures,
+                "mean": mean,
+                "last": last_builds.get(container, (None, None))[0],
+                "size": last_builds.get(container, (None, None))[1],
+                "binpkg_rate": hits / packages if packages else None,
+            }
+            for container, builds, failures, mean, hits, packages in rows
+        }
@@ -0,0 +1,126 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from contextlib import contextmanager
+from fcntl import LOCK_EX, LOCK_UN, flock
+from json import dump, load
+from math import isqrt
+from os import cpu_count, environ, getpid, kill, replace
+from pathlib import Path
+from threading import Lock
+
+from zenlib.logging import loggify
+
+
+def pid_exists(pid):
+    """Checks if a process exists"""
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@loggify
+class JobBudget:
+    """
+    Host-wide budget of compile jobs shared by concurrent layer builds.
+
+    Active builds are recorded in a locked state file, so builds in separate gentainer runs share the budget.
+    Each build is given a share of the jobs when it starts, an even split between active builds,
+    the builds of this run, and reserved builds which may start later in other runs, capped at the unused jobs.
+    Running emerges can't change their share, so the reserve leaves room for builds which start later,
+    and every emerge also gets the load average limit, which throttles all builds on the host when it is oversubscribed.
+    """
+
+    def __init__(self, jobs=None, load_average=None, state_file=None, builds=1, reserve=1, *args, **kwargs):
+        self.jobs = max(int(jobs or cpu_count() or 1), 1)
+        self.builds = max(int(builds), 1)  # Layers built in parallel by this run, shares are at most jobs // builds
+        self.reserve = max(int(reserve), 0)  # Builds which may start later, which new builds leave an even share for
+        self.load_average = float(load_average or self.jobs)
+        self.state_file = Path(state_file) if state_file else None
+        self.lock = Lock()
+        self.local_builds = {}  # {container: share}, used when there is no state file
+
+    def load_state(self):
+        """Loads active builds from the state file, removing builds of processes which no longer exist.
+        Returns a dict of {"pid:container": share}."""
+        if not self.state_file.exists():
+            return {}
+
+        try:
+            with open(self.state_file, "r") as state_file:
+                builds = load(state_file)
+        except ValueError as e:
+            self.logger.warning("Ignoring invalid job budget state '%s': %s" % (self.state_file, e))
+            return {}
+
+        return {build: share for build, share in builds.items() if pid_exists(int(build.split(":", 1)[0]))}
+
+    def save_state(self, builds):
+        """Writes active builds to the state file"""
+        temp_file = self.state_file.with_name(self.state_file.name + ".tmp")
+        with open(temp_file, "w") as state_file:
+            dump(builds, state_file)
+        replace(temp_file, self.state_file)
+
+    @contextmanager
+    def locked_state(self):
+        """Locks and loads the active builds, writing them when the context exits"""
+        with self.lock:
+            if not self.state_file:
+                yield self.local_builds
+                return
+
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.state_file.with_name(self.state_file.name + ".lock"), "w") as lock_file:
+                flock(lock_file, LOCK_EX)
+                try:
+                    builds = self.load_state()
+                    yield builds
+                    self.save_state(builds)
+                finally:
+                    flock(lock_file, LOCK_UN)
+
+    def get_share(self, builds):
+        """Gets the share of jobs for a new build.
+        New builds get an even share of the budget between the expected concurrent builds,
+        the active builds and this one, or the builds of this run if there are more, plus the reserved builds.
+        The share is capped at the unused jobs so active builds are not oversubscribed.
+        Builds always get at least one job."""
+        unused = self.jobs - sum(builds.values())
+        fair_share = self.jobs // (max(len(builds) + 1, self.builds) + self.reserve)
+        return max(min(fair_share, unused), 1)
+
+    def acquire(self, container):
+        """Registers a build, returns its share of jobs"""
+        with self.locked_state() as builds:
+            share = self.get_share(builds)
+            builds["%d:%s" % (getpid(), container)] = share
+            active = len(builds)
+        self.logger.info("[%s] Using %d of %d jobs, active builds: %d" % (container, share, self.jobs, active))
+        return share
+
+    def release(self, container):
+        """Removes a build, its jobs are available to builds which start later"""
+        with self.locked_state() as builds:
+            builds.pop("%d:%s" % (getpid(), container), None)
+        self.logger.debug("[%s] Released build jobs" % container)
+
+    def split_share(self, share):
+        """Splits a share into parallel emerge jobs and make jobs per package, so their product fits the share"""
+        package_jobs = max(isqrt(share), 1)
+        return package_jobs, max(share // package_jobs, 1)
+
+    def get_emerge_args(self, share):
+        """Gets the emerge arguments for a share of jobs"""
+        package_jobs, _ = self.split_share(share)
+        return ["--jobs", str(package_jobs), "--load-average", "%g" % self.load_average]
+
+    def get_env(self, share, env=None):
+        """Gets the environment for emerge with MAKEOPTS set for a share of jobs"""
+        _, make_jobs = self.split_share(share)
+        return {**(env or environ), "MAKEOPTS": "-j%d -l%g" % (make_jobs, self.load_average)}
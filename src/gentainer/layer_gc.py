@@ -0,0 +1,251 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import cpu_count, scandir
+from os.path import ismount
+from pathlib import Path
+from shutil import rmtree
+from stat import S_ISDIR
+from time import time
+
+from zenlib.logging import loggify
+
+from gentainer.tracing import traced, traced_run
+
+SIZE_UNITS = ["B", "K", "M", "G", "T"]
+GC_ORDER = ["snapshot", "layer", "overlay"]  # Layer kinds in the order they are deleted
+
+
+def format_size(size):
+    """Formats a number of bytes, such as 1.5G"""
+    for unit in SIZE_UNITS:
+        if abs(size) < 1024 or unit == SIZE_UNITS[-1]:
+            return ("%d%s" if unit == "B" else "%.1f%s") % (size, unit)
+        size /= 1024
+
+
+def scan_directory(path):
+    """Scans one directory, returns ({(st_dev, st_ino): allocated bytes}, [subdirectories]).
+    Directories are included in the inodes, symlinks and other entries are counted but not followed."""
+    inodes, subdirs = {}, []
+    with scandir(path) as entries:
+        for entry in entries:
+            stat = entry.stat(follow_symlinks=False)
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_blocks * 512
+            if S_ISDIR(stat.st_mode):
+                subdirs.append(entry.path)
+    return inodes, subdirs
+
+
+def scan_trees(paths, workers=None):
+    """Scans directory trees in parallel, each directory is scanned by a worker thread.
+    Returns {path: {(st_dev, st_ino): allocated bytes}}."""
+    results = {path: {} for path in paths}
+    with ThreadPoolExecutor(max_workers=workers or min(32, (cpu_count() or 1) * 2)) as executor:
+        pending = {executor.submit(scan_directory, path): path for path in paths}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root = pending.pop(future)
+                inodes, subdirs = future.result()
+                results[root].update(inodes)
+                for subdir in subdirs:
+                    pending[executor.submit(scan_directory, subdir)] = root
+    return results
+
+
+@loggify
+class LayerGC:
+    """
+    Finds layers under the build dir which are not referenced by any container config,
+    reports the space used by each layer, and deletes unreferenced layers older than the retention period.
+
+    btrfs space is read from qgroups if quotas are enabled, which separates exclusive and shared bytes.
+    Other layers are walked in parallel, inodes found in more than one layer are counted as shared.
+    """
+
+    def __init__(self, build_dir, containers, directory_backing, keep_days=7, workers=None, *args, **kwargs):
+        self.build_dir = Path(build_dir).resolve()
+        self.containers = containers  # {name: ContainerConfig}
+        self.directory_backing = directory_backing
+        self.keep_days = keep_days  # Unreferenced layers modified more recently than this are kept
+        self.workers = workers
+
+    def get_referenced(self):
+        """Gets the names of all containers and the base images in their chains"""
+        referenced = set(self.containers)
+        for config in self.containers.values():
+            if "base_image" in config:
+                referenced.add(config["base_image"])
+        return referenced
+
+    def find_layers(self):
+        """Finds layers in the build dir. Returns {(kind, name): path}, kind is layer, snapshot or overlay.
+        Directories starting with a dot are not layers."""
+        layers = {}
+        if not self.build_dir.exists():
+            return layers
+        layer_dirs = {
+            "layer": self.build_dir,
+            "snapshot": self.build_dir / ".snapshots",
+            "overlay": self.build_dir / ".overlay",
+        }
+        for kind, layer_dir in layer_dirs.items():
+            if not layer_dir.is_dir():
+                continue
+            for path in layer_dir.iterdir():
+                if path.is_dir() and not path.is_symlink() and not path.name.startswith("."):
+                    layers[(kind, path.name)] = path
+        return layers
+
+    def get_overlay_lower_dirs(self, layers, names):
+        """Gets the overlay lower dirs used by the specified layers"""
+        lower_dirs = set()
+        for (kind, name), path in layers.items():
+            if kind == "overlay" and name in names and (path / "lowerdirs").exists():
+                lower_dirs.update((path / "lowerdirs").read_text().splitlines())
+        return lower_dirs
+
+    def find_orphans(self, layers=None):
+        """Finds layers which are not referenced by container configs, or by the overlay lower dirs of referenced layers.
+        Returns {(kind, name): path}."""
+        layers = layers if layers is not None else self.find_layers()
+        referenced = self.get_referenced()
+        lower_dirs = self.get_overlay_lower_dirs(layers, referenced)
+        orphans = {}
+        for (kind, name), path in layers.items():
+            if name in referenced:
+                continue
+            if kind == "overlay" and any(lower_dir.startswith(str(path) + "/") for lower_dir in lower_dirs):
+                self.logger.debug("Unreferenced overlay layer is used as a lower dir: %s" % name)
+                continue
+            orphans[(kind, name)] = path
+        return orphans
+
+    def get_subvolume_ids(self):
+        """Gets the btrfs subvolume IDs under the build dir. Returns {path: subvolume id}."""
+        cmd_out = traced_run(["btrfs", "subvolume", "list", "-o", str(self.build_dir)], capture_output=True)
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+
+        subvolumes = {}
+        for line in cmd_out.stdout.decode("utf-8").splitlines():
+            # ID 257 gen 12 top level 5 path build/container
+            fields = line.split(maxsplit=8)
+            subvolumes[fields[-1]] = fields[1]
+        return subvolumes
+
+    def get_qgroup_usage(self):
+        """Gets {subvolume id: (referenced bytes, exclusive bytes)} from btrfs qgroups.
+        Returns None if quotas are not enabled."""
+        cmd_out = traced_run(["btrfs", "qgroup", "show", "--raw", "--sync", str(self.build_dir)], capture_output=True)
+        if cmd_out.returncode != 0:
+            self.logger.warning(
+                "Unable to read btrfs qgroups, enable quotas for shared space accounting: %s"
+                % cmd_out.stderr.decode("utf-8").strip()
+            )
+            return None
+
+        usage = {}
+        for line in cmd_out.stdout.decode("utf-8").splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[0].startswith("0/") and fields[1].isdigit():
+                usage[fields[0].removeprefix("0/")] = (int(fields[1]), int(fields[2]))
+        return usage
+
+    def get_btrfs_usage(self, layers):
+        """Gets the space used by btrfs layers from qgroups, returns None if quotas are not enabled"""
+        usage = self.get_qgroup_usage()
+        if usage is None:
+            return None
+
+        subvolumes = self.get_subvolume_ids()
+        layer_usage = {}
+        for layer, path in layers.items():
+            # Subvolume paths are relative to the filesystem root, match them on the trailing components
+            suffix = path.relative_to(self.build_dir.parent)
+            subvolume_id = next(
+                (
+                    subvolume_id
+                    for subvolume, subvolume_id in subvolumes.items()
+                    if Path(subvolume).parts[-len(suffix.parts) :] == suffix.parts
+                ),
+                None,
+            )
+            if subvolume_id in usage:
+                referenced, exclusive = usage[subvolume_id]
+                layer_usage[layer] = {"exclusive": exclusive, "shared": referenced - exclusive}
+        return layer_usage
+
+    def get_walked_usage(self, layers):
+        """Gets the space used by layers by walking them in parallel, inodes in more than one layer are shared"""
+        scans = scan_trees([str(path) for path in layers.values()], workers=self.workers)
+        inode_counts = {}
+        for inodes in scans.values():
+            for inode in inodes:
+                inode_counts[inode] = inode_counts.get(inode, 0) + 1
+
+        layer_usage = {}
+        for layer, path in layers.items():
+            inodes = scans[str(path)]
+            shared = sum(size for inode, size in inodes.items() if inode_counts[inode] > 1)
+            layer_usage[layer] = {"exclusive": sum(inodes.values()) - shared, "shared": shared}
+        return layer_usage
+
+    @traced("layer_usage")
+    def get_usage(self):
+        """Gets the space used by each layer, and whether it is referenced.
+        Returns {(kind, name): {"path", "exclusive", "shared", "orphan", "mtime"}}."""
+        layers = self.find_layers()
+        orphans = self.find_orphans(layers)
+
+        layer_usage = None
+        if self.directory_backing == "btrfs":
+            layer_usage = self.get_btrfs_usage(layers)
+        if layer_usage is None:
+            layer_usage = self.get_walked_usage(layers)
+
+        usage = {}
+        for layer, path in sorted(layers.items()):
+            usage[layer] = {
+                "path": path,
+                "exclusive": layer_usage.get(layer, {}).get("exclusive"),
+                "shared": layer_usage.get(layer, {}).get("shared"),
+                "orphan": layer in orphans,
+                "mtime": path.stat().st_mtime,
+            }
+        return usage
+
+    def delete_layer(self, kind, name, path):
+        """Deletes a layer directory, btrfs subvolumes are deleted with btrfs"""
+        self.logger.warning("Deleting unreferenced %s: %s" % (kind, path))
+        if self.directory_backing == "btrfs" and kind in ["layer", "snapshot"]:
+            cmd_out = traced_run(["btrfs", "subvolume", "delete", str(path)], container=name, capture_output=True)
+            if cmd_out.returncode != 0:
+                raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+        else:
+            rmtree(path)
+
+    @traced("layer_gc")
+    def collect(self, force=False, dry_run=False):
+        """Deletes unreferenced layers older than keep_days, or all unreferenced layers if force is set.
+        Returns {"deleted": [(kind, name)], "kept": [(kind, name)]}."""
+        orphans = self.find_orphans()
+        cutoff = time() - self.keep_days * 86400
+        report = {"deleted": [], "kept": []}
+        # Snapshots are deleted before layers, overlay upper dirs after the layer mountpoints
+        for (kind, name), path in sorted(orphans.items(), key=lambda item: GC_ORDER.index(item[0][0])):
+            if ismount(path):
+                self.logger.warning("Keeping mounted unreferenced %s: %s" % (kind, name))
+                report["kept"].append((kind, name))
+                continue
+            if not force and path.stat().st_mtime > cutoff:
+                self.logger.info("Keeping unreferenced %s within retention period: %s" % (kind, name))
+                report["kept"].append((kind, name))
+                continue
+            if not dry_run:
+                self.delete_layer(kind, name, path)
+            report["deleted"].append((kind, name))
+        return report
@@ -6,10 +6,15 @@ __author__ = 'desultory'
 __version__ = '0.0.3'
 
 
-from gentainer.zen_custom import loggify
+from zenlib.logging import loggify
 
+from gentainer.tracing import traced_run, tracer
+from gentainer.treecopy import TreeCopier
+
+from contextlib import contextmanager, nullcontext
+from os.path import ismount
 from pathlib import Path
-from subprocess import run
+from shutil import rmtree
 
 
 @loggify
@@ -20,7 +25,8 @@ class Layers:
 
     parameters = {'base_image': str}  # The base image to use for the layer
 
-    def __init__(self, container, build_dir, directory_backing, base_image=None, force=False, *args, **kwargs):
+    def __init__(self, container, build_dir, directory_backing, base_image=None, force=False, copy_workers=None,
+                 overlay_max_depth=16, *args, **kwargs):
         """
         Initialize a Gentainer object
         """
@@ -29,8 +35,15 @@ class Layers:
         self.directory_backing = directory_backing
         self.base_image = base_image
         self.force = force
+        self.copy_workers = copy_workers  # Threads used to copy base layers with the dir backing
+        self.copy_report = None
+        self.overlay_max_depth = overlay_max_depth  # Base layer chains deeper than this are flattened
 
         self.layer_dir = self.build_dir / self.container
+        self.overlay_dir = self.build_dir.resolve() / '.overlay' / self.container  # Holds the upper, work and base dirs
+        self.upper_dir = self.overlay_dir / 'upper'
+        self.work_dir = self.overlay_dir / 'work'
+        self.lower_file = self.overlay_dir / 'lowerdirs'  # Lower dirs of this layer, nearest first
 
     def prepare(self):
         """
@@ -48,10 +61,13 @@ class Layers:
                 raise RuntimeError("Layer already exists for container: %s" % self.container)
 
         try:
-            getattr(self, 'prepare_%s' % self.directory_backing)()
+            prepare_function = getattr(self, 'prepare_%s' % self.directory_backing)
         except AttributeError:
             raise NotImplementedError("Directory backing '%s' not implemented" % self.directory_backing)
 
+        with tracer.span('layer_prepare', container=self.container, backing=self.directory_backing):
+            prepare_function()
+
     def prepare_btrfs(self):
         """
         Prepares the image layer for the specified container using btrfs
@@ -63,10 +79,123 @@ class Layers:
             self.logger.info("Creating btrfs subvolume for container: %s" % self.container)
             args = ['btrfs', 'subvolume', 'create', str(self.layer_dir)]
 
-        cmd_out = run(args, capture_output=True)
+        cmd_out = traced_run(args, container=self.container, capture_output=True)
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode('utf-8'))
+
+    def prepare_dir(self):
+        """
+        Prepares the image layer for the specified container as a plain directory.
+        The base layer is copied, using reflinks where the filesystem supports them.
+        """
+        if self.base_image:
+            self.logger.info("Copying base layer '%s' for container: %s" % (self.base_image, self.container))
+            copier = TreeCopier(self.build_dir / self.base_image, self.layer_dir, workers=self.copy_workers, logger=self.logger)
+            self.copy_report = copier.copy()
+        else:
+            self.logger.info("Creating layer directory for container: %s" % self.container)
+            self.layer_dir.mkdir(mode=0o755)
+
+    def get_lower_dirs(self):
+        """
+        Gets the overlay lower dirs of this layer, nearest first
+        """
+        if not self.lower_file.exists():
+            raise FileNotFoundError("Overlay layer does not exist for container: %s" % self.container)
+        return self.lower_file.read_text().splitlines()
+
+    def get_layer_dirs(self):
+        """
+        Gets the overlay dirs which make up this layer, its upper dir followed by its lower dirs
+        """
+        return [str(self.upper_dir), *self.get_lower_dirs()]
+
+    def mount_overlay(self, lower_dirs, mountpoint, upper_dir=None, work_dir=None):
+        """
+        Mounts an overlay, read only if no upper dir is set
+        """
+        options = 'lowerdir=%s' % ':'.join(lower_dirs)
+        if upper_dir:
+            options += ',upperdir=%s,workdir=%s' % (upper_dir, work_dir)
+        self.logger.debug("[%s] Mounting overlay at '%s': %s" % (self.container, mountpoint, options))
+        cmd_out = traced_run(['mount', '-t', 'overlay', 'overlay', '-o', options, str(mountpoint)],
+                             container=self.container, capture_output=True)
+        if cmd_out.returncode != 0:
+            raise RuntimeError(cmd_out.stderr.decode('utf-8'))
+
+    def umount(self, mountpoint):
+        """
+        Unmounts a mountpoint
+        """
+        self.logger.debug("[%s] Unmounting: %s" % (self.container, mountpoint))
+        cmd_out = traced_run(['umount', str(mountpoint)], container=self.container, capture_output=True)
         if cmd_out.returncode != 0:
             raise RuntimeError(cmd_out.stderr.decode('utf-8'))
 
+    def mounted(self):
+        """
+        Returns a context manager which keeps the layer mounted at the layer dir.
+        Only overlay layers need to be mounted.
+        """
+        if self.directory_backing != 'overlay':
+            return nullcontext(self.layer_dir)
+        return self.mount_layer()
+
+    @contextmanager
+    def mount_layer(self):
+        """
+        Mounts the overlay layer at the layer dir for the duration of the context
+        """
+        self.mount_overlay(self.get_lower_dirs(), self.layer_dir, self.upper_dir, self.work_dir)
+        try:
+            yield self.layer_dir
+        finally:
+            self.umount(self.layer_dir)
+
+    def flatten_base(self, base_layer, flat_dir):
+        """
+        Copies the merged contents of the base layer chain into a single lower dir
+        """
+        mountpoint = self.overlay_dir / 'flatten'
+        mountpoint.mkdir()
+        self.mount_overlay(base_layer.get_layer_dirs(), mountpoint)
+        try:
+            copier = TreeCopier(mountpoint, flat_dir, workers=self.copy_workers, logger=self.logger)
+            self.copy_report = copier.copy()
+        finally:
+            self.umount(mountpoint)
+            mountpoint.rmdir()
+
+    def prepare_overlay(self):
+        """
+        Prepares the image layer for the specified container as an overlay upper dir.
+        The lower dirs are the base image chain, so no data is copied.
+        Chains deeper than overlay_max_depth are flattened into a single lower dir.
+        """
+        if self.overlay_dir.exists():
+            self.logger.warning("Removing stale overlay dirs for container: %s" % self.container)
+            rmtree(self.overlay_dir)
+        self.overlay_dir.mkdir(parents=True)
+
+        if self.base_image:
+            base_layer = Layers(self.base_image, self.build_dir, self.directory_backing,
+                                copy_workers=self.copy_workers, logger=self.logger)
+            lower_dirs = base_layer.get_layer_dirs()
+            if len(lower_dirs) > self.overlay_max_depth:
+                self.logger.info("Flattening %d layer base image chain for container: %s" % (len(lower_dirs), self.container))
+                self.flatten_base(base_layer, self.overlay_dir / 'base')
+                lower_dirs = [str(self.overlay_dir / 'base')]
+            self.logger.info("Stacking overlay on %d lower dirs for container: %s" % (len(lower_dirs), self.container))
+        else:
+            self.logger.info("Creating overlay layer for container: %s" % self.container)
+            (self.overlay_dir / 'base').mkdir(mode=0o755)  # Overlays need at least one lower dir
+            lower_dirs = [str(self.overlay_dir / 'base')]
+
+        self.upper_dir.mkdir()
+        self.work_dir.mkdir()
+        self.lower_file.write_text('\n'.join(lower_dirs) + '\n')
+        self.layer_dir.mkdir()
+
     def clean(self):
         """
         Cleans the image layer for the specified container.
@@ -87,7 +216,24 @@ class Layers:
         self.logger.warning("Deleting btrfs subvolume for container: %s" % self.container)
         args = ['btrfs', 'subvolume', 'delete', str(self.layer_dir)]
 
-        cmd_out = run(args, capture_output=True)
+        cmd_out = traced_run(args, container=self.container, capture_output=True)
         if cmd_out.returncode != 0:
             raise RuntimeError(cmd_out.stderr.decode('utf-8'))
 
+    def clean_dir(self):
+        """
+        Cleans the image layer for the specified container using the dir backing
+        """
+        self.logger.warning("Deleting layer directory for container: %s" % self.container)
+        rmtree(self.layer_dir)
+
+    def clean_overlay(self):
+        """
+        Cleans the image layer for the specified container using the overlay backing
+        """
+        if ismount(self.layer_dir):
+            self.umount(self.layer_dir)
+        self.logger.warning("Deleting overlay dirs for container: %s" % self.container)
+        if self.overlay_dir.exists():
+            rmtree(self.overlay_dir)
+        self.layer_dir.rmdir()
@@ -1,14 +1,25 @@
 #! /usr/bin/env python3
 
+from pathlib import Path
+
 from zenlib.util import get_kwargs
 
 from gentainer import Gentainer
+from gentainer.daemon import DEFAULT_SOCKET, GentainerDaemon, send_request
+from gentainer.tracing import tracer
+
+# Actions which don't need a container name, or where it is optional
+SINGLE_ARG_ACTIONS = [
+    "list", "prepare_all", "build_all", "run_all", "du", "gc", "optimize", "history", "stats", "plan", "watch"
+]
+# Actions which control a running daemon
+DAEMON_ACTIONS = ["reload", "shutdown"]
 
 
 def process_args(kwargs, gentainer):
     """Process the arguments and call the appropriate method."""
     action = kwargs["action"].lower()
-    if action in ["list"]:
+    if action in SINGLE_ARG_ACTIONS:
         process_single_arg_action(kwargs, gentainer)
     else:
         process_multi_arg_action(kwargs, gentainer)
@@ -20,6 +31,26 @@ def process_single_arg_action(kwargs, gentainer):
     match action:
         case "list":
             gentainer.list()
+        case "prepare_all":
+            gentainer.prepare_all()
+        case "build_all":
+            gentainer.build_all()
+        case "run_all":
+            gentainer.run_all()
+        case "du":
+            gentainer.du()
+        case "gc":
+            gentainer.gc(kwargs.get("dry_run", False))
+        case "optimize":
+            gentainer.optimize(kwargs.get("file"))
+        case "history":
+            gentainer.history(kwargs.get("container_name"))
+        case "stats":
+            gentainer.stats()
+        case "plan":
+            gentainer.plan(kwargs.get("container_name"))
+        case "watch":
+            gentainer.watch()
 
 
 def process_multi_arg_action(kwargs, gentainer):
@@ -37,6 +68,44 @@ def process_multi_arg_action(kwargs, gentainer):
             gentainer.net_prepare(container_name)
         case "net_clean":
             gentainer.net_clean(container_name)
+        case "net_reconcile":
+            gentainer.net_reconcile(container_name)
+        case "export":
+            gentainer.export_layer(container_name, kwargs.get("file"))
+        case "import":
+            gentainer.import_layer(container_name, kwargs.get("file"))
+
+
+def process_daemon_request(kwargs):
+    """Sends the action to the daemon if one is listening.
+    Returns False if there is no daemon, the socket can't be opened by this user,
+    or the daemon serves another config, so the action is run in this process."""
+    request = {
+        "action": kwargs["action"].lower(),
+        "container_name": kwargs.get("container_name"),
+        "file": str(Path(kwargs["file"]).resolve()) if kwargs.get("file") else None,
+        "force": kwargs.get("force", False),
+        "dry_run": kwargs.get("dry_run", False),
+        "config": str(Path(kwargs.get("config", "config.toml")).resolve()),
+    }
+    try:
+        response = send_request(kwargs.get("socket", DEFAULT_SOCKET), request)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if request["action"] in DAEMON_ACTIONS:
+            raise RuntimeError("No daemon is listening on: %s" % kwargs.get("socket", DEFAULT_SOCKET))
+        return False
+    except PermissionError:  # The socket is only accessible to the user running the daemon
+        if request["action"] in DAEMON_ACTIONS:
+            raise RuntimeError("Permission denied on daemon socket: %s" % kwargs.get("socket", DEFAULT_SOCKET))
+        return False
+
+    if response["status"] != "ok":
+        if response["type"] == "ConfigMismatchError" and request["action"] not in DAEMON_ACTIONS:
+            return False
+        raise RuntimeError("[%s] %s" % (response["type"], response["error"]))
+    if response["output"]:
+        print(response["output"])
+    return True
 
 
 def main():
@@ -46,16 +115,74 @@ def main():
             "flags": ["action"],
             "action": "store",
             "help": "Action to perform",
-            "choices": ["list", "prepare", "build", "run", "net_prepare", "net_clean"],
+            "choices": [
+                "list",
+                "prepare",
+                "prepare_all",
+                "build",
+                "build_all",
+                "run",
+                "run_all",
+                "net_prepare",
+                "net_clean",
+                "net_reconcile",
+                "export",
+                "import",
+                "du",
+                "gc",
+                "optimize",
+                "history",
+                "stats",
+                "plan",
+                "watch",
+                "daemon",
+                "reload",
+                "shutdown",
+            ],
         },
         {"flags": ["container_name"], "action": "store", "help": "Name of the container to run", "nargs": "?"},
         {"flags": ["--force"], "action": "store_true", "help": "Force action"},
+        {"flags": ["--dry-run"], "action": "store_true", "help": "List the layers gc would delete, without deleting them"},
+        {"flags": ["-f", "--file"], "action": "store", "help": "File to export a layer to or import a layer from, or the directory optimize writes configs to"},
+        {"flags": ["--trace"], "action": "store", "help": "Record timed spans, write them as Chrome trace JSON to this file"},
+        {"flags": ["-j", "--jobs"], "action": "store", "type": int, "help": "Number of layers to build in parallel"},
+        {"flags": ["--socket"], "action": "store", "help": "Daemon socket, defaults to %s" % DEFAULT_SOCKET},
+        {"flags": ["--no-daemon"], "action": "store_true", "help": "Run the action in this process, even if a daemon is running"},
+        {"flags": ["--daemon-workers"], "action": "store", "type": int, "help": "Requests the daemon runs concurrently"},
     ]
     kwargs = get_kwargs(
         package=__package__, description="Gentoo Container Maker", arguments=arguments, drop_default=True
     )
-    gentainer = Gentainer(**kwargs)
-    process_args(kwargs, gentainer)
+    # Actions are sent to a running daemon, unless they are traced, which needs to happen in this process
+    if kwargs["action"] not in ["daemon", "watch"] and not kwargs.get("no_daemon") and not kwargs.get("trace"):
+        if process_daemon_request(kwargs):
+            return
+    action = kwargs["action"]
+    if action in DAEMON_ACTIONS:
+        raise ValueError("Action needs a running daemon, and can't be used with --no-daemon or --trace: %s" % action)
+
+    if kwargs.get("trace"):
+        tracer.enable()
+
+    gentainer = None
+    try:
+        gentainer = Gentainer(**kwargs)
+        if kwargs["action"] == "daemon":
+            daemon = GentainerDaemon(
+                gentainer,
+                socket_path=kwargs.get("socket", DEFAULT_SOCKET),
+                workers=kwargs.get("daemon_workers", 8),
+                logger=gentainer.logger,
+            )
+            daemon.serve()
+        else:
+            process_args(kwargs, gentainer)
+    finally:
+        if gentainer is not None:
+            gentainer.close()
+        if kwargs.get("trace"):
+            tracer.export_chrome(kwargs["trace"])
+            print(tracer.format_summary())
 
 
 if __name__ == "__main__":
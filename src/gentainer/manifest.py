@@ -0,0 +1,81 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from hashlib import sha256
+from json import dump, dumps, load
+from os import replace
+from pathlib import Path
+from threading import Lock
+
+from zenlib.logging import loggify
+
+
+def hash_paths(paths):
+    """Hashes the contents of files, directories are hashed recursively.
+    Missing paths are included in the hash as missing."""
+    digest = sha256()
+    for path in paths:
+        path = Path(path)
+        files = sorted(f for f in path.rglob("*") if f.is_file()) if path.is_dir() else [path]
+        for file in files:
+            digest.update(str(file).encode())
+            try:
+                digest.update(file.read_bytes())
+            except FileNotFoundError:
+                digest.update(b"\0missing")
+    return digest.hexdigest()
+
+
+def get_layer_digest(packages, parent_digest=None, portage_digest=None):
+    """Returns the digest for a layer built with the specified packages on the specified parent layer"""
+    layer_data = {"packages": sorted(packages), "parent": parent_digest, "portage": portage_digest}
+    return sha256(dumps(layer_data, sort_keys=True).encode()).hexdigest()
+
+
+@loggify
+class LayerManifest:
+    """Tracks the digest each layer was built with, so unchanged layers can be skipped"""
+
+    def __init__(self, manifest_file, *args, **kwargs):
+        self.manifest_file = Path(manifest_file)
+        self.lock = Lock()
+        self.layers = {}
+        self.load()
+
+    def load(self):
+        """Loads the manifest file, if it exists"""
+        if not self.manifest_file.exists():
+            self.logger.debug("Layer manifest does not exist: %s" % self.manifest_file)
+            return
+
+        with open(self.manifest_file, "r") as manifest_file:
+            self.layers = load(manifest_file)
+        self.logger.debug("Loaded layer manifest: %s" % self.layers)
+
+    def save(self):
+        """Writes the manifest to a temporary file, then replaces the manifest file"""
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.manifest_file.with_name(self.manifest_file.name + ".tmp")
+        with open(temp_file, "w") as manifest_file:
+            dump(self.layers, manifest_file, indent=2, sort_keys=True)
+        replace(temp_file, self.manifest_file)
+
+    def __contains__(self, container):
+        return container in self.layers
+
+    def get(self, container):
+        """Gets the digest a layer was built with"""
+        return self.layers.get(container)
+
+    def set(self, container, digest):
+        """Records the digest a layer was built with"""
+        with self.lock:
+            self.layers[container] = digest
+            self.save()
+
+    def remove(self, container):
+        """Removes a layer from the manifest"""
+        with self.lock:
+            if self.layers.pop(container, None) is not None:
+                self.save()
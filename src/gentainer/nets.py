@@ -1,33 +1,152 @@
 __author__ = "desultory"
 __version__ = "0.1.0"
 
+from socket import AF_INET
+from threading import RLock
 from tomllib import load
 
-from pyroute2 import IPRoute
 from zenlib.logging import loggify
 from zenlib.util import handle_plural, pretty_print
 
+from gentainer.tracing import traced
+
+# Network parameters which can be set in container configs, and the lxc.net.<index> keys they are written as
+NETWORK_PARAMETERS = {
+    "name": "name",
+    "hwaddr": "hwaddr",
+    "mtu": "mtu",
+    "ipv4": "ipv4.address",
+    "ipv4_gateway": "ipv4.gateway",
+    "ipv6": "ipv6.address",
+    "ipv6_gateway": "ipv6.gateway",
+    "veth_pair": "veth.pair",
+    "veth_mode": "veth.mode",
+    "macvlan_mode": "macvlan.mode",
+    "ipvlan_mode": "ipvlan.mode",
+    "vlan_id": "vlan.id",
+    "script_up": "script.up",
+    "script_down": "script.down",
+}
+
+
+def get_link_name(link):
+    """Gets the interface name from a netlink link message"""
+    for attr in link["attrs"]:
+        if attr[0] == "IFLA_IFNAME":
+            return attr[1]
 
-def get_interface_names():
-    """Get a list of network interface names"""
-    ip_route = IPRoute()
-    links = ip_route.get_links()
-    interface_names = []
 
-    for link in links:
-        for attr in link["attrs"]:
-            if attr[0] == "IFLA_IFNAME":
-                interface_names.append(attr[1])
+@loggify
+class NetlinkSession:
+    """
+    A single netlink session shared by all network operations.
+    Keeps a table of interface names to indexes, which is updated by writes made through this session.
+    """
+
+    def __init__(self, backend=None, *args, **kwargs):
+        self.backend = backend  # IPRoute compatible class, defaults to pyroute2.IPRoute
+        self.ip_route = None
+        self.links = None  # {interface_name: index}, None when it must be read again
+        self.lock = RLock()  # IPRoute sockets are not thread safe
+
+    def get_ip_route(self):
+        """Gets the netlink socket, opening it on first use"""
+        if self.ip_route is None:
+            if self.backend is None:
+                from pyroute2 import IPRoute  # Imported when needed, pyroute2 is slow to import
+
+                self.backend = IPRoute
+            self.ip_route = self.backend()
+        return self.ip_route
+
+    def close(self):
+        """Closes the netlink socket, it is opened again if the session is used after closing"""
+        with self.lock:
+            if self.ip_route is not None:
+                self.ip_route.close()
+                self.ip_route = None
+            self.links = None
+
+    def invalidate(self):
+        """Drops the link table, so it is read again on next use"""
+        with self.lock:
+            self.links = None
+
+    @traced("link_dump", category="netlink")
+    def get_links(self):
+        """Gets the link table, reading all links if it isn't loaded"""
+        with self.lock:
+            if self.links is None:
+                self.links = {get_link_name(link): link["index"] for link in self.get_ip_route().get_links()}
+                self.logger.log(5, "Read %d links" % len(self.links))
+            return self.links
+
+    def get_interface_names(self):
+        """Get a list of network interface names"""
+        return list(self.get_links())
+
+    def link_lookup(self, interface):
+        """Gets the index of an interface, or None if it does not exist"""
+        return self.get_links().get(interface)
+
+    def get_link(self, interface):
+        """Gets the link info for an interface"""
+        with self.lock:
+            return self.get_ip_route().get_links(self.link_lookup(interface))[0]
+
+    @traced("link_add", category="netlink")
+    def add_link(self, interface, kind):
+        """Creates an interface, returns the index of the new interface"""
+        with self.lock:
+            ip_route = self.get_ip_route()
+            ip_route.link("add", ifname=interface, kind=kind)
+            index = ip_route.link("get", ifname=interface)[0]["index"]
+            if self.links is not None:
+                self.links[interface] = index
+            return index
+
+    @traced("link_del", category="netlink")
+    def del_link(self, interface):
+        """Deletes an interface"""
+        with self.lock:
+            self.get_ip_route().link("del", index=self.link_lookup(interface))
+            if self.links is not None:
+                self.links.pop(interface, None)
+
+    def get_link_kind(self, interface):
+        """Gets the kind of an interface, such as 'bridge', None for physical interfaces"""
+        link_info = self.get_link(interface).get_attr("IFLA_LINKINFO")
+        return link_info.get_attr("IFLA_INFO_KIND") if link_info else None
+
+    @traced("addr_dump", category="netlink")
+    def get_addresses(self, interface):
+        """Gets the IPv4 addresses of an interface as a set of (address, mask)"""
+        with self.lock:
+            addresses = self.get_ip_route().get_addr(family=AF_INET, index=self.link_lookup(interface))
+        return {(address.get_attr("IFA_ADDRESS"), address["prefixlen"]) for address in addresses}
+
+    @traced("addr", category="netlink")
+    def addr(self, command, interface, **kwargs):
+        """Runs an address command against an interface"""
+        with self.lock:
+            return self.get_ip_route().addr(command, index=self.link_lookup(interface), **kwargs)
+
+
+netlink_session = NetlinkSession()  # Shared by all HostNet and ContainerNet instances by default
+
 
-    return interface_names
+def get_interface_names():
+    """Get a list of network interface names"""
+    return netlink_session.get_interface_names()
 
 
 @loggify
 class ContainerNet:
     parameters = {"networks": dict}  # A dict containing network configuration, where the key name is the interface name
 
-    def __init__(self, net_config, force=False, *args, **kwargs):
+    def __init__(self, net_config, force=False, netlink=None, *args, **kwargs):
         self.force = force
+        self.netlink = netlink or netlink_session
         self.load_config(net_config)
 
     def load_config(self, net_config: dict):
@@ -36,31 +155,56 @@ class ContainerNet:
         self.networks = self.config["networks"]
 
     def validate_networks(self, networks):
-        """Validates supplied network information against host interfaces"""
-        interface_names = get_interface_names()
+        """Validates the structure of supplied network information.
+        Host interfaces are checked with check_interfaces when they are needed, so loading configs does not use netlink."""
+        for network, network_config in networks.items():
+            if not isinstance(network_config, dict):
+                raise TypeError("[%s] Invalid network configuration for %s: %s" % (self.name, network, network_config))
+            bad_params = [param for param in network_config if param not in ["type", "flags", *NETWORK_PARAMETERS]]
+            if bad_params:
+                raise ValueError("[%s] Unknown parameters for network %s: %s" % (self.name, network, bad_params))
+
+    def check_interfaces(self):
+        """Checks that all networks exist as host interfaces"""
+        interface_names = self.netlink.get_links()
         self.logger.log(5, "Detected interfaces: %s" % interface_names)
 
-        for network in networks:
+        for network in self.networks:
             if network not in interface_names:
                 self.logger.warning("[%s] Network interface does not exist: %s" % (self.name, network))
                 return False
         return True
 
     def to_config(self):
-        """Print a list containing a representation of the network configuration as LXC config directives"""
-        if not self.validate_networks(self.networks):
+        """Returns a list containing a representation of the network configuration as LXC config directives.
+        Each network is linked to the host interface it is named after, defaulting to a veth.
+        Other network parameters are added as the lxc.net.<index> key in NETWORK_PARAMETERS,
+        parameters with a list of values, such as multiple addresses, are added once for each value."""
+        if not self.check_interfaces():
             raise ValueError("Invalid network configuration")
 
+        directives = []
+        for index, (network, network_config) in enumerate(self.networks.items()):
+            prefix = "lxc.net.%d" % index
+            directives.append("%s.type = %s" % (prefix, network_config.get("type", "veth")))
+            directives.append("%s.link = %s" % (prefix, network))
+            directives.append("%s.flags = %s" % (prefix, network_config.get("flags", "up")))
+            for parameter, value in network_config.items():
+                if parameter not in ["type", "flags"]:
+                    for item in value if isinstance(value, list) else [value]:
+                        directives.append("%s.%s = %s" % (prefix, NETWORK_PARAMETERS[parameter], item))
+        return directives
+
 
 @loggify
 class HostNet:
     interface_parameters = ["type", "address", "mask"]
     prepare_host = ["prepare"]
 
-
-    def __init__(self, config_file, force=False, *args, **kwargs):
+    def __init__(self, config_file, force=False, netlink=None, *args, **kwargs):
         self.config_file = config_file
         self.force = force
+        self.netlink = netlink or netlink_session
         self.load_config()
 
     def __str__(self):
@@ -105,6 +249,71 @@ class HostNet:
         self.logger.debug("Network configuration: %s" % self.config)
         self.configure_interface(self.config.keys())
 
+    def reconcile(self):
+        """Reconciles all network interfaces, returns the applied changes"""
+        return self.reconcile_interfaces(self.config.keys())
+
+    def get_interface_changes(self, interface):
+        """
+        Compares the configuration of an interface with the kernel state.
+        Returns a list of changes, as tuples of (action, interface, *args).
+        """
+        interface_config = self.config[interface]
+        desired_addresses = set()
+        if "address" in interface_config and "mask" in interface_config:
+            desired_addresses.add((interface_config["address"], interface_config["mask"]))
+
+        if interface not in self.netlink.get_links():
+            changes = [("create", interface, interface_config["type"])]
+            return changes + [("add_address", interface, *address) for address in desired_addresses]
+
+        kind = self.netlink.get_link_kind(interface)
+        if kind != interface_config["type"]:
+            if not self.force:
+                raise ValueError(
+                    "[%s] Interface type is '%s' but should be '%s', use --force to recreate it"
+                    % (interface, kind, interface_config["type"])
+                )
+            changes = [("delete", interface), ("create", interface, interface_config["type"])]
+            return changes + [("add_address", interface, *address) for address in desired_addresses]
+
+        current_addresses = self.netlink.get_addresses(interface)
+        changes = [("del_address", interface, *address) for address in current_addresses - desired_addresses]
+        return changes + [("add_address", interface, *address) for address in desired_addresses - current_addresses]
+
+    def apply_interface_change(self, action, interface, *args):
+        """Applies a change from get_interface_changes"""
+        self.logger.info("[%s] Applying network change: %s %s" % (interface, action, args))
+        match action:
+            case "create":
+                self.netlink.add_link(interface, args[0])
+            case "delete":
+                self.netlink.del_link(interface)
+            case "add_address":
+                self.netlink.addr("add", interface, address=args[0], mask=args[1])
+            case "del_address":
+                self.netlink.addr("del", interface, address=args[0], mask=args[1])
+            case _:
+                raise ValueError("Unknown network change: %s" % action)
+
+    @traced("reconcile_interfaces")
+    def reconcile_interfaces(self, interfaces):
+        """
+        Reconciles network interfaces with the network config, applying only the changes needed.
+        All interfaces are compared before any changes are made, then changes are applied in one netlink session.
+        Interfaces are only deleted and recreated if the interface type changed and force is set.
+        """
+        with self.netlink.lock:
+            changes = [change for interface in interfaces for change in self.get_interface_changes(interface)]
+            if not changes:
+                self.logger.info("Network interfaces are up to date: %s" % ", ".join(interfaces))
+                return []
+
+            self.logger.debug("Network changes:\n%s" % pretty_print(changes))
+            for change in changes:
+                self.apply_interface_change(*change)
+        return changes
+
     def clean(self):
         """Cleans all managed network interfaces"""
         self.logger.info("Cleaning network interfaces:\n%s" % pretty_print(self.config.keys()))
@@ -113,18 +322,18 @@ class HostNet:
     @handle_plural
     def clean_interface(self, interface):
         """ Cleans (deletes) a network interface """
-        if interface in get_interface_names():
+        if interface in self.netlink.get_links():
             self.logger.info("Cleaning interface: %s" % interface)
-            with IPRoute() as ip_route:
-                ip_route.link("del", ifname=interface)
+            self.netlink.del_link(interface)
         else:
             self.logger.warning("Cannot clean interface, does not exist: %s" % interface)
 
     @handle_plural
+    @traced("configure_interface")
     def configure_interface(self, interface):
         """ Configures a network interface"""
         self.logger.info("Configuring network interface: %s" % interface)
-        if interface in get_interface_names():
+        if interface in self.netlink.get_links():
             self.logger.warning("Interface already exists: %s" % interface)
             if self.force:
                 self.logger.info("Forcing interface configuration")
@@ -136,16 +345,12 @@ class HostNet:
         interface_config = self.config[interface]
         self.logger.debug("Interface configuration: \n%s" % pretty_print(interface_config))
 
-        with IPRoute() as ip_route:
-            ip_route.link("add", ifname=interface, kind=interface_config["type"])
-            device_index = ip_route.link_lookup(ifname=interface)[0]
-            self.logger.debug("[%s] Created interface with index: %s" % (interface, device_index))
+        device_index = self.netlink.add_link(interface, interface_config["type"])
+        self.logger.debug("[%s] Created interface with index: %s" % (interface, device_index))
 
-            if "address" in interface_config and "mask" in interface_config:
-                ip_route.addr(
-                    "add", index=device_index, address=interface_config["address"], mask=interface_config["mask"]
-                )
+        if "address" in interface_config and "mask" in interface_config:
+            self.netlink.addr("add", interface, address=interface_config["address"], mask=interface_config["mask"])
 
-            interface_info = ip_route.get_links(device_index)[0]
-            self.logger.info("Interface configured: %s" % interface)
-            self.logger.log(5, "[%s] Interface info: %s" % (interface, pretty_print(interface_info)))
+        interface_info = self.netlink.get_link(interface)
+        self.logger.info("Interface configured: %s" % interface)
+        self.logger.log(5, "[%s] Interface info: %s" % (interface, pretty_print(interface_info)))
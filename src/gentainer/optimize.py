@@ -0,0 +1,329 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from pathlib import Path
+from re import MULTILINE, compile
+from statistics import median
+
+from zenlib.logging import loggify
+
+from gentainer.layer_gc import format_size
+from gentainer.tracing import traced
+from gentainer.vdb import VDBIndex, get_cp
+
+# emerge.log lines, such as:
+# 1700000000:  >>> emerge (1 of 2) sys-libs/zlib-1.3 to /tmp/gentainer_build/gentoo_base/
+# 1700000090:  ::: completed emerge (1 of 2) sys-libs/zlib-1.3 to /tmp/gentainer_build/gentoo_base/
+EMERGE_LOG_START = compile(r"^(?P<time>\d+):  >>> emerge \(\d+ of \d+\) (?P<cpv>\S+) to (?P<root>\S+)")
+EMERGE_LOG_FINISH = compile(r"^(?P<time>\d+):  ::: completed emerge \(\d+ of \d+\) (?P<cpv>\S+) to (?P<root>\S+)")
+BASE_IMAGE_LINE = compile(r"^base_image\s*=.*$", MULTILINE)
+
+
+def read_emerge_durations(emerge_log):
+    """Reads the mean merge time in seconds of each category/package from an emerge.log"""
+    durations, starts = {}, {}
+    try:
+        with open(emerge_log, "r", errors="replace") as log_file:
+            for line in log_file:
+                if match := EMERGE_LOG_START.match(line):
+                    starts[(match["cpv"], match["root"])] = int(match["time"])
+                elif (match := EMERGE_LOG_FINISH.match(line)) and (match["cpv"], match["root"]) in starts:
+                    duration = int(match["time"]) - starts.pop((match["cpv"], match["root"]))
+                    durations.setdefault(get_cp(match["cpv"]), []).append(duration)
+    except FileNotFoundError:
+        return {}
+    return {cp: sum(times) / len(times) for cp, times in durations.items()}
+
+
+@loggify
+class LayerOptimizer:
+    """
+    Finds packages which are built in more than one sibling layer, and proposes intermediate base layers for them.
+
+    The dependency closure of every container is resolved in one portage pass, each package version is resolved once.
+    Only runtime dependencies (RDEPEND and PDEPEND) are followed, since build dependencies are installed on the build host.
+    The first available choice of any-of groups is used.
+
+    Layers with the same base image are factored greedily: the group of siblings sharing the most build cost
+    gets an intermediate layer with the packages they share, then the new layers are factored in the same way.
+    If a sibling only builds packages shared by the group, the others are rebased onto it instead.
+
+    Build cost is the merge time of each package read from the build history or emerge.log,
+    or the median time for packages in neither.
+    Installed sizes are read from the package db of built layers.
+    """
+
+    def __init__(
+        self,
+        containers,
+        emerge_log="/var/log/emerge.log",
+        durations=None,
+        min_shared=3,
+        layer_roots=None,
+        *args,
+        **kwargs,
+    ):
+        self.containers = containers  # {name: ContainerConfig}
+        self.min_shared = min_shared  # Shared packages needed to propose a layer
+        # {category/package: seconds}, from the emerge.log, then from the build history if set
+        self.durations = {**read_emerge_durations(emerge_log), **(durations or {})}
+        self.default_duration = median(self.durations.values()) if self.durations else None
+        self.sizes = self.read_sizes(layer_roots or [])
+        self.best_matches = {}  # {atom: cpv or None}
+        self.dependencies = {}  # {cpv: {cpv}}
+        self.new_layers = {}  # {name: [category/package]}
+        self.portdb = None
+        self.settings = None
+
+    def read_sizes(self, layer_roots):
+        """Reads the installed size of each package from the package db of built layers"""
+        sizes = {}
+        for layer_root in layer_roots:
+            for installed in VDBIndex(layer_root, logger=self.logger).packages.values():
+                sizes.update({package["cpv"]: package["size"] for package in installed if package["size"]})
+        return sizes
+
+    def load_portage(self):
+        """Loads the portage tree and config on first use"""
+        if self.portdb is None:
+            import portage
+
+            self.portdb = portage.db[portage.root]["porttree"].dbapi
+            self.settings = portage.config(clone=portage.settings)
+
+    def get_best_match(self, atom):
+        """Gets the best visible version for an atom, or None"""
+        if atom not in self.best_matches:
+            self.load_portage()
+            self.best_matches[atom] = self.portdb.xmatch("bestmatch-visible", atom) or None
+        return self.best_matches[atom]
+
+    def select_atoms(self, deps):
+        """Gets the atoms from a reduced dependency list, using the first available choice of any-of groups"""
+        atoms = []
+        for dep in deps:
+            if isinstance(dep, list) and dep[:1] == ["||"]:
+                for choice in dep[1:]:
+                    choice_atoms = self.select_atoms(choice if isinstance(choice, list) else [choice])
+                    if all(self.get_best_match(atom) for atom in choice_atoms):
+                        atoms.extend(choice_atoms)
+                        break
+            elif isinstance(dep, list):
+                atoms.extend(self.select_atoms(dep))
+            elif not dep.blocker:
+                atoms.append(str(dep.without_use))
+        return atoms
+
+    def get_dependencies(self, cpv):
+        """Gets the package versions a package version depends on at runtime"""
+        if cpv not in self.dependencies:
+            from portage.dep import Atom, use_reduce
+
+            self.load_portage()
+            self.settings.setcpv(cpv, mydb=self.portdb)
+            dep_string = " ".join(self.portdb.aux_get(cpv, ["RDEPEND", "PDEPEND"]))
+            deps = use_reduce(dep_string, uselist=self.settings["PORTAGE_USE"].split(), opconvert=True, token_class=Atom)
+            self.dependencies[cpv] = {match for atom in self.select_atoms(deps) if (match := self.get_best_match(atom))}
+        return self.dependencies[cpv]
+
+    def get_closure(self, atoms):
+        """Gets every package version installed by emerging atoms"""
+        closure, pending = set(), []
+        for atom in atoms:
+            if cpv := self.get_best_match(atom):
+                pending.append(cpv)
+            else:
+                self.logger.warning("No visible version for: %s" % atom)
+        while pending:
+            cpv = pending.pop()
+            if cpv not in closure:
+                closure.add(cpv)
+                pending.extend(self.get_dependencies(cpv))
+        return closure
+
+    @traced("resolve_closures")
+    def resolve_layers(self):
+        """Gets the package versions built in each layer, which are not already installed by its base image chain.
+        Returns ({container: base image or None}, {container: {cpv}})."""
+        bases = {name: config["base_image"] if "base_image" in config else None for name, config in self.containers.items()}
+        installed = {}
+
+        def get_installed(name):
+            if name not in installed:
+                base_installed = get_installed(bases[name]) if bases[name] else set()
+                installed[name] = base_installed | self.get_closure(self.containers[name].get("packages", []))
+            return installed[name]
+
+        layers = {}
+        for name, base in bases.items():
+            layers[name] = get_installed(name) - (get_installed(base) if base else set())
+        self.logger.info(
+            "Resolved %d package versions for %d layers" % (len(set().union(*layers.values())), len(layers))
+        )
+        return bases, layers
+
+    def get_cost(self, packages):
+        """Gets the estimated build seconds for packages, or the package count if no merge times are known"""
+        if self.default_duration is None:
+            return len(packages)
+        return sum(self.durations.get(get_cp(cpv), self.default_duration) for cpv in packages)
+
+    def get_size(self, packages):
+        """Gets the installed bytes of packages with a known size"""
+        return sum(self.sizes.get(cpv, 0) for cpv in packages)
+
+    def find_best_group(self, members, layers):
+        """Finds the group of sibling layers sharing the most build cost.
+        Returns (group, shared packages) or None."""
+        users = {}  # {cpv: layers which build it}
+        for member in members:
+            for cpv in layers[member]:
+                users.setdefault(cpv, set()).add(member)
+
+        best, best_savings = None, 0
+        for group in {frozenset(group) for group in users.values() if len(group) > 1}:
+            shared = {cpv for cpv, cpv_users in users.items() if group <= cpv_users}
+            savings = (len(group) - 1) * self.get_cost(shared)
+            if len(shared) >= self.min_shared and savings > best_savings:
+                best, best_savings = (group, shared), savings
+        return best
+
+    def get_layer_name(self, base):
+        """Gets an unused name for an intermediate layer"""
+        index = 1
+        while (name := "%s_shared_%d" % (base or "root", index)) in self.containers or name in self.new_layers:
+            index += 1
+        return name
+
+    def get_top_packages(self, packages):
+        """Gets the category/packages of packages which are not dependencies of other packages in the set"""
+        dependencies = set().union(*((self.dependencies.get(cpv, set()) & packages) - {cpv} for cpv in packages))
+        top = {cpv for cpv in packages if cpv not in dependencies}
+        covered = self.get_closure_within(top, packages)
+        # Packages in dependency cycles may not be reached from a top package
+        for cpv in sorted(packages - covered):
+            if cpv not in covered:
+                top.add(cpv)
+                covered |= self.get_closure_within([cpv], packages)
+        return sorted({get_cp(cpv) for cpv in top})
+
+    def get_closure_within(self, cpvs, packages):
+        """Gets the closure of package versions, limited to a set of packages"""
+        closure, pending = set(), list(cpvs)
+        while pending:
+            cpv = pending.pop()
+            if cpv not in closure:
+                closure.add(cpv)
+                pending.extend(self.dependencies.get(cpv, set()) & packages)
+        return closure
+
+    def factor(self, base, bases, layers, proposals):
+        """Factors the children of a base image, then the children of each resulting layer"""
+        while best := self.find_best_group([name for name, name_base in bases.items() if name_base == base], layers):
+            group, shared = best
+            rebase = next((member for member in sorted(group) if layers[member] == shared), None)
+            if rebase:
+                members = sorted(group - {rebase})
+                self.logger.info("[%s] Rebasing onto existing layer: %s" % (rebase, ", ".join(members)))
+                proposals.append({"name": rebase, "new": False, "members": members, "packages": shared})
+            else:
+                rebase = self.get_layer_name(base)
+                members = sorted(group)
+                self.new_layers[rebase] = self.get_top_packages(shared)
+                self.logger.info("[%s] Proposing shared layer for: %s" % (rebase, ", ".join(members)))
+                bases[rebase], layers[rebase] = base, set(shared)
+                proposals.append({"name": rebase, "new": True, "members": members, "packages": shared})
+
+            for member in members:
+                bases[member] = rebase
+                layers[member] = layers[member] - shared
+
+        for child in [name for name, name_base in bases.items() if name_base == base]:
+            self.factor(child, bases, layers, proposals)
+
+    @traced("optimize_layers")
+    def optimize(self):
+        """
+        Proposes intermediate base layers for packages shared by sibling layers.
+        Returns {"bases", "layers", "new_layers", "proposals", "before", "after"},
+        bases and layers are the proposed base images and built packages of each layer,
+        before and after are the total build cost and installed bytes.
+        """
+        original_bases, original_layers = self.resolve_layers()
+        bases, layers = dict(original_bases), {name: set(packages) for name, packages in original_layers.items()}
+        self.new_layers = {}
+        proposals = []
+        self.factor(None, bases, layers, proposals)
+
+        def get_totals(layer_packages):
+            return {
+                "cost": sum(self.get_cost(packages) for packages in layer_packages.values()),
+                "size": sum(self.get_size(packages) for packages in layer_packages.values()),
+                "packages": sum(len(packages) for packages in layer_packages.values()),
+            }
+
+        return {
+            "bases": bases,
+            "layers": layers,
+            "new_layers": self.new_layers,
+            "proposals": proposals,
+            "before": get_totals(original_layers),
+            "after": get_totals(layers),
+        }
+
+    def format_report(self, report):
+        """Formats the proposed layers and projected savings"""
+        unit = "s" if self.default_duration is not None else " packages"
+        lines = []
+        for proposal in report["proposals"]:
+            if proposal["new"]:
+                name = proposal["name"]
+                lines.append(
+                    "New layer %s (base image: %s) with %d packages: %s"
+                    % (name, report["bases"][name], len(proposal["packages"]), ", ".join(report["new_layers"][name]))
+                )
+            else:
+                lines.append("Existing layer %s with %d packages" % (proposal["name"], len(proposal["packages"])))
+            lines.append(
+                "  Base image for: %s, saves %.0f%s"
+                % (
+                    ", ".join(proposal["members"]),
+                    (len(proposal["members"]) - (1 if proposal["new"] else 0)) * self.get_cost(proposal["packages"]),
+                    unit,
+                )
+            )
+        if not report["proposals"]:
+            lines.append("No packages are shared by %d or more sibling layers" % self.min_shared)
+
+        before, after = report["before"], report["after"]
+        lines.append(
+            "Package builds: %d -> %d, build cost: %.0f%s -> %.0f%s"
+            % (before["packages"], after["packages"], before["cost"], unit, after["cost"], unit)
+        )
+        if before["size"]:
+            lines.append("Installed size: %s -> %s" % (format_size(before["size"]), format_size(after["size"])))
+        return "\n".join(lines)
+
+    def write_configs(self, report, output_dir):
+        """Writes configs for new layers, and copies of container configs with a changed base_image, to output_dir"""
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for name, packages in report["new_layers"].items():
+            lines = ['base_image = "%s"' % report["bases"][name]] if report["bases"][name] else []
+            lines.append("packages = [%s]" % ", ".join('"%s"' % package for package in packages))
+            (output_dir / ("%s.toml" % name)).write_text("\n".join(lines) + "\n")
+            self.logger.info("Wrote new layer config: %s" % (output_dir / ("%s.toml" % name)))
+
+        for name, config in self.containers.items():
+            base = report["bases"][name]
+            if base == (config["base_image"] if "base_image" in config else None):
+                continue
+            config_text = config.config_file.read_text()
+            base_line = 'base_image = "%s"' % base
+            if BASE_IMAGE_LINE.search(config_text):
+                config_text = BASE_IMAGE_LINE.sub(base_line, config_text, count=1)
+            else:
+                config_text = "%s\n%s" % (base_line, config_text)
+            (output_dir / config.config_file.name).write_text(config_text)
+            self.logger.info("Wrote rebased container config: %s" % (output_dir / config.config_file.name))
@@ -0,0 +1,104 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from json import dump, load
+from os import replace
+from pathlib import Path
+
+from zenlib.logging import loggify
+
+
+def is_plain_atom(atom):
+    """Checks if an atom is a plain category/package name, without versions, slots, repos or USE deps"""
+    return atom[:1] not in "<>=~!" and not any(char in atom for char in ":[*")
+
+
+@loggify
+class PackageIndex:
+    """Index of the package versions in the portage tree.
+    The index is saved to disk, and rebuilt when the repo timestamp changes."""
+
+    def __init__(self, index_file, timestamp_file, *args, **kwargs):
+        self.index_file = Path(index_file)
+        self.timestamp_file = Path(timestamp_file)
+        self.packages = {}  # {category/package: [category/package-version]}
+        if not self.load():
+            self.build()
+            self.save()
+
+    def get_timestamp(self):
+        """Gets the timestamp of the portage tree, from the contents and mtime of the timestamp file"""
+        try:
+            return "%s %d" % (self.timestamp_file.read_text().strip(), self.timestamp_file.stat().st_mtime_ns)
+        except FileNotFoundError:
+            self.logger.warning("Portage timestamp file does not exist: %s" % self.timestamp_file)
+            return None
+
+    def load(self):
+        """Loads the index file, if it exists and matches the current portage timestamp"""
+        if not self.index_file.exists():
+            self.logger.debug("Package index does not exist: %s" % self.index_file)
+            return False
+
+        timestamp = self.get_timestamp()
+        if timestamp is None:
+            return False
+
+        with open(self.index_file, "r") as index_file:
+            index_data = load(index_file)
+
+        if index_data.get("timestamp") != timestamp:
+            self.logger.info("Package index is out of date: %s" % self.index_file)
+            return False
+
+        self.packages = index_data["packages"]
+        self.logger.debug("Loaded package index with %d packages: %s" % (len(self.packages), self.index_file))
+        return True
+
+    def build(self):
+        """Builds the package index using the portage tree"""
+        import portage
+
+        self.logger.info("Building package index from the portage tree")
+        dbapi = portage.db[portage.root]["porttree"].dbapi
+        self.packages = {cp: dbapi.cp_list(cp) for cp in dbapi.cp_all()}
+        self.logger.info("Indexed %d packages" % len(self.packages))
+
+    def save(self):
+        """Saves the package index, failures are not fatal"""
+        timestamp = self.get_timestamp()
+        if timestamp is None:
+            return
+
+        try:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self.index_file.with_name(self.index_file.name + ".tmp")
+            with open(temp_file, "w") as index_file:
+                dump({"timestamp": timestamp, "packages": self.packages}, index_file)
+            replace(temp_file, self.index_file)
+        except OSError as e:
+            self.logger.warning("Unable to save package index: %s" % e)
+        else:
+            self.logger.debug("Saved package index: %s" % self.index_file)
+
+    def match(self, atom):
+        """Gets the package versions matching an atom"""
+        if is_plain_atom(atom):
+            return self.packages.get(atom, [])
+
+        import portage
+        from portage.dep import Atom, match_from_list
+
+        if "::" in atom:  # Repository information is not indexed
+            return portage.db[portage.root]["porttree"].dbapi.xmatch("match-all", atom)
+
+        atom = Atom(atom)
+        return match_from_list(atom, self.packages.get(atom.cp, []))
+
+    def validate(self, packages):
+        """Checks that all packages exist in the index, raises a KeyError listing all missing packages"""
+        missing = [package for package in packages if not self.match(package)]
+        if missing:
+            raise KeyError("Packages do not exist: %s" % ", ".join(missing))
+        self.logger.debug("Validated %d packages" % len(packages))
@@ -0,0 +1,107 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os import environ
+from pathlib import Path
+from threading import Lock
+from urllib.parse import unquote, urlparse
+
+from zenlib.logging import loggify
+
+from gentainer.tracing import traced_run
+
+
+def get_mirror(mirror):
+    """Gets a GENTOO_MIRRORS entry for a mirror.
+    file:// URIs are converted to paths, portage copies distfiles from mirrors which are local paths."""
+    mirror = str(mirror)
+    if mirror.startswith("file://"):
+        return unquote(urlparse(mirror).path)
+    return mirror
+
+
+@loggify
+class DistfilePrefetcher:
+    """
+    Fetches distfiles for layers which are about to be built, while other layers compile.
+
+    Layers are fetched in build order by a bounded pool of emerge --fetchonly processes, into a distfiles dir shared with builds.
+    Each layer has a readiness future, which is waited on before the layer is built.
+    If a layer is ready to build before its fetch started, the fetch is cancelled and emerge fetches while building.
+    Failed fetches are logged, the build fetches whatever is still missing.
+    """
+
+    def __init__(self, distfiles_dir=None, mirrors=None, jobs=2, binpkg_pool=None, *args, **kwargs):
+        self.distfiles_dir = Path(distfiles_dir) if distfiles_dir else None  # Defaults to the portage DISTDIR
+        if isinstance(mirrors, str):
+            mirrors = mirrors.split()
+        self.mirrors = [get_mirror(mirror) for mirror in mirrors or []]
+        self.jobs = jobs  # Concurrent fetches, 0 disables prefetching
+        self.binpkg_pool = binpkg_pool  # Packages available as binary packages are not fetched
+        self.futures = {}  # {container: Future}
+        self.lock = Lock()
+
+    def get_env(self, env=None):
+        """Gets the environment for emerge to use the shared distfiles dir and mirrors"""
+        env = {**(env or environ)}
+        if self.distfiles_dir:
+            env["DISTDIR"] = str(self.distfiles_dir)
+        if self.mirrors:
+            env["GENTOO_MIRRORS"] = " ".join(self.mirrors)
+        return env
+
+    def fetch(self, container, packages):
+        """Fetches the distfiles for packages and all of their dependencies"""
+        # The base image is not built yet, so the whole dependency tree is fetched, distfiles which exist are skipped
+        args = ["emerge", "--color", "n", "--fetchonly", "--emptytree", "--quiet"]
+        env = None
+        if self.binpkg_pool:
+            args.append("--usepkg")
+            env = self.binpkg_pool.get_env()
+        args.extend(packages)
+        self.logger.info("[%s] Prefetching distfiles: %s" % (container, ", ".join(packages)))
+        cmd_out = traced_run(args, container=container, capture_output=True, env=self.get_env(env))
+        if cmd_out.returncode != 0:
+            raise RuntimeError(
+                "[%s] Fetch failed with exit code %d: %s"
+                % (container, cmd_out.returncode, cmd_out.stderr.decode("utf-8", "replace").strip())
+            )
+        self.logger.info("[%s] Distfiles are ready" % container)
+
+    @contextmanager
+    def prefetch(self, layers):
+        """Fetches layers in the background, in order, while the context is active.
+        layers is a list of (container, packages) in build order."""
+        if self.distfiles_dir:
+            self.distfiles_dir.mkdir(parents=True, exist_ok=True)
+        if not layers:
+            yield
+            return
+        executor = ThreadPoolExecutor(max_workers=max(int(self.jobs), 1), thread_name_prefix="prefetch")
+        with self.lock:
+            for container, packages in layers:
+                self.futures[container] = executor.submit(self.fetch, container, packages)
+        try:
+            yield
+        finally:
+            with self.lock:
+                for container, _ in layers:
+                    self.futures.pop(container, None)
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def wait(self, container):
+        """Waits until the distfiles of a layer are fetched, if it is being prefetched"""
+        with self.lock:
+            future = self.futures.pop(container, None)
+        if future is None:
+            return
+        if future.cancel():
+            self.logger.debug("[%s] Prefetch did not start, distfiles will be fetched by the build" % container)
+            return
+        try:
+            future.result()
+        except Exception as e:
+            self.logger.warning("[%s] Prefetch failed, distfiles will be fetched by the build: %s" % (container, e))
@@ -0,0 +1,323 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from json import dump, dumps, load
+from os import chmod, lchown, lstat, replace, walk
+from os.path import join
+from pathlib import Path
+from pwd import getpwnam
+from shutil import rmtree
+from stat import S_IMODE, S_ISDIR, S_ISGID, S_ISLNK, S_ISUID
+from threading import Lock
+from time import monotonic
+
+from zenlib.logging import loggify
+
+from gentainer.nets import ContainerNet
+from gentainer.tracing import traced, traced_run, tracer
+from gentainer.treecopy import TreeCopier
+from gentainer.users import LXC_PATH_PARTS
+
+
+def get_subid_range(username, subid_file):
+    """Gets the first (start, count) subordinate id range of a user, or None"""
+    try:
+        with open(subid_file, "r") as f:
+            for line in f:
+                fields = line.strip().split(":")
+                if len(fields) == 3 and fields[0] == username:
+                    return int(fields[1]), int(fields[2])
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def shift_ownership(path, uid_range, gid_range):
+    """Shifts the owner and group of path and everything under it into subordinate id ranges, given as (start, count).
+    Ids beyond the count are not changed. Set-user-ID and set-group-ID bits, which chown clears, are restored.
+    Returns the number of files shifted."""
+
+    def shift(file_path):
+        stat = lstat(file_path)
+        if not S_ISDIR(stat.st_mode) and stat.st_nlink > 1:
+            if (stat.st_dev, stat.st_ino) in shifted:
+                return
+            shifted.add((stat.st_dev, stat.st_ino))
+        uid = stat.st_uid + uid_range[0] if stat.st_uid < uid_range[1] else stat.st_uid
+        gid = stat.st_gid + gid_range[0] if stat.st_gid < gid_range[1] else stat.st_gid
+        lchown(file_path, uid, gid)
+        if stat.st_mode & (S_ISUID | S_ISGID) and not S_ISLNK(stat.st_mode):
+            chmod(file_path, S_IMODE(stat.st_mode))
+
+    shifted = set()  # Hard linked files, which must only be shifted once
+    count = 1
+    shift(path)
+    for root, dirs, files in walk(path):
+        for name in dirs + files:
+            shift(join(root, name))
+            count += 1
+    return count
+
+
+@loggify
+class ContainerRunner:
+    """
+    Generates LXC configs for built containers and starts them.
+
+    Generated configs are cached, keyed on a digest of the container config, the host network config,
+    the rootfs and the subordinate id files, and are only generated again when that changes.
+    Each container runs on its own rootfs, created from its layer, so running containers never write to layers.
+    Containers with a username are unprivileged, they are started as that user, in the LXC path under the user home,
+    with that user's subordinate ids mapped, and their rootfs owned by those ids.
+    """
+
+    def __init__(
+        self,
+        gentainer,
+        lxc_path="/var/lib/lxc",
+        lxc_includes=None,
+        subuid_file="/etc/subuid",
+        subgid_file="/etc/subgid",
+        start_timeout=30,
+        *args,
+        **kwargs,
+    ):
+        self.gentainer = gentainer
+        self.lxc_path = Path(lxc_path)  # LXC path for containers without a username
+        self.lxc_includes = lxc_includes if lxc_includes is not None else ["/usr/share/lxc/config/common.conf"]
+        self.subuid_file = Path(subuid_file)
+        self.subgid_file = Path(subgid_file)
+        self.start_timeout = start_timeout
+        self.cache_file = gentainer.cache_dir / "lxc_configs.json"
+        self.cache = self.load_cache()
+        self.cache_lock = Lock()
+
+    def load_cache(self):
+        """Loads the {container: config digest} cache"""
+        try:
+            with open(self.cache_file, "r") as cache_file:
+                return load(cache_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_cache(self):
+        """Writes the config digest cache, failures are not fatal"""
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self.cache_file.with_name(self.cache_file.name + ".tmp")
+            with open(temp_file, "w") as cache_file:
+                dump(self.cache, cache_file)
+            replace(temp_file, self.cache_file)
+        except OSError as e:
+            self.logger.warning("Unable to save LXC config cache: %s" % e)
+
+    def get_lxc_path(self, container):
+        """Gets the LXC path for a container, under the home of its user if it has one"""
+        config = self.gentainer.containers[container]
+        if "username" in config:
+            return Path(getpwnam(config["username"]).pw_dir, *LXC_PATH_PARTS)
+        return self.lxc_path
+
+    def is_unprivileged(self, container):
+        """Containers with a username are started by that user, with its subordinate ids"""
+        return "username" in self.gentainer.containers[container]
+
+    def get_container_dir(self, container):
+        """Gets the LXC dir of a container, which holds its config and rootfs"""
+        return self.get_lxc_path(container) / container
+
+    def uses_overlay_rootfs(self, container):
+        """Privileged containers on overlay layers are started on an LXC overlay rootfs, which copies no data.
+        Unprivileged containers need a rootfs owned by their subordinate ids, so their layer is copied."""
+        return self.gentainer.directory_backing == "overlay" and not self.is_unprivileged(container)
+
+    def get_rootfs(self, container):
+        """Gets the LXC rootfs for a container"""
+        if self.uses_overlay_rootfs(container):
+            # LXC overlay rootfs: overlay:<lower dirs>:<upper dir>, the layer dirs are the lower dirs
+            layer = self.gentainer.get_layer(container)
+            return "overlay:%s:%s" % (":".join(layer.get_layer_dirs()), self.get_container_dir(container) / "delta0")
+        return str(self.get_container_dir(container) / "rootfs")
+
+    def clean_rootfs(self, container):
+        """Deletes the rootfs of a container"""
+        container_dir = self.get_container_dir(container)
+        rootfs_dir, delta_dir = container_dir / "rootfs", container_dir / "delta0"
+        if rootfs_dir.exists():
+            self.logger.info("[%s] Deleting container rootfs: %s" % (container, rootfs_dir))
+            if self.gentainer.directory_backing == "btrfs":
+                cmd_out = traced_run(
+                    ["btrfs", "subvolume", "delete", str(rootfs_dir)], container=container, capture_output=True
+                )
+                if cmd_out.returncode != 0:
+                    raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+            else:
+                rmtree(rootfs_dir)
+        if delta_dir.exists():
+            rmtree(delta_dir)
+
+    def copy_layer(self, container, rootfs_dir):
+        """Copies a layer to a container rootfs, snapshotting btrfs layers and cloning dir and overlay layers"""
+        layer = self.gentainer.get_layer(container)
+        if layer.directory_backing == "btrfs":
+            args = ["btrfs", "subvolume", "snapshot", str(layer.layer_dir), str(rootfs_dir)]
+            cmd_out = traced_run(args, container=container, capture_output=True)
+            if cmd_out.returncode != 0:
+                raise RuntimeError(cmd_out.stderr.decode("utf-8"))
+        elif layer.directory_backing == "overlay":
+            # The merged layer is mounted read only, so the layer is not changed
+            mountpoint = self.get_container_dir(container) / "layer"
+            mountpoint.mkdir(exist_ok=True)
+            layer.mount_overlay(layer.get_layer_dirs(), mountpoint)
+            try:
+                TreeCopier(mountpoint, rootfs_dir, workers=self.gentainer.copy_workers, logger=self.logger).copy()
+            finally:
+                layer.umount(mountpoint)
+                mountpoint.rmdir()
+        else:
+            TreeCopier(layer.layer_dir, rootfs_dir, workers=self.gentainer.copy_workers, logger=self.logger).copy()
+
+    @traced("rootfs_prepare")
+    def prepare_rootfs(self, container):
+        """Creates the rootfs of a container from its layer, unless it was created from the current layer build.
+        The rootfs of an unprivileged container is shifted into the subordinate ids of its user."""
+        container_dir = self.get_container_dir(container)
+        digest_file = container_dir / "rootfs.digest"  # Digest of the layer build the rootfs was created from
+        layer_digest = self.gentainer.layer_manifest.get(container)
+        rootfs_dir = container_dir / ("delta0" if self.uses_overlay_rootfs(container) else "rootfs")
+        if rootfs_dir.exists() and digest_file.exists() and digest_file.read_text() == layer_digest:
+            self.logger.debug("[%s] Container rootfs is up to date: %s" % (container, rootfs_dir))
+            return
+
+        self.clean_rootfs(container)
+        container_dir.mkdir(parents=True, exist_ok=True)
+        if self.uses_overlay_rootfs(container):
+            self.logger.info("[%s] Creating overlay rootfs upper dir: %s" % (container, rootfs_dir))
+            rootfs_dir.mkdir(mode=0o755)
+        else:
+            self.logger.info("[%s] Creating container rootfs: %s" % (container, rootfs_dir))
+            self.copy_layer(container, rootfs_dir)
+            if self.is_unprivileged(container):
+                uid_range, gid_range = self.get_subid_ranges(container)
+                with tracer.span("rootfs_shift", container=container):
+                    count = shift_ownership(rootfs_dir, uid_range, gid_range)
+                self.logger.info(
+                    "[%s] Shifted ownership of %d files to ids starting at %d" % (container, count, uid_range[0])
+                )
+        digest_file.write_text(layer_digest or "")
+
+    def get_config_digest(self, container):
+        """Gets a digest of everything the LXC config for a container is generated from"""
+        config = self.gentainer.containers[container]
+        host_networks = self.gentainer.host_network.config
+        inputs = {
+            "config": dict(config),
+            "networks": {network: host_networks.get(network) for network in config.get("networks", {})},
+            "rootfs": self.get_rootfs(container),
+            "includes": self.lxc_includes,
+            "subids": [
+                subid_file.stat().st_mtime_ns if subid_file.exists() else None
+                for subid_file in (self.subuid_file, self.subgid_file)
+            ],
+        }
+        return sha256(dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_subid_ranges(self, container):
+        """Gets the (start, count) subordinate uid and gid ranges of the user of a container"""
+        username = self.gentainer.containers[container]["username"]
+        subid_ranges = []
+        for subid_file in (self.subuid_file, self.subgid_file):
+            subid_range = get_subid_range(username, subid_file)
+            if subid_range is None:
+                raise ValueError("[%s] No subordinate ids for user '%s' in: %s" % (container, username, subid_file))
+            subid_ranges.append(subid_range)
+        return subid_ranges
+
+    def get_idmaps(self, container):
+        """Gets lxc.idmap directives mapping root in the container to the user's subordinate ids"""
+        if not self.is_unprivileged(container):
+            self.logger.warning("[%s] No username set, the container will not use an id map" % container)
+            return []
+
+        uid_range, gid_range = self.get_subid_ranges(container)
+        return ["lxc.idmap = u 0 %d %d" % uid_range, "lxc.idmap = g 0 %d %d" % gid_range]
+
+    def generate_config(self, container):
+        """Generates the LXC config directives for a container"""
+        config = self.gentainer.containers[container]
+        directives = ["lxc.include = %s" % include for include in self.lxc_includes]
+        directives.append("lxc.uts.name = %s" % container)
+        directives.append("lxc.rootfs.path = %s" % self.get_rootfs(container))
+        directives.extend(self.get_idmaps(container))
+        if "networks" in config:
+            net = ContainerNet(config, netlink=self.gentainer.netlink, logger=self.logger)
+            directives.extend(net.to_config())
+        return directives
+
+    def write_config(self, container):
+        """Writes the LXC config for a container, unless the cached config is current.
+        Returns the config file."""
+        config_file = self.get_container_dir(container) / "config"
+        digest = self.get_config_digest(container)
+        with self.cache_lock:
+            if config_file.exists() and self.cache.get(container) == digest:
+                self.logger.debug("[%s] LXC config is up to date: %s" % (container, config_file))
+                return config_file
+
+        directives = self.generate_config(container)
+        config_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = config_file.with_name(config_file.name + ".tmp")
+        temp_file.write_text("\n".join(directives) + "\n")
+        replace(temp_file, config_file)
+        self.logger.info("[%s] Wrote LXC config: %s" % (container, config_file))
+        with self.cache_lock:
+            self.cache[container] = digest
+        return config_file
+
+    def start(self, container):
+        """Creates the container rootfs and writes the LXC config if needed,
+        then starts the container and waits until it is running. Unprivileged containers are started as their user.
+        Returns the start latency in seconds."""
+        start_time = monotonic()
+        with tracer.span("container_start", container=container):
+            if not self.gentainer.get_layer(container).layer_dir.exists():
+                raise FileNotFoundError("Layer does not exist for container: %s" % container)
+            self.prepare_rootfs(container)
+            self.write_config(container)
+            lxc_args = ["--name", container, "--lxcpath", str(self.get_lxc_path(container))]
+            run_as = []
+            if self.is_unprivileged(container):
+                run_as = ["runuser", "-u", self.gentainer.containers[container]["username"], "--"]
+            for args in (
+                [*run_as, "lxc-start", *lxc_args, "--daemon"],
+                [*run_as, "lxc-wait", *lxc_args, "--state", "RUNNING", "--timeout", str(self.start_timeout)],
+            ):
+                cmd_out = traced_run(args, container=container, capture_output=True)
+                if cmd_out.returncode != 0:
+                    raise RuntimeError(
+                        "[%s] %s failed: %s" % (container, args[len(run_as)], cmd_out.stderr.decode("utf-8"))
+                    )
+        latency = monotonic() - start_time
+        self.logger.info("[%s] Started in %.2fs" % (container, latency))
+        return latency
+
+    @traced("run_all")
+    def start_all(self, containers, jobs=16):
+        """Starts containers concurrently, at most jobs at a time.
+        Returns {container: {"status", "latency", "error"}}."""
+
+        def start(container):
+            try:
+                return {"status": "running", "latency": self.start(container), "error": None}
+            except Exception as e:
+                self.logger.error("[%s] Failed to start: %s" % (container, e))
+                return {"status": "failed", "latency": None, "error": str(e)}
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(int(jobs), 1)) as executor:
+                return dict(zip(containers, executor.map(start, containers)))
+        finally:
+            self.save_cache()
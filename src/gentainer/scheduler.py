@@ -0,0 +1,169 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from heapq import heappop, heappush
+from itertools import count
+
+from zenlib.logging import loggify
+
+
+class ReadyQueue:
+    """Layers which are ready to build, ordered by longest critical path, then by the order they were added"""
+
+    def __init__(self, paths):
+        self.paths = paths  # {container: critical path seconds}
+        self.heap = []
+        self.counter = count()
+
+    def push(self, container):
+        heappush(self.heap, (-self.paths[container], next(self.counter), container))
+
+    def pop(self):
+        return heappop(self.heap)[2]
+
+    def __bool__(self):
+        return bool(self.heap)
+
+
+@loggify
+class BuildScheduler:
+    """Builds container layers in base_image order.
+    Each layer in the resolved graph is built exactly once,
+    layers which do not depend on each other are built concurrently.
+    If build estimates are set, ready layers on the longest remaining path through the graph are started first."""
+
+    def __init__(self, containers, build_function, jobs=1, estimates=None, *args, **kwargs):
+        self.containers = containers  # {name: ContainerConfig}
+        self.build_function = build_function  # Called with the container name
+        self.jobs = max(int(jobs), 1)
+        self.estimates = estimates or {}  # {container: estimated build seconds}
+        self.built = []
+        self.failed = {}
+        self.skipped = []
+
+    def get_base_image(self, container):
+        """Returns the base image of a container, or None"""
+        if container not in self.containers:
+            raise KeyError("Container does not exist: %s" % container)
+        config = self.containers[container]
+        return config["base_image"] if "base_image" in config else None
+
+    def resolve(self, targets):
+        """Resolves the base_image chains of all targets into a graph.
+        Returns a dict of {container: base_image}."""
+        graph = {}
+        for target in targets:
+            chain = []
+            container = target
+            while container is not None and container not in graph:
+                if container in chain:
+                    raise ValueError("Base image loop detected: %s" % " -> ".join([*chain, container]))
+                chain.append(container)
+                container = self.get_base_image(container)
+            for container in chain:
+                graph[container] = self.get_base_image(container)
+
+        self.logger.debug("Resolved build graph: %s" % graph)
+        return graph
+
+    def get_children(self, graph):
+        """Returns a dict of {container: [children]} for a resolved graph"""
+        children = {container: [] for container in graph}
+        for container, base_image in graph.items():
+            if base_image is not None:
+                children[base_image].append(container)
+        return children
+
+    def get_critical_paths(self, graph, children):
+        """Returns {container: estimated seconds from the start of its build until its longest descendant chain is built}"""
+        order = [container for container, base_image in graph.items() if base_image is None]
+        for container in order:
+            order.extend(children[container])
+
+        paths = {}
+        for container in reversed(order):
+            paths[container] = self.estimates.get(container, 0) + max(
+                (paths[child] for child in children[container]), default=0
+            )
+        return paths
+
+    def get_ready_queue(self, graph, children):
+        """Returns a ReadyQueue with the layers which have no base image"""
+        ready = ReadyQueue(self.get_critical_paths(graph, children))
+        for container, base_image in graph.items():
+            if base_image is None:
+                ready.push(container)
+        return ready
+
+    def get_build_order(self, graph):
+        """Returns the containers of a resolved graph in the order they are started with one job"""
+        children = self.get_children(graph)
+        ready, order = self.get_ready_queue(graph, children), []
+        while ready:
+            container = ready.pop()
+            order.append(container)
+            for child in children[container]:
+                ready.push(child)
+        return order
+
+    def simulate(self, graph):
+        """Simulates building a resolved graph with the estimates and job count.
+        Returns {container: (start seconds, finish seconds)}."""
+        children = self.get_children(graph)
+        ready, running, times, now = self.get_ready_queue(graph, children), [], {}, 0
+        while ready or running:
+            while ready and len(running) < self.jobs:
+                container = ready.pop()
+                times[container] = (now, now + self.estimates.get(container, 0))
+                heappush(running, (times[container][1], len(times), container))
+            now, _, container = heappop(running)
+            for child in children[container]:
+                ready.push(child)
+        return times
+
+    def skip_children(self, container, children):
+        """Marks all descendants of a failed container as skipped"""
+        for child in children[container]:
+            self.logger.error("[%s] Skipping build, base image failed: %s" % (child, container))
+            self.skipped.append(child)
+            self.skip_children(child, children)
+
+    def run(self, targets):
+        """Builds all targets and their base images.
+        Raises a RuntimeError if any layer failed to build."""
+        graph = self.resolve(targets)
+        children = self.get_children(graph)
+
+        ready = self.get_ready_queue(graph, children)
+        self.logger.info("Building %d layers with %d jobs" % (len(graph), self.jobs))
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            running = {}
+            while ready or running:
+                while ready and len(running) < self.jobs:
+                    container = ready.pop()
+                    self.logger.debug("Starting layer build: %s" % container)
+                    running[executor.submit(self.build_function, container)] = container
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    container = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.logger.error("[%s] Layer build failed: %s" % (container, e))
+                        self.failed[container] = e
+                        self.skip_children(container, children)
+                    else:
+                        self.logger.info("[%s] Layer build complete" % container)
+                        self.built.append(container)
+                        for child in children[container]:
+                            ready.push(child)
+
+        if self.failed:
+            raise RuntimeError(
+                "Failed to build layers: %s; Skipped: %s" % (", ".join(self.failed), ", ".join(self.skipped) or None)
+            )
+        return self.built
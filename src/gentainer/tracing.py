@@ -0,0 +1,136 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from json import dump
+from os import getpid
+from subprocess import run
+from threading import Lock, current_thread, get_ident
+from time import perf_counter_ns
+
+from zenlib.logging import loggify
+
+DISABLED_SPAN = nullcontext()  # Returned by Tracer.span when tracing is disabled
+
+
+@loggify
+class Tracer:
+    """
+    Records timed spans for build phases and subprocesses.
+    Spans can be exported as Chrome trace event JSON, and summarized as a table.
+    When disabled, span() only checks a flag and returns a shared null context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.enabled = False
+        self.lock = Lock()
+        self.events = []
+        self.threads = {}  # {thread id: thread name}
+        self.start_time = perf_counter_ns()
+
+    def enable(self):
+        """Enables tracing, clearing recorded spans"""
+        with self.lock:
+            self.events, self.threads = [], {}
+            self.start_time = perf_counter_ns()
+            self.enabled = True
+
+    def span(self, name, category="phase", **span_args):
+        """Returns a context manager which records a span.
+        Spans in the same thread are nested by time, span_args such as the container are included in the trace."""
+        if not self.enabled:
+            return DISABLED_SPAN
+        return self.record_span(name, category, span_args)
+
+    @contextmanager
+    def record_span(self, name, category, span_args):
+        """Records the duration of the context as a complete event"""
+        start_time = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start_time, perf_counter_ns(), **span_args)
+
+    def add_span(self, name, category, start_time, end_time, **span_args):
+        """Records a complete event in the current thread, between perf_counter_ns timestamps.
+        Used for spans which are not a block of code, such as a package merged by emerge."""
+        if not self.enabled:
+            return
+        thread_id = get_ident()
+        with self.lock:
+            self.threads[thread_id] = current_thread().name
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start_time - self.start_time) / 1000,
+                    "dur": (end_time - start_time) / 1000,
+                    "pid": getpid(),
+                    "tid": thread_id,
+                    "args": {key: str(value) for key, value in span_args.items()},
+                }
+            )
+
+    def export_chrome(self, trace_file):
+        """Writes recorded spans as Chrome trace event JSON"""
+        with self.lock:
+            thread_names = [
+                {"name": "thread_name", "ph": "M", "pid": getpid(), "tid": thread_id, "args": {"name": thread_name}}
+                for thread_id, thread_name in self.threads.items()
+            ]
+            trace_events = [*thread_names, *self.events]
+        with open(trace_file, "w") as f:
+            dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        self.logger.info("Wrote %d trace events: %s" % (len(trace_events), trace_file))
+
+    def get_summary(self):
+        """Gets the count, total, mean and max duration in ms of spans, grouped by category and name"""
+        summary = {}
+        with self.lock:
+            for event in self.events:
+                entry = summary.setdefault((event["cat"], event["name"]), {"count": 0, "total": 0.0, "max": 0.0})
+                entry["count"] += 1
+                entry["total"] += event["dur"] / 1000
+                entry["max"] = max(entry["max"], event["dur"] / 1000)
+        for entry in summary.values():
+            entry["mean"] = entry["total"] / entry["count"]
+        return summary
+
+    def format_summary(self):
+        """Formats the span summary as a table, sorted by total time"""
+        lines = ["%-12s %-32s %8s %12s %12s %12s" % ("Category", "Span", "Count", "Total ms", "Mean ms", "Max ms")]
+        summary = sorted(self.get_summary().items(), key=lambda item: item[1]["total"], reverse=True)
+        for (category, name), entry in summary:
+            lines.append(
+                "%-12s %-32s %8d %12.1f %12.1f %12.1f"
+                % (category, name, entry["count"], entry["total"], entry["mean"], entry["max"])
+            )
+        return "\n".join(lines)
+
+
+tracer = Tracer()  # Shared by all modules, enabled with --trace
+
+
+def traced_run(args, container=None, **kwargs):
+    """subprocess.run, recorded as a subprocess span when tracing is enabled"""
+    with tracer.span(args[0], category="subprocess", command=" ".join(args), container=container):
+        return run(args, **kwargs)
+
+
+def traced(name, category="phase"):
+    """Decorator which records a span for each call when tracing is enabled"""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.record_span(name, category, {}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,263 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from concurrent.futures import ThreadPoolExecutor
+from errno import EBADF, EINVAL, ENOSYS, ENOTSUP, ENOTTY, ENXIO, EOPNOTSUPP, EPERM, EXDEV
+from fcntl import ioctl
+from os import (
+    O_CREAT,
+    O_EXCL,
+    O_NOFOLLOW,
+    O_RDONLY,
+    O_WRONLY,
+    SEEK_DATA,
+    SEEK_HOLE,
+    chmod,
+    chown,
+    close,
+    copy_file_range,
+    cpu_count,
+    ftruncate,
+    getxattr,
+    link,
+    listxattr,
+    lseek,
+    mkdir,
+    mknod,
+    open as os_open,
+    pread,
+    pwrite,
+    readlink,
+    scandir,
+    setxattr,
+    symlink,
+    utime,
+)
+from pathlib import Path
+from stat import S_IMODE, S_ISBLK, S_ISCHR, S_ISDIR, S_ISFIFO, S_ISLNK, S_ISREG, S_ISSOCK
+from threading import Lock
+
+from zenlib.logging import loggify
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int), clones a whole file on filesystems with reflink support
+UNSUPPORTED_ERRNOS = {EBADF, EINVAL, ENOSYS, ENOTSUP, ENOTTY, EOPNOTSUPP, EXDEV}  # The copy method is not available
+COPY_CHUNK_SIZE = 1 << 30  # Bytes per copy_file_range call
+READ_CHUNK_SIZE = 1 << 20  # Bytes per read when copying through userspace
+
+
+@loggify
+class TreeCopier:
+    """
+    Copies a directory tree, preserving ownership, permissions, xattrs, timestamps, hardlinks, devices and symlinks.
+
+    Regular files are copied in parallel, each is cloned with FICLONE if the filesystem supports reflinks,
+    otherwise its data segments are copied with copy_file_range, falling back to pread/pwrite.
+    Holes in sparse files are not written, so they stay sparse.
+    Once a method fails as unsupported, it is not tried again for the rest of the copy.
+    """
+
+    def __init__(self, source, destination, workers=None, *args, **kwargs):
+        self.source = Path(source)
+        self.destination = Path(destination)
+        self.workers = workers or min(32, (cpu_count() or 1) * 2)
+        self.lock = Lock()
+        self.use_reflink = True
+        self.use_copy_file_range = True
+        self.report = {
+            "directories": 0,
+            "files": 0,
+            "hardlinks": 0,
+            "symlinks": 0,
+            "devices": 0,
+            "bytes_cloned": 0,  # Bytes shared with the source through reflinks
+            "bytes_copied": 0,  # Data bytes written to the destination, holes in sparse files are not counted
+        }
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.report[key] += value
+
+    def copy(self):
+        """Copies the source tree to the destination, which must not exist. Returns the copy report."""
+        if not self.source.is_dir():
+            raise FileNotFoundError("Source directory does not exist: %s" % self.source)
+
+        self.logger.info("Copying tree '%s' to: %s" % (self.source, self.destination))
+        directories, files, links, others = self.walk()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda file: self.copy_file(*file), files))
+
+        for source_path, destination_path, first_path in links:
+            link(first_path, destination_path)
+            self.count("hardlinks")
+
+        for source_path, destination_path, stat in others:
+            self.copy_special(source_path, destination_path, stat)
+
+        # Directory metadata is set last, deepest first, so timestamps are not changed by creating their contents
+        for source_path, destination_path, stat in reversed(directories):
+            self.copy_metadata(source_path, destination_path, stat)
+
+        self.logger.info(
+            "Copied %d files, %d hardlinks, %d directories; cloned %d bytes, copied %d bytes"
+            % (
+                self.report["files"],
+                self.report["hardlinks"],
+                self.report["directories"],
+                self.report["bytes_cloned"],
+                self.report["bytes_copied"],
+            )
+        )
+        return self.report
+
+    def walk(self):
+        """Walks the source tree, creating destination directories.
+        Returns lists of directories, regular files, hardlinks to files in the list, and other entries."""
+        directories, files, links, others = [], [], [], []
+        inodes = {}  # {(st_dev, st_ino): destination path} for files with multiple links
+
+        mkdir(self.destination, 0o700)
+        directories.append((self.source, self.destination, self.source.lstat()))
+        self.count("directories")
+        pending = [(self.source, self.destination)]
+        while pending:
+            source_dir, destination_dir = pending.pop()
+            with scandir(source_dir) as entries:
+                for entry in entries:
+                    source_path, destination_path = Path(entry.path), destination_dir / entry.name
+                    stat = entry.stat(follow_symlinks=False)
+                    if S_ISDIR(stat.st_mode):
+                        mkdir(destination_path, 0o700)
+                        directories.append((source_path, destination_path, stat))
+                        self.count("directories")
+                        pending.append((source_path, destination_path))
+                    elif S_ISREG(stat.st_mode):
+                        if stat.st_nlink > 1:
+                            inode = (stat.st_dev, stat.st_ino)
+                            if inode in inodes:
+                                links.append((source_path, destination_path, inodes[inode]))
+                                continue
+                            inodes[inode] = destination_path
+                        files.append((source_path, destination_path, stat))
+                    else:
+                        others.append((source_path, destination_path, stat))
+
+        return directories, files, links, others
+
+    def clone_data(self, source_fd, destination_fd, size):
+        """Copies file data with the fastest available method"""
+        if self.use_reflink:
+            try:
+                ioctl(destination_fd, FICLONE, source_fd)
+                self.count("bytes_cloned", size)
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.logger.info("Reflinks are not supported, copying file data: %s" % self.destination)
+                self.use_reflink = False
+
+        copied = 0
+        for offset, length in self.get_data_segments(source_fd, size):
+            copied += self.copy_segment(source_fd, destination_fd, offset, length)
+        ftruncate(destination_fd, size)  # Extends the file over a trailing hole
+        self.count("bytes_copied", copied)
+
+    def get_data_segments(self, fd, size):
+        """Yields (offset, length) of the data segments of a file, skipping holes.
+        If the filesystem can't find holes, the whole file is one segment."""
+        offset = 0
+        while offset < size:
+            try:
+                data_start = lseek(fd, offset, SEEK_DATA)
+                data_end = min(lseek(fd, data_start, SEEK_HOLE), size)
+            except OSError as e:
+                if e.errno == ENXIO:  # There is no data after the offset
+                    return
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                data_start, data_end = offset, size
+            yield data_start, data_end - data_start
+            offset = data_end
+
+    def copy_segment(self, source_fd, destination_fd, offset, length):
+        """Copies a segment of file data to the same offset in the destination, returns the bytes copied"""
+        end = offset + length
+        position = offset
+        if self.use_copy_file_range:
+            try:
+                while position < end and (
+                    written := copy_file_range(
+                        source_fd, destination_fd, min(COPY_CHUNK_SIZE, end - position), position, position
+                    )
+                ):
+                    position += written
+                return position - offset
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS or position != offset:
+                    raise
+                self.logger.info("copy_file_range is not supported, copying through userspace: %s" % self.destination)
+                self.use_copy_file_range = False
+
+        while position < end and (data := pread(source_fd, min(READ_CHUNK_SIZE, end - position), position)):
+            while data:
+                written = pwrite(destination_fd, data, position)
+                position += written
+                data = data[written:]
+        return position - offset
+
+    def copy_file(self, source_path, destination_path, stat):
+        """Copies a regular file and its metadata"""
+        source_fd = os_open(source_path, O_RDONLY | O_NOFOLLOW)
+        try:
+            destination_fd = os_open(destination_path, O_WRONLY | O_CREAT | O_EXCL, 0o600)
+            try:
+                if stat.st_size:
+                    self.clone_data(source_fd, destination_fd, stat.st_size)
+            finally:
+                close(destination_fd)
+        finally:
+            close(source_fd)
+        self.copy_metadata(source_path, destination_path, stat)
+        self.count("files")
+
+    def copy_special(self, source_path, destination_path, stat):
+        """Copies a symlink, device node, FIFO or socket"""
+        if S_ISLNK(stat.st_mode):
+            symlink(readlink(source_path), destination_path)
+            self.count("symlinks")
+        elif S_ISCHR(stat.st_mode) or S_ISBLK(stat.st_mode) or S_ISFIFO(stat.st_mode) or S_ISSOCK(stat.st_mode):
+            mknod(destination_path, stat.st_mode, stat.st_rdev)
+            self.count("devices")
+        else:
+            self.logger.warning("Skipping unknown file type: %s" % source_path)
+            return
+        self.copy_metadata(source_path, destination_path, stat)
+
+    def copy_xattrs(self, source_path, destination_path):
+        """Copies extended attributes, if supported by both filesystems"""
+        try:
+            names = listxattr(source_path, follow_symlinks=False)
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS:
+                return
+            raise
+
+        for name in names:
+            try:
+                setxattr(destination_path, name, getxattr(source_path, name, follow_symlinks=False), follow_symlinks=False)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS | {EPERM}:
+                    raise
+                self.logger.warning("Unable to copy xattr '%s': %s" % (name, destination_path))
+
+    def copy_metadata(self, source_path, destination_path, stat):
+        """Copies ownership, permissions, xattrs and timestamps.
+        Ownership is set first, since chown clears setuid bits and file capabilities."""
+        chown(destination_path, stat.st_uid, stat.st_gid, follow_symlinks=False)
+        if not S_ISLNK(stat.st_mode):
+            chmod(destination_path, S_IMODE(stat.st_mode))
+        self.copy_xattrs(source_path, destination_path)
+        utime(destination_path, ns=(stat.st_atime_ns, stat.st_mtime_ns), follow_symlinks=False)
@@ -0,0 +1,134 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from fcntl import LOCK_EX, LOCK_UN, flock
+from os import chmod, fsync, replace
+from pathlib import Path
+from threading import RLock
+
+from zenlib.logging import loggify
+
+
+@loggify
+class UsernetDB:
+    """
+    The lxc-usernet file, parsed once and indexed by (user, type, interface).
+
+    Use as a context manager, the file is locked and read on entry.
+    Changes are made in memory, and are written with a single atomic replace when the outermost context exits.
+    If any context exits with an exception, the changes are dropped and the file is not written.
+    """
+
+    def __init__(self, usernet_file, *args, **kwargs):
+        self.usernet_file = Path(usernet_file)
+        self.lock_file = self.usernet_file.with_name(self.usernet_file.name + ".lock")
+        self.lock = RLock()
+        self.depth = 0  # Nested context depth, the file is only locked and written by the outermost context
+        self.lock_fd = None
+        self.lines = []  # Lines in file order, entries are stored as their key
+        self.entries = {}  # {(user, interface_type, interface): count}
+        self.changed = False
+        self.failed = False  # Set if a context exited with an exception, so the changes are dropped
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            if self.depth == 0:
+                self.lock_file.parent.mkdir(parents=True, exist_ok=True)
+                self.lock_fd = open(self.lock_file, "w")
+                self.logger.debug("Locking usernet file: %s" % self.lock_file)
+                flock(self.lock_fd, LOCK_EX)
+                self.load()
+        except Exception:
+            self.release()
+            self.lock.release()
+            raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        self.failed = self.failed or exc_type is not None
+        try:
+            if self.depth == 0:
+                if self.failed:
+                    self.discard()
+                else:
+                    self.commit()
+        finally:
+            if self.depth == 0:
+                self.release()
+            self.lock.release()
+
+    def discard(self):
+        """Drops changes which were not written, the file is read again by the next context"""
+        if self.changed:
+            self.logger.warning("Discarding usernet changes after an error: %s" % self.usernet_file)
+        self.lines, self.entries, self.changed, self.failed = [], {}, False, False
+
+    def release(self):
+        """Releases the file lock"""
+        if self.lock_fd is not None:
+            flock(self.lock_fd, LOCK_UN)
+            self.lock_fd.close()
+            self.lock_fd = None
+
+    def load(self):
+        """Reads and indexes the usernet file"""
+        self.lines, self.entries, self.changed = [], {}, False
+        if not self.usernet_file.exists():
+            self.logger.warning("Usernet file does not exist, it will be created: %s" % self.usernet_file)
+            return
+
+        with open(self.usernet_file, "r") as usernet:
+            for line in usernet.readlines():
+                line = line if line.endswith("\n") else line + "\n"
+                if line.startswith("#"):
+                    self.logger.log(5, "Skipping commented line: %s" % line)
+                    self.lines.append(line)
+                    continue
+                elif not line.strip():
+                    self.logger.log(5, "Skipping empty line")
+                    self.lines.append(line)
+                    continue
+
+                try:
+                    user, interface_type, interface, count = line.split()
+                    self.entries[(user, interface_type, interface)] = int(count)
+                except ValueError:
+                    raise ValueError("Invalid usernet entry: %s" % line)
+                self.lines.append((user, interface_type, interface))
+
+        self.logger.debug("Loaded %d usernet entries: %s" % (len(self.entries), self.usernet_file))
+
+    def get(self, user, interface_type, interface):
+        """Gets the allocation count for an entry, or None if there is no entry"""
+        return self.entries.get((user, interface_type, interface))
+
+    def set(self, user, interface_type, interface, count):
+        """Adds or replaces an entry"""
+        if self.depth == 0:
+            raise RuntimeError("Usernet entries can only be changed while the usernet file is locked")
+
+        key = (user, interface_type, interface)
+        if key not in self.entries:
+            self.lines.append(key)
+        self.entries[key] = count
+        self.changed = True
+
+    def commit(self):
+        """Writes all entries to a temporary file, then replaces the usernet file"""
+        if not self.changed:
+            return
+
+        temp_file = self.usernet_file.with_name(self.usernet_file.name + ".tmp")
+        with open(temp_file, "w") as usernet:
+            for line in self.lines:
+                usernet.write(line if isinstance(line, str) else "%s %s %s %d\n" % (*line, self.entries[line]))
+            usernet.flush()
+            fsync(usernet.fileno())
+        chmod(temp_file, 0o644)
+        replace(temp_file, self.usernet_file)
+        self.changed = False
+        self.logger.info("Wrote %d usernet entries: %s" % (len(self.entries), self.usernet_file))
@@ -2,13 +2,41 @@ __author__ = 'desultory'
 __version__ = '0.0.2'
 
 
-from zenlib.util import replace_file_line
 from zenlib.logging import loggify
 
+from gentainer.tracing import traced, traced_run
+from gentainer.usernet import UsernetDB
+
 from pathlib import Path
-from pwd import getpwnam
-from subprocess import run
-from os import chmod, mkdir, chown
+from pwd import getpwall, getpwnam
+from os import mkdir, chown, stat
+
+LXC_PATH_PARTS = ['.local', 'share', 'lxc']  # Path to the LXC directory, under the user home
+
+
+def useradd(username):
+    """Creates a user along with a home directory, and adds the user to the lxc group."""
+    user_cmd = traced_run(['useradd', '--create-home', '--groups', 'lxc', username], capture_output=True)
+    if user_cmd.returncode != 0:
+        raise RuntimeError("Failed to create user: %s; Error: %s" % (username, user_cmd.stderr.decode('utf-8')))
+    return user_cmd.stdout.decode('utf-8')
+
+
+def ensure_dir(path, uid, gid):
+    """Creates a directory owned by uid:gid, or fixes its ownership.
+    Uses a single stat for directories which are already correct.
+    Returns 'created', 'chowned' or 'correct'."""
+    try:
+        dir_stat = stat(path)
+    except FileNotFoundError:
+        mkdir(path)
+        chown(path, uid, gid)
+        return 'created'
+
+    if dir_stat.st_uid != uid or dir_stat.st_gid != gid:
+        chown(path, uid, gid)
+        return 'chowned'
+    return 'correct'
 
 
 @loggify
@@ -16,12 +44,17 @@ class UserManager:
     parameters = {"username": str,  # User name for the unprivileged container user
                   "usernet_allocation": dict}  # {interface: count} for the container user
 
-    def __init__(self, container_config, *args, **kwargs):
+    def __init__(self, container_config, force=False, lxc_usernet_file='/etc/lxc/lxc-usernet', usernet_db=None, *args, **kwargs):
         self.config = container_config
+        self.force = force
         self.container_name = self.config.name
         self.username = self.config['username']
-        self.usernet_allocation = self.config['usernet_allocation']
+        self.usernet_allocation = self.config.get('usernet_allocation', {})
+        self.lxc_usernet_file = Path(lxc_usernet_file)
+        # Usernet DB shared by all containers in a run, so the file is read and written once
+        self.usernet_db = usernet_db or UsernetDB(self.lxc_usernet_file, logger=self.logger)
 
+    @traced("user_prepare")
     def prepare(self):
         """
         Run preparation actions, such as creating the user and usernet entries
@@ -47,73 +80,24 @@ class UserManager:
             return False
 
         self.logger.info("Creating user: %s" % self.username)
-
-        user_cmd = run(['useradd', '--create-home', '--groups', 'lxc', self.username], capture_output=True)
-        self.logger.debug("[%s] Useradd output: %s" % (self.username, user_cmd.stdout.decode('utf-8')))
-
-        if user_cmd.returncode != 0:
-            raise RuntimeError("Failed to create user: %s; Error: %s" % (self.username, user_cmd.stderr.decode('utf-8')))
+        output = useradd(self.username)
+        self.logger.debug("[%s] Useradd output: %s" % (self.username, output))
 
     def create_container_home(self):
         """Creates LXC folders for the container user.
         Owns the folders to the container user if necessary."""
-        user_home = Path(getpwnam(self.username).pw_dir)
-        path_parts = ['.local', 'share', 'lxc', self.container_name]
-        lxc_dir = user_home
-
-        for part in path_parts:
-            lxc_dir = lxc_dir.joinpath(part)
-            if not lxc_dir.exists():
-                self.logger.info("[%s] Creating LXC directory: %s" % (self.username, lxc_dir))
-                mkdir(lxc_dir)
-            else:
-                self.logger.debug("[%s] LXC directory already exists: %s" % (self.username, lxc_dir))
-
-            uid = getpwnam(self.username).pw_uid
-            gid = getpwnam(self.username).pw_gid
-            if lxc_dir.stat().st_uid != uid or lxc_dir.stat().st_gid != gid:
-                self.logger.warning("[%s] Incorrect ownership of LXC directory: %s" % (self.username, lxc_dir))
-                chown(lxc_dir, uid, gid)
-                self.logger.info("[%s] Setting ownership of LXC directory: %s" % (self.username, lxc_dir))
-            else:
-                self.logger.debug("[%s] Correct ownership already exists on LXC directory: %s" % (self.username, lxc_dir))
-
-    def parse_usernet_user(self):
-        """Checks /etc/lxc/lxc-usernet for an existing usernets entry.
-        Returns a list containing the usernet interface and count as strings packed into a list.
-        """
-        usernet_entries = {}
-        try:
-            with open(self.lxc_usernet_file, 'r') as usernet:
-                for line in usernet.readlines():
-                    user, interface_type, interface_name, count = line.split()
-                    if user == self.username and interface_type == 'veth':
-                        usernet_entries[interface_name] = int(count)
-        except FileNotFoundError:
-            raise FileNotFoundError("Usernet file does not exist: %s" % self.lxc_usernet_file)
-        except ValueError:
-            if line.startswith('#'):
-                self.logger.log(5, "Skipping commented line: %s" % line)
-            elif line == '\n':
-                self.logger.log(5, "Skipping empty line")
-            else:
-                raise ValueError("Invalid usernet entry: %s" % line)
-
-        self.logger.log(5, "Existing usernet entries for %s: %s" % (self.username, usernet_entries))
-        return usernet_entries
-
-    def create_usernet_file(self):
-        """Creates an empty usernet file with 0644 permissions."""
-        if self.lxc_usernet_file.exists():
-            self.logger.warning("[%s] Usernet file already exists: %s" % (self.username, self.lxc_usernet_file))
-            if self.force:
-                self.logger.info("[%s] Forcing usernet file creation: %s" % (self.username, self.lxc_usernet_file))
-            else:
-                return False
-
-        self.logger.info("[%s] Creating usernet file: %s" % (self.username, self.lxc_usernet_file))
-        self.lxc_usernet_file.touch()
-        chmod(self.lxc_usernet_file, 0o644)
+        user = getpwnam(self.username)
+        lxc_dir = Path(user.pw_dir)
+
+        for part in [*LXC_PATH_PARTS, self.container_name]:
+            lxc_dir = lxc_dir / part
+            match ensure_dir(lxc_dir, user.pw_uid, user.pw_gid):
+                case 'created':
+                    self.logger.info("[%s] Created LXC directory: %s" % (self.username, lxc_dir))
+                case 'chowned':
+                    self.logger.warning("[%s] Fixed incorrect ownership of LXC directory: %s" % (self.username, lxc_dir))
+                case 'correct':
+                    self.logger.debug("[%s] LXC directory already exists with correct ownership: %s" % (self.username, lxc_dir))
 
     def prepare_usernets(self):
         """Prepares the usernet for the specified container"""
@@ -121,42 +105,90 @@ class UserManager:
             self.logger.warning("No usernet allocation specified for user: %s" % self.username)
             return False
 
-        if not self.lxc_usernet_file.exists():
-            self.logger.warning("[%s] Usernet file does not exist: %s" % (self.username, self.lxc_usernet_file))
-            self.create_usernet_file()
-
-        self.add_usernet_entries()
+        with self.usernet_db:
+            self.add_usernet_entries()
 
     def add_usernet_entries(self):
-        """Iterates over self.usernet_allocation {interface: count} and adds them to the usernet file."""
-        existing_usernets = self.parse_usernet_user()
-
+        """Iterates over self.usernet_allocation {interface: count} and adds them to the usernet DB."""
         for interface, count in self.usernet_allocation.items():
             self.logger.debug("[%s] Considering usernet entry: %s - %s" % (self.username, interface, count))
-            if interface in existing_usernets and existing_usernets[interface] != count:
-                self.logger.warning("[%s] Usernet '%s' already exists with a different allocation: %s != %s" % (self.username, interface, existing_usernets[interface], count))
+            existing_count = self.usernet_db.get(self.username, 'veth', interface)
+            if existing_count is None:
+                self.usernet_db.set(self.username, 'veth', interface, count)
+                self.logger.info("[%s] Added usernet entry: %s %s" % (self.username, interface, count))
+            elif existing_count != count:
+                self.logger.warning("[%s] Usernet '%s' already exists with a different allocation: %s != %s" % (self.username, interface, existing_count, count))
                 if self.force:
                     self.logger.info("Forcing usernet entry for user %s, %s: %s" % (self.username, interface, count))
-                    old_usernet_string = f"{self.username} veth {interface} {existing_usernets[interface]}\n"
-                    new_usernet_string = f"{self.username} veth {interface} {count}\n"
-                    replace_file_line(self.lxc_usernet_file, old_usernet_string, new_usernet_string)
-            elif interface in existing_usernets and existing_usernets[interface] == count:
-                self.logger.debug("[%s] Usernet '%s' already exists with the same allocation: %s" % (self.username, interface, count))
+                    self.usernet_db.set(self.username, 'veth', interface, count)
             else:
-                self.add_usernet_entry(interface, count)
+                self.logger.debug("[%s] Usernet '%s' already exists with the same allocation: %s" % (self.username, interface, count))
+
 
-    def add_usernet_entry(self, interface, count):
+@loggify
+class UserProvisioner:
+    """Prepares the users, LXC directories and usernets for many containers in one pass."""
+
+    def __init__(self, container_configs, force=False, lxc_usernet_file='/etc/lxc/lxc-usernet', usernet_db=None, *args, **kwargs):
+        self.container_configs = [config for config in container_configs if 'username' in config]
+        self.force = force
+        self.lxc_usernet_file = Path(lxc_usernet_file)
+        self.usernet_db = usernet_db or UsernetDB(self.lxc_usernet_file, logger=self.logger)
+        self.report = {'users_created': [], 'users_existing': [],
+                       'dirs_created': [], 'dirs_chowned': [], 'dirs_correct': []}
+
+    @traced("user_provision")
+    def prepare(self):
         """
-        Adds the specified usernet entry to the usernet file.
+        Prepares all container users.
+        The passwd database is read once, only missing users are created.
+        Shared LXC directories are only checked once per user.
+        Returns a report of what was created, fixed, or already correct.
         """
-        if interface in self.parse_usernet_user():
-            raise RuntimeError("Usernet entry already exists: %s" % interface)
-
-        usernet_entry = f"{self.username} veth {interface} {count}\n"
-        with open(self.lxc_usernet_file, 'a') as f:
-            f.write(usernet_entry)
-
-        self.logger.info("[%s] Added usernet entry: %s" % (self.username, usernet_entry.strip()))
-
-
-
+        passwd = self.create_users()
+        self.create_container_homes(passwd)
+
+        with self.usernet_db:
+            for config in self.container_configs:
+                user = UserManager(config, force=self.force, lxc_usernet_file=self.lxc_usernet_file,
+                                   usernet_db=self.usernet_db, logger=self.logger)
+                if user.usernet_allocation:
+                    user.add_usernet_entries()
+
+        self.logger.info("Prepared %d containers, created users: %s; created directories: %d; fixed directories: %d; correct directories: %d"
+                         % (len(self.container_configs), self.report['users_created'] or None, len(self.report['dirs_created']),
+                            len(self.report['dirs_chowned']), len(self.report['dirs_correct'])))
+        return self.report
+
+    def create_users(self):
+        """Creates all missing users, returns the passwd database as {username: pwd entry}"""
+        passwd = {user.pw_name: user for user in getpwall()}
+        usernames = sorted({config['username'] for config in self.container_configs})
+        for username in usernames:
+            if username in passwd:
+                self.report['users_existing'].append(username)
+                continue
+
+            self.logger.info("Creating user: %s" % username)
+            output = useradd(username)
+            self.logger.debug("[%s] Useradd output: %s" % (username, output))
+            self.report['users_created'].append(username)
+
+        if self.report['users_created']:  # Read the passwd database again to get the new users
+            passwd = {user.pw_name: user for user in getpwall()}
+        return passwd
+
+    def create_container_homes(self, passwd):
+        """Creates the LXC directories for all containers, each directory is only checked once."""
+        checked_dirs = set()
+        for config in self.container_configs:
+            user = passwd[config['username']]
+            lxc_dir = Path(user.pw_dir)
+            for part in [*LXC_PATH_PARTS, config.name]:
+                lxc_dir = lxc_dir / part
+                if lxc_dir in checked_dirs:
+                    continue
+                checked_dirs.add(lxc_dir)
+                result = ensure_dir(lxc_dir, user.pw_uid, user.pw_gid)
+                self.report['dirs_%s' % result].append(str(lxc_dir))
+                self.logger.debug("[%s] LXC directory %s: %s" % (user.pw_name, result, lxc_dir))
@@ -0,0 +1,134 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from os import scandir
+from pathlib import Path
+from re import compile
+
+from zenlib.logging import loggify
+
+from gentainer.package_index import is_plain_atom
+
+# Matches the version at the end of a package directory name, such as glibc-2.38-r10
+PF_VERSION = compile(r"-(\d+(\.\d+)*[a-z]?(_(alpha|beta|pre|rc|p)\d*)*(-r\d+)?)$")
+VDB_PATH = Path("var", "db", "pkg")
+
+
+def get_cp(cpv):
+    """Gets the category/package of a category/package-version"""
+    return cpv[: PF_VERSION.search(cpv).start()]
+
+
+def read_vdb_file(package_dir, name):
+    """Reads a file from a VDB package dir, returns an empty string if it does not exist"""
+    try:
+        return (package_dir / name).read_text().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def get_installed_size(root, cpvs):
+    """Gets the total installed bytes of package versions in the VDB of a root"""
+    return sum(int(read_vdb_file(Path(root) / VDB_PATH / cpv, "SIZE") or 0) for cpv in cpvs)
+
+
+@loggify
+class VDBIndex:
+    """
+    Index of the packages installed in a root, read once from its VDB (var/db/pkg).
+
+    Used to find packages which are already installed with the USE flags they would be built with,
+    so they don't need to be passed to emerge.
+    """
+
+    def __init__(self, root, *args, **kwargs):
+        self.root = Path(root)
+        self.packages = {}  # {category/package: [{"cpv", "slot", "use", "iuse", "repository", "size"}]}
+        self.settings = None  # Portage config, loaded to check the configured USE of installed packages
+        self.load()
+
+    def load(self):
+        """Reads the VDB of the root"""
+        vdb_dir = self.root / VDB_PATH
+        if not vdb_dir.is_dir():
+            self.logger.debug("No installed packages in: %s" % self.root)
+            return
+
+        with scandir(vdb_dir) as categories:
+            for category in categories:
+                if not category.is_dir(follow_symlinks=False):
+                    continue
+                with scandir(category.path) as package_dirs:
+                    for package_dir in package_dirs:
+                        if package_dir.name.startswith("-MERGING-") or not PF_VERSION.search(package_dir.name):
+                            continue
+                        self.add_package("%s/%s" % (category.name, package_dir.name), Path(package_dir.path))
+
+        self.logger.info("Indexed %d installed packages in: %s" % (len(self.packages), self.root))
+
+    def add_package(self, cpv, package_dir):
+        """Adds an installed package from its VDB dir"""
+        self.packages.setdefault(get_cp(cpv), []).append(
+            {
+                "cpv": cpv,
+                "slot": read_vdb_file(package_dir, "SLOT").split("/")[0] or "0",
+                "use": set(read_vdb_file(package_dir, "USE").split()),
+                "iuse": {flag.lstrip("+-") for flag in read_vdb_file(package_dir, "IUSE").split()},
+                "repository": read_vdb_file(package_dir, "repository"),
+                "size": int(read_vdb_file(package_dir, "SIZE") or 0),  # Installed bytes
+            }
+        )
+
+    def match(self, atom):
+        """Gets the installed packages matching an atom, including its slot, repository and USE dependencies"""
+        if is_plain_atom(atom):
+            return self.packages.get(atom, [])
+
+        from portage.dep import Atom, match_from_list
+
+        atom = Atom(atom)
+        installed = {package["cpv"]: package for package in self.packages.get(atom.cp, [])}
+        matches = []
+        for cpv in match_from_list(atom.without_use.without_repo.without_slot, list(installed)):
+            package = installed[cpv]
+            if atom.slot and atom.slot != package["slot"]:
+                continue
+            if atom.repo and atom.repo != package["repository"]:
+                continue
+            if atom.use and not (atom.use.enabled <= package["use"] and not atom.use.disabled & package["use"]):
+                continue
+            matches.append(package)
+        return matches
+
+    def get_configured_use(self, cpv):
+        """Gets the USE flags a package would be built with using the current portage config,
+        or None if the package is not in the portage tree."""
+        import portage
+
+        if self.settings is None:
+            self.settings = portage.config(clone=portage.settings)
+        portdb = portage.db[portage.root]["porttree"].dbapi
+        if not portdb.cpv_exists(cpv):
+            return None
+        self.settings.setcpv(cpv, mydb=portdb)
+        return set(self.settings["PORTAGE_USE"].split())
+
+    def is_satisfied(self, atom):
+        """Checks if an atom is installed, with the USE flags it would be built with now"""
+        if atom[:1] in "!@":  # Blockers and sets are always passed to emerge
+            return False
+
+        for package in self.match(atom):
+            configured_use = self.get_configured_use(package["cpv"])
+            if configured_use is None:
+                self.logger.debug("Installed package is not in the portage tree: %s" % package["cpv"])
+                continue
+            if configured_use & package["iuse"] == package["use"] & package["iuse"]:
+                return True
+            self.logger.info("USE flags changed for installed package: %s" % package["cpv"])
+        return False
+
+    def filter_installed(self, packages):
+        """Returns the packages which are not already installed with matching USE flags"""
+        return [package for package in packages if not self.is_satisfied(package)]
@@ -0,0 +1,189 @@
+__author__ = "desultory"
+__version__ = "0.1.0"
+
+
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import close, read, strerror
+from pathlib import Path
+from select import POLLIN, poll
+from struct import calcsize, unpack_from
+from time import monotonic
+
+from zenlib.logging import loggify
+
+from gentainer.scheduler import BuildScheduler
+from gentainer.tracing import tracer
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = "iIII"  # struct inotify_event: wd, mask, cookie, len, followed by the name
+EVENT_HEADER_SIZE = calcsize(EVENT_HEADER)
+
+
+class Inotify:
+    """Minimal inotify binding using ctypes"""
+
+    def __init__(self):
+        self.libc = CDLL(find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), "inotify_init1 failed: %s" % strerror(get_errno()))
+        self.watches = {}  # {watch descriptor: directory}
+        self.poller = poll()
+        self.poller.register(self.fd, POLLIN)
+
+    def add_watch(self, directory, mask=WATCH_MASK):
+        """Watches a directory"""
+        wd = self.libc.inotify_add_watch(self.fd, str(directory).encode(), mask)
+        if wd < 0:
+            raise OSError(get_errno(), "Unable to watch '%s': %s" % (directory, strerror(get_errno())))
+        self.watches[wd] = Path(directory)
+
+    def read_events(self, timeout=None):
+        """Waits up to timeout seconds for events, returns a list of (path, mask).
+        An overflow is returned as (None, IN_Q_OVERFLOW)."""
+        if not self.poller.poll(None if timeout is None else timeout * 1000):
+            return []
+
+        events = []
+        try:
+            data = read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = unpack_from(EVENT_HEADER, data, offset)
+            name = data[offset + EVENT_HEADER_SIZE : offset + EVENT_HEADER_SIZE + name_length].rstrip(b"\0").decode()
+            offset += EVENT_HEADER_SIZE + name_length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self.watches:
+                events.append((self.watches[wd] / name if name else self.watches[wd], mask))
+        return events
+
+    def close(self):
+        self.poller.unregister(self.fd)
+        close(self.fd)
+
+
+@loggify
+class ConfigWatcher:
+    """
+    Watches the container config dir, network config and portage timestamp, and applies changes as they happen.
+
+    Events are debounced, changes are applied once no events have arrived for the debounce period.
+    Only changed container configs are reloaded. Changed containers are prepared again,
+    and their layers and all descendant layers are rebuilt if they were built before.
+    Network config changes are reconciled, a portage timestamp change rebuilds every built layer whose digest changed.
+    """
+
+    def __init__(self, gentainer, debounce=1.0, *args, **kwargs):
+        self.gentainer = gentainer
+        self.debounce = debounce
+        self.network_config_file = Path(gentainer.host_network.config_file).resolve()
+        self.timestamp_file = Path(gentainer.portage_timestamp_file).resolve()
+        self.config_dir = Path(gentainer.config_dir).resolve()
+
+    def watch_paths(self, inotify):
+        """Adds watches for the config dir, and the directories of the network config and timestamp file.
+        Directories are watched, since editors and portage replace files."""
+        for directory in {self.config_dir, self.network_config_file.parent, self.timestamp_file.parent}:
+            self.logger.info("Watching: %s" % directory)
+            inotify.add_watch(directory)
+
+    def wait_for_changes(self, inotify):
+        """Waits for relevant events, then until no events arrive for the debounce period.
+        Returns the set of changed paths, or None if events were lost and everything must be checked."""
+        changed = set()
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - monotonic(), 0)
+            events = inotify.read_events(timeout)
+            if not events and deadline is not None and monotonic() >= deadline:
+                return changed
+            for path, mask in events:
+                if path is None:
+                    self.logger.warning("Inotify queue overflowed, reloading everything")
+                    changed = None
+                elif changed is not None and self.is_relevant(path):
+                    self.logger.debug("Changed: %s" % path)
+                    changed.add(path)
+                else:
+                    continue
+                deadline = monotonic() + self.debounce
+
+    def is_relevant(self, path):
+        """Checks if a path is a container config, the network config or the portage timestamp"""
+        return (path.parent == self.config_dir and path.suffix == ".toml") or path in (
+            self.network_config_file,
+            self.timestamp_file,
+        )
+
+    def get_descendants(self, containers):
+        """Gets containers and every container built on them"""
+        scheduler = BuildScheduler(self.gentainer.containers, None, logger=self.logger)
+        children = scheduler.get_children(scheduler.resolve(self.gentainer.containers))
+        descendants, pending = set(), [container for container in containers if container in children]
+        while pending:
+            container = pending.pop()
+            if container not in descendants:
+                descendants.add(container)
+                pending.extend(children[container])
+        return descendants
+
+    def apply_changes(self, changed):
+        """Reloads changed configs, then prepares and rebuilds the affected containers"""
+        gentainer = self.gentainer
+        if changed is None:
+            changed_containers = gentainer.reload()
+            changed = {self.network_config_file, self.timestamp_file}
+        else:
+            config_files = [path for path in changed if path.parent == self.config_dir]
+            changed_containers = gentainer.reload_config_files(config_files) if config_files else []
+
+        if self.network_config_file in changed:
+            gentainer.reload_network()
+
+        built = set(gentainer.layer_manifest.layers)
+        new_containers = [name for name in changed_containers if name in gentainer.containers and name not in built]
+        if self.timestamp_file in changed:
+            self.logger.info("Portage tree changed, checking all built layers")
+            gentainer.invalidate_digests()
+            affected = set(gentainer.containers)
+        else:
+            affected = self.get_descendants([name for name in changed_containers if name in gentainer.containers])
+
+        targets = sorted(name for name in affected if name in built or name in new_containers)
+        prepare = sorted(name for name in changed_containers if name in gentainer.containers)
+        if prepare:
+            self.logger.info("Preparing changed containers: %s" % ", ".join(prepare))
+            gentainer.prepare_all(prepare)
+        if targets:
+            self.logger.info("Rebuilding affected layers: %s" % ", ".join(targets))
+            gentainer.build_all(targets)
+
+    def run(self):
+        """Watches for changes until interrupted"""
+        inotify = Inotify()
+        try:
+            self.watch_paths(inotify)
+            while True:
+                changed = self.wait_for_changes(inotify)
+                try:
+                    with tracer.span("watch_apply"):
+                        self.apply_changes(changed)
+                except Exception as e:
+                    self.logger.error("Failed to apply changes: %s" % e)
+        except KeyboardInterrupt:
+            self.logger.info("Stopped watching")
+        finally:
+            inotify.close()
@@ -0,0 +1,35 @@
+"""
+Tests run gentainer against the fake executables and in-memory netlink backend of the benchmark harness.
+"""
+
+import sys
+from os import environ, pathsep
+from pathlib import Path
+
+import pytest
+
+BENCH_DIR = Path(__file__).resolve().parent.parent / "bench"
+sys.path.insert(0, str(BENCH_DIR))
+
+from harness import FakeIPRoute, install_fake_passwd, install_fake_use_config, write_environment  # noqa: E402
+
+from gentainer.nets import NetlinkSession  # noqa: E402
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    """Writes a config with two containers sharing a bridge, returns (config_file, ip_route, netlink).
+    net_reconcile is disabled, as in the example config."""
+    config_file = write_environment(tmp_path, containers=2, depth=2, users=1, bridges=1, jobs=2)
+    config_file.write_text(config_file.read_text().replace("net_reconcile = true", "net_reconcile = false"))
+
+    monkeypatch.setenv("PATH", str(BENCH_DIR / "fakes") + pathsep + environ.get("PATH", ""))
+    monkeypatch.setenv("FAKE_PASSWD", str(tmp_path / "passwd"))
+    monkeypatch.setenv("FAKE_HOME_DIR", str(tmp_path / "home"))
+    monkeypatch.setenv("FAKE_EMERGE_DELAY", "0")
+    monkeypatch.setenv("FAKE_FETCH_DELAY", "0")
+    install_fake_passwd(tmp_path / "passwd")
+    install_fake_use_config()
+
+    ip_route = FakeIPRoute()
+    return config_file, ip_route, NetlinkSession(backend=lambda: ip_route)
@@ -0,0 +1,42 @@
+from os import utime
+
+import pytest
+
+from gentainer.binpkgs import BinpkgPool, parse_size
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    """A pool with three 1KiB binary packages, oldest first, limited to 2KiB"""
+    monkeypatch.setattr(BinpkgPool, "get_key", lambda self: "key")
+    monkeypatch.setattr(BinpkgPool, "fix_index", lambda self, pkgdir: self.fixed.append(pkgdir))
+    pool = BinpkgPool(tmp_path, max_size="2K")
+    pool.fixed = []
+    (pool.get_pkgdir() / "app-misc").mkdir(parents=True)
+    (pool.pkgdir / "Packages").write_text("index\n")
+    for age, pf in enumerate(["c-1.0", "b-1.0", "a-1.0"]):
+        package_file = pool.pkgdir / "app-misc" / ("%s.gpkg.tar" % pf)
+        package_file.write_bytes(bytes(1024))
+        utime(package_file, (1000 - age * 100, 1000 - age * 100))
+    return pool
+
+
+def test_parse_size():
+    assert parse_size("20G") == 20 << 30
+    assert parse_size("512MB") == 512 << 20
+    assert parse_size(1024) == 1024
+
+
+def test_evict_least_recently_used(pool):
+    evicted = pool.evict()
+    assert [package_file.name for package_file in evicted] == ["a-1.0.gpkg.tar", "b-1.0.gpkg.tar"]
+    assert (pool.pkgdir / "app-misc" / "c-1.0.gpkg.tar").exists()
+    assert (pool.pkgdir / "Packages").exists()
+    assert pool.fixed == [pool.pkgdir]
+
+
+def test_used_packages_are_evicted_last(pool):
+    pool.record_build("app", ["app-misc/a-1.0"], [])
+    evicted = pool.evict()
+    assert [package_file.name for package_file in evicted] == ["b-1.0.gpkg.tar", "c-1.0.gpkg.tar"]
+    assert (pool.pkgdir / "app-misc" / "a-1.0.gpkg.tar").exists()
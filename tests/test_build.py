@@ -0,0 +1,27 @@
+import pytest
+
+from gentainer import Gentainer, gentainer as gentainer_module
+
+
+def test_rebuild_with_networks_is_noop(environment, monkeypatch):
+    """A second build of containers with networks, in a new run, does not touch interfaces or layers"""
+    config_file, ip_route, netlink = environment
+    Gentainer(config=str(config_file), netlink=netlink).build_all()
+    links = {index: {**link, "addresses": set(link["addresses"])} for index, link in ip_route.links.items()}
+    assert [link["name"] for link in links.values()] == ["benchbr0"]
+
+    def fail_build(*args, **kwargs):
+        pytest.fail("Layer was rebuilt")
+
+    monkeypatch.setattr(gentainer_module, "Builder", fail_build)
+    Gentainer(config=str(config_file), netlink=netlink).build_all()
+    assert ip_route.links == links
+
+
+def test_benchmark_harness(tmp_path, environment):
+    """The benchmark harness runs against the fakes, reading the link table once"""
+    from harness import run_benchmark
+
+    (tmp_path / "bench").mkdir()
+    results = run_benchmark(tmp_path / "bench", containers=4, depth=2, users=2, bridges=2, jobs=2)
+    assert results["containers"] == 4 and results["link_dumps"] == 1
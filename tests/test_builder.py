@@ -0,0 +1,65 @@
+from os import environ, pathsep
+
+import pytest
+
+from gentainer import Gentainer
+from gentainer.builder import Builder
+
+EMERGE_OUTPUT = """\
+>>> Emerging binary (1 of 2) app-misc/a-1.0::gentoo
+>>> Completed (1 of 2) app-misc/a-1.0::gentoo
+>>> Emerging (2 of 2) app-misc/b-1.0::gentoo
+>>> Completed (2 of 2) app-misc/b-1.0::gentoo
+"""
+
+
+@pytest.fixture
+def emerge(tmp_path, monkeypatch):
+    """Installs a fake emerge which prints FAKE_OUTPUT and exits with FAKE_STATUS"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "emerge").write_text('#!/bin/sh\nprintf "%s" "$FAKE_OUTPUT"\nexit "${FAKE_STATUS:-0}"\n')
+    (bin_dir / "emerge").chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + pathsep + environ.get("PATH", ""))
+    monkeypatch.setenv("FAKE_OUTPUT", EMERGE_OUTPUT)
+    (tmp_path / "root").mkdir()
+    return monkeypatch
+
+
+def test_output_lines_are_parsed_into_results():
+    builder = Builder("app", "/nonexistent", [])
+    for line in EMERGE_OUTPUT.splitlines() + [">>> Failed to emerge app-misc/c-1.0, Log file:", "noise"]:
+        builder.handle_output_line(line)
+
+    assert builder.binpkg_hits == ["app-misc/a-1.0"] and builder.binpkg_misses == ["app-misc/b-1.0"]
+    assert [(result["cpv"], result["status"]) for result in builder.package_results] == [
+        ("app-misc/a-1.0", "complete"),
+        ("app-misc/b-1.0", "complete"),
+        ("app-misc/c-1.0", "failed"),
+    ]
+    assert builder.package_results[0]["binary"] and not builder.package_results[1]["binary"]
+
+
+def test_build_streams_output_to_log(tmp_path, emerge):
+    builder = Builder("app", tmp_path / "root", ["app-misc/b"], log_dir=tmp_path / "logs")
+    builder.build()
+    assert builder.binpkg_hits == ["app-misc/a-1.0"]
+    assert (tmp_path / "logs" / "app.log").read_text().count(">>> Completed") == 2
+
+
+def test_failed_build_reports_output_tail(tmp_path, emerge):
+    emerge.setenv("FAKE_OUTPUT", "".join("line %d\n" % i for i in range(200)))
+    emerge.setenv("FAKE_STATUS", "1")
+    with pytest.raises(RuntimeError, match="exit code 1") as error:
+        Builder("app", tmp_path / "root", ["app-misc/b"]).build()
+    assert "line 199" in str(error.value) and "line 99\n" not in str(error.value)
+
+
+def test_skipped_packages_are_added_to_world(environment):
+    """Packages skipped because the base layer installed them are recorded in the world file of the layer"""
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+
+    world_file = gentainer.get_layer("container_1").layer_dir / "var" / "lib" / "portage" / "world"
+    assert world_file.read_text().split() == ["app-misc/bench"]
@@ -0,0 +1,72 @@
+from os import utime
+
+from gentainer.config_cache import ConfigCache, get_cache_file, read_config_files
+from gentainer.container_config import read_config_file
+
+CONFIG = 'packages = ["app-misc/bench"]\n'
+
+
+def write_cache(cache_file, config_file, signature="signature"):
+    cache = ConfigCache(cache_file, signature)
+    cache.set(config_file, *read_config_file(config_file))
+    cache.save()
+
+
+def test_cached_config_is_used_while_unchanged(tmp_path):
+    config_file = tmp_path / "container.toml"
+    config_file.write_text(CONFIG)
+    write_cache(tmp_path / "cache.json", config_file)
+    assert ConfigCache(tmp_path / "cache.json", "signature").get(config_file) == {"packages": ["app-misc/bench"]}
+
+    stat = config_file.stat()
+    utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    cache = ConfigCache(tmp_path / "cache.json", "signature")
+    assert cache.get(config_file) == {"packages": ["app-misc/bench"]}
+    assert cache.changed  # The new mtime is saved, so the file is not hashed again
+
+    config_file.write_text(CONFIG.replace("bench", "other"))
+    assert ConfigCache(tmp_path / "cache.json", "signature").get(config_file) is None
+
+
+def test_signature_change_drops_cache(tmp_path):
+    config_file = tmp_path / "container.toml"
+    config_file.write_text(CONFIG)
+    write_cache(tmp_path / "cache.json", config_file)
+    assert ConfigCache(tmp_path / "cache.json", "new_signature").get(config_file) is None
+
+
+def test_prune_removes_deleted_configs(tmp_path):
+    config_files = [tmp_path / ("container_%d.toml" % index) for index in range(2)]
+    cache = ConfigCache(tmp_path / "cache.json", "signature")
+    for config_file in config_files:
+        config_file.write_text(CONFIG)
+        cache.set(config_file, *read_config_file(config_file))
+    cache.prune(config_files[:1])
+    assert list(cache.entries) == [str(config_files[0])]
+
+
+def test_parallel_load_matches_serial_load(tmp_path):
+    config_files = []
+    for index in range(20):
+        config_files.append(tmp_path / ("container_%d.toml" % index))
+        config_files[-1].write_text('packages = ["app-misc/package_%d"]\n' % index)
+    assert read_config_files(config_files, workers=2) == read_config_files(config_files, workers=1)
+
+
+def test_config_dirs_have_separate_caches(tmp_path):
+    """Config dirs sharing a cache_dir don't prune each other's entries"""
+    caches = {}
+    for name in ["first", "second"]:
+        config_file = tmp_path / name / "container.toml"
+        config_file.parent.mkdir()
+        config_file.write_text('packages = ["app-misc/bench"]\n')
+        stat = config_file.stat()
+        cache = ConfigCache(get_cache_file(tmp_path / "cache", config_file.parent), "signature")
+        cache.set(config_file, {"packages": ["app-misc/bench"]}, {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size})
+        cache.prune([config_file])
+        cache.save()
+        caches[config_file] = cache.cache_file
+
+    assert len(set(caches.values())) == 2
+    for config_file, cache_file in caches.items():
+        assert ConfigCache(cache_file, "signature").get(config_file) == {"packages": ["app-misc/bench"]}
@@ -0,0 +1,140 @@
+from threading import Thread
+
+import pytest
+
+from gentainer import Gentainer
+from gentainer import main as main_module
+from gentainer.daemon import ConfigMismatchError, GentainerDaemon, SharedLock, send_request
+from gentainer.main import process_daemon_request
+
+
+@pytest.fixture
+def daemon(environment):
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    return GentainerDaemon(gentainer, socket_path=config_file.parent / "gentainer.sock")
+
+
+def test_shared_lock_waits_for_exclusive_holder():
+    lock, order = SharedLock(), []
+
+    def hold_exclusive():
+        with lock.hold_exclusive():
+            order.append("exclusive")
+
+    with lock.hold_shared(), lock.hold_shared():
+        assert lock.shared == 2
+        exclusive = Thread(target=hold_exclusive)
+        exclusive.start()
+        while not lock.exclusive_waiting:
+            pass
+        order.append("shared")
+    exclusive.join()
+    assert order == ["shared", "exclusive"]
+    assert (lock.shared, lock.exclusive, lock.exclusive_waiting) == (0, False, 0)
+
+
+def test_lock_keys(daemon):
+    assert daemon.get_lock_keys("build", "container_1") == [("container", "container_0"), ("container", "container_1")]
+    assert daemon.get_lock_keys("net_prepare", "benchbr0") == [("interface", "benchbr0")]
+    assert daemon.get_lock_keys("list", None) == []
+    with pytest.raises(KeyError):
+        daemon.get_lock_keys("build", "missing")
+
+
+def test_requests_for_other_configs_fail(daemon, tmp_path):
+    with pytest.raises(ConfigMismatchError, match="different config"):
+        daemon.handle_request({"action": "ping", "config": str(tmp_path / "other.toml")})
+
+
+def test_links_are_read_for_each_request(daemon, environment):
+    """Interfaces removed outside the daemon are recreated by the next request"""
+    config_file, ip_route, netlink = environment
+    daemon.handle_request({"action": "net_prepare", "container_name": "benchbr0", "config": str(config_file)})
+    assert [link["name"] for link in ip_route.links.values()] == ["benchbr0"]
+
+    ip_route.links.clear()  # Deleted with another tool
+    daemon.handle_request({"action": "net_prepare", "container_name": "benchbr0", "config": str(config_file)})
+    assert [link["name"] for link in ip_route.links.values()] == ["benchbr0"]
+
+
+def test_gc_dry_run(daemon):
+    """gc with dry_run lists unreferenced layers without deleting them"""
+    config_file = daemon.gentainer.config_file
+    daemon.gentainer.build_all()
+    orphan = daemon.gentainer.build_dir / "removed_container"
+    orphan.mkdir()
+
+    request = {"action": "gc", "config": str(config_file), "force": True, "dry_run": True}
+    response = daemon.handle_request(request)
+
+    assert response["result"]["deleted"] == [("layer", "removed_container")]
+    assert "would delete" in response["output"]
+    assert orphan.exists()
+    assert "container_0" in daemon.gentainer.layer_manifest.layers
+    assert not daemon.gentainer.force
+
+
+def test_serve(daemon, capsys):
+    server = Thread(target=daemon.serve)
+    server.start()
+    try:
+        while not daemon.socket_path.exists():
+            pass
+        assert send_request(daemon.socket_path, {"action": "ping"})["output"] == "pong"
+        response = send_request(daemon.socket_path, {"action": "build", "container_name": "missing"})
+        assert (response["status"], response["type"]) == ("error", "KeyError")
+
+        kwargs = {"action": "list", "socket": str(daemon.socket_path), "config": str(daemon.gentainer.config_file)}
+        assert process_daemon_request(kwargs)
+        assert "container_1" in capsys.readouterr().out
+    finally:
+        send_request(daemon.socket_path, {"action": "shutdown"})
+        server.join()
+    assert not daemon.socket_path.exists()
+
+
+def test_daemon_for_other_config(daemon, tmp_path):
+    """Actions for another config run in process, reload and shutdown fail"""
+    server = Thread(target=daemon.serve)
+    server.start()
+    try:
+        while not daemon.socket_path.exists():
+            pass
+        kwargs = {"socket": str(daemon.socket_path), "config": str(tmp_path / "other.toml")}
+        assert not process_daemon_request({"action": "list", **kwargs})
+        with pytest.raises(RuntimeError, match="different config"):
+            process_daemon_request({"action": "reload", **kwargs})
+    finally:
+        send_request(daemon.socket_path, {"action": "shutdown"})
+        server.join()
+
+
+def test_daemon_socket_permission_denied(tmp_path, monkeypatch):
+    """Users who can't open the daemon socket run actions in process"""
+
+    def deny(socket_path, request):
+        raise PermissionError(13, "Permission denied", str(socket_path))
+
+    monkeypatch.setattr(main_module, "send_request", deny)
+    assert not process_daemon_request({"action": "list", "socket": str(tmp_path / "gentainer.sock")})
+    with pytest.raises(RuntimeError, match="Permission denied"):
+        process_daemon_request({"action": "shutdown", "socket": str(tmp_path / "gentainer.sock")})
+
+
+def test_no_daemon(tmp_path):
+    """Actions run in process if no daemon is listening, reload and shutdown need a daemon"""
+    assert not process_daemon_request({"action": "list", "socket": str(tmp_path / "missing.sock")})
+    with pytest.raises(RuntimeError, match="No daemon"):
+        process_daemon_request({"action": "reload", "socket": str(tmp_path / "missing.sock")})
+
+
+def test_run_all_returns_report(daemon):
+    """The start latency report is returned as the output of run_all, so the client prints it"""
+    daemon.gentainer.build_all()
+
+    response = daemon.handle_request({"action": "run_all", "config": str(daemon.gentainer.config_file)})
+
+    assert response["status"] == "ok"
+    assert "Start ms" in response["output"]
+    assert "container_1" in response["output"]
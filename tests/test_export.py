@@ -0,0 +1,106 @@
+from subprocess import DEVNULL
+
+import pytest
+
+from gentainer import Gentainer, export
+from gentainer.export import LayerExporter, run_pipeline
+from gentainer.layers import Layers
+from gentainer.manifest import LayerManifest
+
+
+@pytest.fixture
+def dir_environment(environment):
+    """The test environment, using the dir backing so layers can be exported as tarballs"""
+    config_file, ip_route, netlink = environment
+    config_file.write_text(config_file.read_text() + '\ndir_back = "dir"\n')
+    return config_file, netlink
+
+
+def test_run_pipeline(tmp_path):
+    with open(tmp_path / "output", "wb") as output:
+        run_pipeline([["echo", "layer"], ["tr", "a-z", "A-Z"]], stdout=output)
+    assert (tmp_path / "output").read_text() == "LAYER\n"
+
+    with pytest.raises(RuntimeError, match="sh: broken"):
+        run_pipeline([["sh", "-c", "echo broken >&2; exit 1"], ["cat"]], stdout=DEVNULL)
+
+
+def test_btrfs_export_is_relative_to_base_snapshot(tmp_path, monkeypatch):
+    commands = []
+    monkeypatch.setattr(LayerExporter, "btrfs", lambda self, *args: commands.append(["btrfs", *map(str, args)]))
+    monkeypatch.setattr(export, "run_pipeline", lambda pipeline, **kwargs: commands.append(pipeline[0]))
+
+    exporter = LayerExporter(Layers("app", tmp_path, "btrfs", base_image="base"))
+    assert exporter.export_btrfs(tmp_path / "app.btrfs.zst") == "base"
+    snapshot_dir = tmp_path / ".snapshots"
+    assert commands == [
+        ["btrfs", "subvolume", "snapshot", "-r", str(tmp_path / "app"), str(snapshot_dir / "app")],
+        ["btrfs", "subvolume", "snapshot", "-r", str(tmp_path / "base"), str(snapshot_dir / "base")],
+        ["btrfs", "send", "-q", "-p", str(snapshot_dir / "base"), str(snapshot_dir / "app")],
+    ]
+
+
+def test_btrfs_snapshots_are_reused(tmp_path, environment, monkeypatch):
+    """Snapshots are only taken again when the layer is rebuilt, so exports of a layer share one parent snapshot"""
+    sends = []
+    monkeypatch.setattr(export, "run_pipeline", lambda pipeline, **kwargs: sends.append(pipeline[0]))
+    manifest = LayerManifest(tmp_path / "manifest.json")
+    for container in ["base", "app"]:
+        (tmp_path / container).mkdir()
+        (tmp_path / container / "file").write_text(container)
+        manifest.set(container, "%s-1" % container)
+
+    LayerExporter(Layers("app", tmp_path, "btrfs", base_image="base"), manifest=manifest).export_btrfs(tmp_path / "app.btrfs.zst")
+    base_snapshot = tmp_path / ".snapshots" / "base"
+    (base_snapshot / "marker").touch()
+    LayerExporter(Layers("base", tmp_path, "btrfs"), manifest=manifest).export_btrfs(tmp_path / "base.btrfs.zst")
+    assert (base_snapshot / "marker").exists()
+
+    manifest.set("base", "base-2")
+    LayerExporter(Layers("base", tmp_path, "btrfs"), manifest=manifest).export_btrfs(tmp_path / "base.btrfs.zst")
+    assert not (base_snapshot / "marker").exists()
+    assert (tmp_path / ".snapshots" / "base.digest").read_text() == "base-2"
+    assert sends[0][-3:] == ["-p", str(base_snapshot), str(tmp_path / ".snapshots" / "app")]
+
+
+def test_btrfs_import_needs_parent_snapshot(environment):
+    """Importing a btrfs layer fails before the layer is removed if the base image snapshot was never received"""
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink, force=True)
+    gentainer.build_all()
+    export_file = gentainer.export_dir / "container_1.btrfs.zst"
+    export_file.parent.mkdir(parents=True)
+    export_file.write_bytes(b"")
+    export_file.with_name(export_file.name + ".json").write_text('{"base_image": "container_0", "format": "btrfs"}')
+
+    with pytest.raises(FileNotFoundError, match="import or export the base image layer 'container_0' first"):
+        gentainer.import_layer("container_1", export_file)
+    assert gentainer.get_layer("container_1").layer_dir.exists()
+    assert "container_1" in gentainer.layer_manifest
+
+
+def test_export_import_round_trip(dir_environment):
+    config_file, netlink = dir_environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+    layer_dir = gentainer.get_layer("container_1").layer_dir
+    (layer_dir / "etc").mkdir(exist_ok=True)
+    (layer_dir / "etc" / "hostname").write_text("container_1\n")
+
+    export_info = gentainer.export_layer("container_1")
+    assert export_info["format"] == "tar" and export_info["digest"] == gentainer.layer_manifest.get("container_1")
+
+    gentainer = Gentainer(config=str(config_file), netlink=netlink, force=True)
+    gentainer.import_layer("container_1", gentainer.export_dir / "container_1.tar.zst")
+    assert (layer_dir / "etc" / "hostname").read_text() == "container_1\n"
+    assert gentainer.layer_manifest.get("container_1") == export_info["digest"]
+
+
+def test_import_checks_base_image(dir_environment):
+    config_file, netlink = dir_environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+    gentainer.export_layer("container_0")
+
+    with pytest.raises(ValueError, match="does not match"):
+        gentainer.import_layer("container_1", gentainer.export_dir / "container_0.tar.zst")
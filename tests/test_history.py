@@ -0,0 +1,96 @@
+from time import time
+
+from gentainer import Gentainer
+from gentainer.history import BuildHistory, format_duration
+from gentainer.scheduler import BuildScheduler
+
+CONTAINERS = {
+    "base": {},
+    "short": {"base_image": "base"},
+    "long": {"base_image": "base"},
+    "long_app": {"base_image": "long"},
+}
+
+
+def package_result(cpv, binary=False, duration=10.0, status="complete"):
+    return {"cpv": cpv, "binary": binary, "status": status, "duration": duration}
+
+
+def test_format_duration():
+    assert format_duration(5) == "5s"
+    assert format_duration(65) == "1m05s"
+    assert format_duration(3723) == "1h02m03s"
+
+
+def test_estimates_use_recent_successful_builds(tmp_path):
+    history = BuildHistory(tmp_path / "history.db", samples=2)
+    for started in [time() - 300, time() - 200, time() - 100]:
+        history.record_layer("app", "digest", started, "built")
+    history.record_layer("app", "digest", time(), "failed", error="emerge failed")
+    history.record_layer("other", "digest", time(), "failed")
+
+    estimates = history.get_estimates()
+    assert list(estimates) == ["app"]
+    assert 150 < estimates["app"] < 250  # Mean of the two most recent successful builds
+    assert history.get_estimates(["other"]) == {}
+
+
+def test_packages_and_stats_are_recorded(tmp_path):
+    history = BuildHistory(tmp_path / "history.db")
+    results = [
+        package_result("dev-lang/python-3.12", duration=60.0),
+        package_result("sys-libs/zlib-1.3", binary=True, duration=1.0),
+    ]
+    history.record_layer("app", "digest", time(), "built", size=2048, package_results=results)
+    history.record_layer("app", "digest", time(), "failed", error="emerge failed")
+
+    assert history.get_package_durations() == {"dev-lang/python": 60.0}
+    builds = history.get_builds("app")
+    assert [build["status"] for build in builds] == ["failed", "built"]
+    assert builds[1]["packages"] == 2 and builds[1]["binpkg_hits"] == 1
+
+    stats = history.get_stats()["app"]
+    assert stats["builds"] == 2 and stats["failures"] == 1
+    assert stats["size"] == 2048 and stats["binpkg_rate"] == 0.5
+
+
+def test_critical_path_is_started_first():
+    """With one job, the layer with the longest remaining chain is built before its sibling"""
+    scheduler = BuildScheduler(CONTAINERS, None, estimates={"base": 1, "short": 5, "long": 2, "long_app": 10})
+    graph = scheduler.resolve(["short", "long_app"])
+    paths = scheduler.get_critical_paths(graph, scheduler.get_children(graph))
+    assert paths == {"base": 13, "short": 5, "long": 12, "long_app": 10}
+    assert scheduler.get_build_order(graph) == ["base", "long", "long_app", "short"]
+
+
+def test_simulate_estimates_total_time():
+    scheduler = BuildScheduler(CONTAINERS, None, jobs=2, estimates={"base": 1, "short": 5, "long": 2, "long_app": 10})
+    times = scheduler.simulate(scheduler.resolve(["short", "long_app"]))
+    assert times == {"base": (0, 1), "long": (1, 3), "short": (1, 6), "long_app": (3, 13)}
+
+
+def test_builds_are_recorded_and_planned(environment):
+    config_file, ip_route, netlink = environment
+    Gentainer(config=str(config_file), netlink=netlink).build_all()
+
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    assert "container_0" in gentainer.format_stats()
+    assert [build["status"] for build in gentainer.get_history().get_builds()] == ["built", "built"]
+    plan = gentainer.get_plan()
+    assert "0 of 2 layers to build" in plan
+
+
+def test_history_action(environment, capsys):
+    """The history action prints recorded builds, directly and through the daemon"""
+    from gentainer.daemon import GentainerDaemon
+    from gentainer.main import process_args
+
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+    process_args({"action": "history", "container_name": None}, gentainer)
+    assert capsys.readouterr().out.count(" built ") == 2
+
+    daemon = GentainerDaemon(gentainer, socket_path=config_file.parent / "gentainer.sock")
+    response = daemon.handle_request({"action": "history", "container_name": "container_1", "config": str(config_file)})
+    assert "container_1" in response["output"] and "container_0" not in response["output"]
@@ -0,0 +1,49 @@
+from json import dumps, loads
+
+from gentainer.jobs import JobBudget
+
+
+def test_concurrent_shares_fit_budget():
+    """Builds which start while others are active don't take more than the unused jobs"""
+    budget = JobBudget(8, reserve=0)
+    first = budget.acquire("container_0")
+    second = budget.acquire("container_1")
+    assert (first, second) == (8, 1)
+
+    budget.release("container_0")
+    assert budget.acquire("container_2") == 4
+
+
+def test_reserve_leaves_room_for_later_builds():
+    """A build which starts alone leaves an even share for builds which start later"""
+    budget = JobBudget(8)
+    shares = [budget.acquire("container_%d" % index) for index in range(4)]
+    assert shares == [4, 2, 2, 1]
+    assert sum(shares[:3]) <= 8
+
+
+def test_parallel_builds_share_budget():
+    """Layers built in parallel by one run get even shares"""
+    budget = JobBudget(8, builds=3)
+    shares = [budget.acquire("container_%d" % index) for index in range(3)]
+    assert shares == [2, 2, 2]
+
+
+def test_state_file_is_shared(tmp_path):
+    """Builds in separate runs share the state file, builds of dead processes are ignored"""
+    state_file = tmp_path / "jobs.json"
+    state_file.write_text(dumps({"999999999:stale": 8}))
+    assert JobBudget(8, state_file=state_file).acquire("container_0") == 4
+    assert JobBudget(8, state_file=state_file).acquire("container_1") == 2
+    assert sorted(build.split(":")[1] for build in loads(state_file.read_text())) == ["container_0", "container_1"]
+
+    JobBudget(8, state_file=state_file).release("container_0")
+    assert JobBudget(8, state_file=state_file).acquire("container_2") == 2
+
+
+def test_share_is_split_between_emerge_and_make():
+    budget = JobBudget(16, load_average=12)
+    assert budget.split_share(16) == (4, 4)
+    assert budget.split_share(1) == (1, 1)
+    assert budget.get_emerge_args(8) == ["--jobs", "2", "--load-average", "12"]
+    assert budget.get_env(8, env={})["MAKEOPTS"] == "-j4 -l12"
@@ -0,0 +1,71 @@
+from os import link, utime
+
+import pytest
+
+from gentainer import Gentainer
+from gentainer.layer_gc import LayerGC, format_size
+
+OLD = 1 << 30  # mtime of layers outside the retention period
+
+
+@pytest.fixture
+def build_dir(tmp_path):
+    """A build dir with the layers of app and its base, and unreferenced old and new layers.
+    The overlay dir of the unreferenced 'lower' layer is used as a lower dir by app."""
+    build_dir = tmp_path / "build"
+    for name in ["app", "base", "old", "new", ".snapshots/old", ".overlay/app", ".overlay/lower/upper"]:
+        (build_dir / name).mkdir(parents=True)
+    (build_dir / ".overlay" / "app" / "lowerdirs").write_text("%s\n" % (build_dir / ".overlay" / "lower" / "upper"))
+    (build_dir / "base" / "data").write_bytes(bytes(8192))
+    link(build_dir / "base" / "data", build_dir / "app" / "data")
+    (build_dir / "old" / "data").write_bytes(bytes(4096))
+    for name in ["old", ".snapshots/old"]:
+        utime(build_dir / name, (OLD, OLD))
+    return build_dir
+
+
+@pytest.fixture
+def layer_gc(build_dir):
+    return LayerGC(build_dir, {"app": {"base_image": "base"}, "base": {}}, "dir")
+
+
+def test_format_size():
+    assert format_size(512) == "512B"
+    assert format_size(3 << 29) == "1.5G"
+
+
+def test_find_orphans(layer_gc):
+    assert sorted(layer_gc.find_orphans()) == [("layer", "new"), ("layer", "old"), ("snapshot", "old")]
+
+
+def test_usage_counts_shared_inodes(layer_gc):
+    usage = layer_gc.get_usage()
+    assert usage[("layer", "app")]["shared"] == usage[("layer", "base")]["shared"] == 8192
+    assert usage[("layer", "old")]["exclusive"] >= 4096 and usage[("layer", "old")]["orphan"]
+    assert not usage[("layer", "app")]["orphan"]
+
+
+def test_collect_keeps_recent_orphans(build_dir, layer_gc):
+    report = layer_gc.collect(dry_run=True)
+    assert report == {"deleted": [("snapshot", "old"), ("layer", "old")], "kept": [("layer", "new")]}
+    assert (build_dir / "old").exists()
+
+    assert layer_gc.collect() == report
+    assert not (build_dir / "old").exists() and not (build_dir / ".snapshots" / "old").exists()
+    assert layer_gc.collect(force=True) == {"deleted": [("layer", "new")], "kept": []}
+    assert sorted(path.name for path in build_dir.iterdir()) == [".overlay", ".snapshots", "app", "base"]
+
+
+def test_gc_dry_run_keeps_manifest(environment, capsys):
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink, force=True)
+    gentainer.build_all()
+    gentainer.layer_manifest.set("removed", "digest")
+    (gentainer.build_dir / "removed").mkdir()
+
+    gentainer.gc(dry_run=True)
+    assert "layer      removed                          would delete" in capsys.readouterr().out
+    assert "removed" in gentainer.layer_manifest and (gentainer.build_dir / "removed").exists()
+
+    gentainer.gc()
+    assert "removed" not in gentainer.layer_manifest and not (gentainer.build_dir / "removed").exists()
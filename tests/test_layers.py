@@ -0,0 +1,64 @@
+import pytest
+
+from gentainer.layers import Layers
+
+
+@pytest.fixture
+def mounts(monkeypatch):
+    """Records overlay mounts instead of mounting, as [(action, mountpoint, lower dirs)]"""
+    mounts = []
+
+    def mount_overlay(self, lower_dirs, mountpoint, upper_dir=None, work_dir=None):
+        mounts.append(("mount", mountpoint, list(lower_dirs)))
+
+    monkeypatch.setattr(Layers, "mount_overlay", mount_overlay)
+    monkeypatch.setattr(Layers, "umount", lambda self, mountpoint: mounts.append(("umount", mountpoint, None)))
+    return mounts
+
+
+def prepare_chain(build_dir, depth, **kwargs):
+    """Prepares a chain of overlay layers, each based on the previous, returns the last layer"""
+    for index in range(depth):
+        base_image = "layer_%d" % (index - 1) if index else None
+        layer = Layers("layer_%d" % index, build_dir, "overlay", base_image=base_image, **kwargs)
+        layer.prepare()
+    return layer
+
+
+def test_overlay_chain_is_stacked(tmp_path, mounts):
+    layer = prepare_chain(tmp_path, 3)
+    overlay_dir = tmp_path / ".overlay"
+    assert layer.get_layer_dirs() == [
+        str(overlay_dir / "layer_2" / "upper"),
+        str(overlay_dir / "layer_1" / "upper"),
+        str(overlay_dir / "layer_0" / "upper"),
+        str(overlay_dir / "layer_0" / "base"),
+    ]
+    assert mounts == []
+
+    with layer.mounted() as layer_dir:
+        assert layer_dir == tmp_path / "layer_2"
+    assert [mount[0] for mount in mounts] == ["mount", "umount"]
+    assert mounts[0][2] == layer.get_lower_dirs()
+
+
+def test_deep_chains_are_flattened(tmp_path, mounts):
+    layer = prepare_chain(tmp_path, 4, overlay_max_depth=3)
+    flat_dir = tmp_path / ".overlay" / "layer_3" / "base"
+    assert layer.get_lower_dirs() == [str(flat_dir)]
+    assert flat_dir.is_dir()
+    assert mounts[0][2] == Layers("layer_2", tmp_path, "overlay").get_layer_dirs()
+
+
+def test_other_backings_are_not_mounted(tmp_path, mounts):
+    layer = Layers("layer_0", tmp_path, "dir")
+    layer.prepare()
+    with layer.mounted() as layer_dir:
+        assert layer_dir == tmp_path / "layer_0"
+    assert mounts == []
+
+
+def test_clean_overlay(tmp_path, mounts):
+    layer = prepare_chain(tmp_path, 1)
+    layer.clean_overlay()
+    assert not layer.layer_dir.exists() and not layer.overlay_dir.exists()
@@ -0,0 +1,21 @@
+import sys
+from os import environ, pathsep
+from subprocess import run
+
+HEAVY_MODULES = ["portage", "pyroute2"]
+
+IMPORT_SCRIPT = """
+import sys
+import gentainer.main
+from gentainer import binpkgs, nets, package_index
+
+print(" ".join(module for module in %r if module in sys.modules))
+""" % HEAVY_MODULES
+
+
+def test_heavy_modules_are_not_imported():
+    """portage and pyroute2 are only imported by the actions which use them"""
+    env = {**environ, "PYTHONPATH": pathsep.join(sys.path)}
+    cmd_out = run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True, text=True, env=env)
+    assert cmd_out.returncode == 0, cmd_out.stderr
+    assert cmd_out.stdout.split() == []
@@ -0,0 +1,34 @@
+from gentainer.manifest import LayerManifest, get_layer_digest, hash_paths
+
+
+def test_layer_digest_depends_on_packages_parent_and_portage():
+    digest = get_layer_digest(["app-misc/a", "app-misc/b"], parent_digest="parent", portage_digest="portage")
+    assert digest == get_layer_digest(["app-misc/b", "app-misc/a"], parent_digest="parent", portage_digest="portage")
+    assert digest != get_layer_digest(["app-misc/a"], parent_digest="parent", portage_digest="portage")
+    assert digest != get_layer_digest(["app-misc/a", "app-misc/b"], parent_digest="other", portage_digest="portage")
+    assert digest != get_layer_digest(["app-misc/a", "app-misc/b"], parent_digest="parent", portage_digest="other")
+
+
+def test_hash_paths_tracks_file_and_directory_contents(tmp_path):
+    make_conf = tmp_path / "make.conf"
+    make_conf.write_text('USE="-X"\n')
+    package_use = tmp_path / "package.use"
+    package_use.mkdir()
+    (package_use / "app").write_text("app-misc/a foo\n")
+    digest = hash_paths([make_conf, package_use])
+
+    (package_use / "app").write_text("app-misc/a -foo\n")
+    assert hash_paths([make_conf, package_use]) != digest
+    assert hash_paths([tmp_path / "missing"]) != hash_paths([tmp_path / "other_missing"])
+
+
+def test_manifest_persists_digests(tmp_path):
+    manifest_file = tmp_path / "build" / ".manifest.json"
+    manifest = LayerManifest(manifest_file)
+    manifest.set("base", "digest")
+    manifest.set("app", "app_digest")
+    manifest.remove("app")
+
+    loaded = LayerManifest(manifest_file)
+    assert "base" in loaded and "app" not in loaded
+    assert loaded.get("base") == "digest"
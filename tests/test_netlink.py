@@ -0,0 +1,128 @@
+import pytest
+
+from gentainer.nets import HostNet, NetlinkSession
+
+
+class FakeMessage(dict):
+    """Netlink message with the get_attr interface of pyroute2 messages"""
+
+    def get_attr(self, name):
+        for attr_name, value in self["attrs"]:
+            if attr_name == name:
+                return value
+
+
+class FakeIPRoute:
+    """In-memory link and address table with the parts of pyroute2.IPRoute used by NetlinkSession"""
+
+    def __init__(self):
+        self.links = {1: {"name": "lo", "kind": None, "addresses": set()}}
+        self.dumps = 0
+
+    def get_message(self, index):
+        link = self.links[index]
+        link_info = FakeMessage(attrs=[("IFLA_INFO_KIND", link["kind"])]) if link["kind"] else None
+        return FakeMessage(index=index, attrs=[("IFLA_IFNAME", link["name"]), ("IFLA_LINKINFO", link_info)])
+
+    def get_links(self, *indexes):
+        if not indexes:
+            self.dumps += 1
+        return [self.get_message(index) for index in (indexes or list(self.links))]
+
+    def link(self, command, index=None, ifname=None, kind=None):
+        match command:
+            case "add":
+                self.links[max(self.links) + 1] = {"name": ifname, "kind": kind, "addresses": set()}
+            case "get":
+                return [self.get_message(next(i for i, link in self.links.items() if link["name"] == ifname))]
+            case "del":
+                self.links.pop(index)
+
+    def get_addr(self, family=None, index=None):
+        addresses = self.links[index]["addresses"]
+        return [FakeMessage(prefixlen=mask, attrs=[("IFA_ADDRESS", address)]) for address, mask in addresses]
+
+    def addr(self, command, index=None, address=None, mask=None):
+        if command == "add":
+            self.links[index]["addresses"].add((address, mask))
+        else:
+            self.links[index]["addresses"].discard((address, mask))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def ip_route():
+    return FakeIPRoute()
+
+
+@pytest.fixture
+def netlink(ip_route):
+    return NetlinkSession(backend=lambda: ip_route)
+
+
+@pytest.fixture
+def network_file(tmp_path):
+    network_file = tmp_path / "networks.toml"
+    network_file.write_text(
+        '[lxcbr0]\ntype = "bridge"\naddress = "10.0.0.1"\nmask = 24\n'
+        '[lxcbr1]\ntype = "bridge"\naddress = "10.0.1.1"\nmask = 24\n'
+    )
+    return network_file
+
+
+def test_link_table_is_read_once(ip_route, netlink):
+    assert netlink.get_interface_names() == ["lo"]
+    assert netlink.link_lookup("lo") == 1
+    assert netlink.link_lookup("missing") is None
+    assert ip_route.dumps == 1
+
+
+def test_writes_update_link_table(ip_route, netlink):
+    netlink.get_links()
+    assert netlink.add_link("lxcbr0", "bridge") == 2
+    assert netlink.link_lookup("lxcbr0") == 2
+    netlink.del_link("lo")
+    assert netlink.get_interface_names() == ["lxcbr0"]
+    assert ip_route.dumps == 1
+
+
+def test_close_reopens_on_use():
+    ip_routes = []
+    netlink = NetlinkSession(backend=lambda: ip_routes.append(FakeIPRoute()) or ip_routes[-1])
+    netlink.get_links()
+    netlink.close()
+    assert netlink.ip_route is None
+    netlink.get_links()
+    assert len(ip_routes) == 2
+
+
+def test_reconcile_creates_missing_interfaces(network_file, netlink):
+    changes = HostNet(network_file, netlink=netlink).reconcile_interfaces(["lxcbr0"])
+    assert changes == [("create", "lxcbr0", "bridge"), ("add_address", "lxcbr0", "10.0.0.1", 24)]
+    assert netlink.get_addresses("lxcbr0") == {("10.0.0.1", 24)}
+    assert netlink.link_lookup("lxcbr1") is None
+
+
+def test_reconcile_only_applies_address_changes(network_file, ip_route, netlink):
+    host_network = HostNet(network_file, netlink=netlink)
+    host_network.reconcile()
+    index = netlink.link_lookup("lxcbr0")
+    netlink.addr("del", "lxcbr0", address="10.0.0.1", mask=24)
+    netlink.addr("add", "lxcbr0", address="10.0.0.2", mask=24)
+
+    changes = host_network.reconcile()
+    assert changes == [("del_address", "lxcbr0", "10.0.0.2", 24), ("add_address", "lxcbr0", "10.0.0.1", 24)]
+    assert netlink.link_lookup("lxcbr0") == index
+    assert host_network.reconcile() == []
+
+
+def test_reconcile_type_change_needs_force(network_file, netlink):
+    netlink.add_link("lxcbr0", "veth")
+    with pytest.raises(ValueError, match="use --force"):
+        HostNet(network_file, netlink=netlink).reconcile_interfaces(["lxcbr0"])
+
+    changes = HostNet(network_file, force=True, netlink=netlink).reconcile_interfaces(["lxcbr0"])
+    assert changes[:2] == [("delete", "lxcbr0"), ("create", "lxcbr0", "bridge")]
+    assert netlink.get_link_kind("lxcbr0") == "bridge"
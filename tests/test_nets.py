@@ -0,0 +1,13 @@
+from gentainer import Gentainer
+
+
+def test_close_netlink_session(environment):
+    """Closing gentainer closes the netlink socket, which is opened again if it is used later"""
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.prepare_all()
+    assert netlink.ip_route is ip_route
+
+    gentainer.close()
+    assert netlink.ip_route is None
+    assert netlink.link_lookup("benchbr0") is not None
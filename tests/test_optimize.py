@@ -0,0 +1,79 @@
+import pytest
+
+from gentainer.optimize import LayerOptimizer, read_emerge_durations
+
+DEPENDENCIES = {
+    "dev-lang/python-3.12": {"dev-libs/libffi-3.4", "sys-libs/zlib-1.3"},
+    "dev-libs/libffi-3.4": set(),
+    "sys-libs/zlib-1.3": set(),
+    "www-servers/nginx-1.26": {"sys-libs/zlib-1.3"},
+    "www-apps/api-1.0": {"dev-lang/python-3.12"},
+}
+
+
+class FakeContainerConfig(dict):
+    def __init__(self, config_file, **config):
+        super().__init__(config)
+        self.config_file = config_file
+
+
+@pytest.fixture
+def containers(tmp_path):
+    """Two sibling layers on a base, which share python and its dependencies"""
+    configs = {
+        "base": {},
+        "web": {"base_image": "base", "packages": ["www-servers/nginx", "dev-lang/python"]},
+        "api": {"base_image": "base", "packages": ["www-apps/api"]},
+    }
+    containers = {}
+    for name, config in configs.items():
+        config_file = tmp_path / "config" / ("%s.toml" % name)
+        config_file.parent.mkdir(exist_ok=True)
+        config_file.write_text('base_image = "base"\n' if "base_image" in config else "")
+        containers[name] = FakeContainerConfig(config_file, **config)
+    return containers
+
+
+@pytest.fixture
+def optimizer(tmp_path, containers):
+    """Optimizer with the portage lookups resolved from DEPENDENCIES"""
+    optimizer = LayerOptimizer(containers, emerge_log=tmp_path / "missing.log")
+    optimizer.best_matches = {cpv.rsplit("-", 1)[0]: cpv for cpv in DEPENDENCIES}
+    optimizer.dependencies = DEPENDENCIES
+    return optimizer
+
+
+def test_read_emerge_durations(tmp_path):
+    (tmp_path / "emerge.log").write_text(
+        "100:  >>> emerge (1 of 1) sys-libs/zlib-1.3 to /build/a/\n"
+        "160:  ::: completed emerge (1 of 1) sys-libs/zlib-1.3 to /build/a/\n"
+        "200:  >>> emerge (1 of 1) sys-libs/zlib-1.3.1 to /build/b/\n"
+        "220:  ::: completed emerge (1 of 1) sys-libs/zlib-1.3.1 to /build/b/\n"
+        "300:  >>> emerge (1 of 1) dev-libs/libffi-3.4 to /build/a/\n"
+    )
+    assert read_emerge_durations(tmp_path / "emerge.log") == {"sys-libs/zlib": 40}
+    assert read_emerge_durations(tmp_path / "missing.log") == {}
+
+
+def test_shared_packages_are_factored(optimizer):
+    report = optimizer.optimize()
+    assert report["new_layers"] == {"base_shared_1": ["dev-lang/python"]}
+    assert report["bases"] == {"base": None, "web": "base_shared_1", "api": "base_shared_1", "base_shared_1": "base"}
+    assert report["layers"]["web"] == {"www-servers/nginx-1.26"}
+    assert (report["before"]["packages"], report["after"]["packages"]) == (8, 5)
+    assert "New layer base_shared_1 (base image: base) with 3 packages: dev-lang/python" in optimizer.format_report(report)
+
+
+def test_min_shared(optimizer):
+    optimizer.min_shared = 4
+    report = optimizer.optimize()
+    assert report["proposals"] == [] and report["before"] == report["after"]
+
+
+def test_write_configs(tmp_path, optimizer):
+    optimizer.write_configs(optimizer.optimize(), tmp_path / "optimized")
+    assert (tmp_path / "optimized" / "base_shared_1.toml").read_text() == (
+        'base_image = "base"\npackages = ["dev-lang/python"]\n'
+    )
+    assert (tmp_path / "optimized" / "web.toml").read_text() == 'base_image = "base_shared_1"\n'
+    assert not (tmp_path / "optimized" / "base.toml").exists()
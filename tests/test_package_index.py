@@ -0,0 +1,47 @@
+import pytest
+
+from gentainer.package_index import PackageIndex, is_plain_atom
+
+PACKAGES = {"app-misc/a": ["app-misc/a-1.0"], "app-misc/b": ["app-misc/b-1.0", "app-misc/b-2.0"]}
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """Replaces the portage tree scan, returns the list of builds"""
+    builds = []
+
+    def build(self):
+        builds.append(self.index_file)
+        self.packages = dict(PACKAGES)
+
+    monkeypatch.setattr(PackageIndex, "build", build)
+    return builds
+
+
+def test_is_plain_atom():
+    assert is_plain_atom("app-misc/a")
+    assert not is_plain_atom(">=app-misc/a-1.0")
+    assert not is_plain_atom("app-misc/a:0")
+    assert not is_plain_atom("app-misc/a[foo]")
+
+
+def test_index_is_cached_until_the_timestamp_changes(tmp_path, builds):
+    timestamp_file = tmp_path / "timestamp.chk"
+    timestamp_file.write_text("first\n")
+    index_file = tmp_path / "cache" / "package_index.json"
+
+    PackageIndex(index_file, timestamp_file)
+    index = PackageIndex(index_file, timestamp_file)
+    assert len(builds) == 1
+    assert index.match("app-misc/b") == ["app-misc/b-1.0", "app-misc/b-2.0"]
+
+    timestamp_file.write_text("second\n")
+    PackageIndex(index_file, timestamp_file)
+    assert len(builds) == 2
+
+
+def test_validate_lists_missing_packages(tmp_path, builds):
+    index = PackageIndex(tmp_path / "package_index.json", tmp_path / "timestamp.chk")
+    index.validate(["app-misc/a", "app-misc/b"])
+    with pytest.raises(KeyError, match="app-misc/missing, app-misc/gone"):
+        index.validate(["app-misc/a", "app-misc/missing", "app-misc/gone"])
@@ -0,0 +1,51 @@
+from threading import Event
+
+from gentainer import Gentainer
+from gentainer.prefetch import DistfilePrefetcher, get_mirror
+
+
+def test_get_mirror():
+    assert get_mirror("file:///srv/gentoo%20mirror") == "/srv/gentoo mirror"
+    assert get_mirror("https://distfiles.gentoo.org") == "https://distfiles.gentoo.org"
+
+
+def test_get_env(tmp_path):
+    prefetcher = DistfilePrefetcher(tmp_path, mirrors="file:///srv/mirror https://mirror")
+    env = prefetcher.get_env({"PATH": "/bin"})
+    assert env == {"PATH": "/bin", "DISTDIR": str(tmp_path), "GENTOO_MIRRORS": "/srv/mirror https://mirror"}
+
+
+def test_failed_fetches_are_not_fatal(monkeypatch):
+    def fetch(self, container, packages):
+        raise RuntimeError("mirror is down")
+
+    monkeypatch.setattr(DistfilePrefetcher, "fetch", fetch)
+    prefetcher = DistfilePrefetcher()
+    with prefetcher.prefetch([("app", ["app-misc/app"])]):
+        prefetcher.wait("app")
+    prefetcher.wait("unknown")
+
+
+def test_waiting_cancels_queued_fetches(monkeypatch):
+    fetched, release = [], Event()
+
+    def fetch(self, container, packages):
+        release.wait(5)
+        fetched.append(container)
+
+    monkeypatch.setattr(DistfilePrefetcher, "fetch", fetch)
+    prefetcher = DistfilePrefetcher(jobs=1)
+    with prefetcher.prefetch([("base", ["app-misc/base"]), ("app", ["app-misc/app"])]):
+        prefetcher.wait("app")
+        release.set()
+        prefetcher.wait("base")
+    assert fetched == ["base"]
+
+
+def test_builds_use_prefetched_distfiles(environment):
+    """Distfiles are fetched from the local mirror into the shared distfiles dir"""
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+    assert (config_file.parent / "distfiles" / "bench-1.0.tar").read_bytes() == b"bench"
+    assert gentainer.is_layer_current("container_0")
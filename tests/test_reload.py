@@ -0,0 +1,21 @@
+from gentainer import Gentainer
+
+
+def test_reload_keeps_invalid_config(environment):
+    """An invalid config in a reload batch keeps its loaded config, other files in the batch are reloaded"""
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    config_dir = config_file.parent / "config"
+    invalid_file, valid_file = config_dir / "container_0.toml", config_dir / "container_1.toml"
+    old_config = dict(gentainer.containers["container_0"])
+    gentainer.prepare_all()
+
+    invalid_file.write_text("packages = [\n")
+    valid_file.write_text(valid_file.read_text().replace('"benchbr0" = 2', '"benchbr0" = 3'))
+    changed = gentainer.reload_config_files([invalid_file, valid_file])
+
+    assert changed == ["container_1"]
+    assert dict(gentainer.containers["container_0"]) == old_config
+    assert gentainer.containers["container_1"]["usernet_allocation"] == {"benchbr0": 3}
+    assert "container_0" in gentainer.prepared
+    assert "container_1" not in gentainer.prepared
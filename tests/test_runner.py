@@ -0,0 +1,104 @@
+import pytest
+
+from gentainer import Gentainer, runner as runner_module
+from gentainer.runner import ContainerRunner, get_subid_range, shift_ownership
+
+
+@pytest.fixture
+def gentainer(environment):
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+    return gentainer
+
+
+def test_get_subid_range(tmp_path):
+    (tmp_path / "subuid").write_text("other:100000:65536\nbench0:165536:65536\n")
+    assert get_subid_range("bench0", tmp_path / "subuid") == (165536, 65536)
+    assert get_subid_range("missing", tmp_path / "subuid") is None
+    assert get_subid_range("bench0", tmp_path / "missing") is None
+
+
+def test_generate_config(gentainer):
+    directives = gentainer.get_runner().generate_config("container_1")
+    assert "lxc.uts.name = container_1" in directives
+    rootfs_dir = gentainer.get_runner().get_container_dir("container_1") / "rootfs"
+    assert "lxc.rootfs.path = %s" % rootfs_dir in directives
+    assert "lxc.idmap = u 0 100000 65536" in directives and "lxc.idmap = g 0 100000 65536" in directives
+    assert "lxc.net.0.link = benchbr0" in directives
+
+
+def test_shift_ownership(tmp_path):
+    (tmp_path / "root").mkdir()
+    (tmp_path / "root" / "file").write_text("file")
+    (tmp_path / "root" / "link").symlink_to("file")
+    (tmp_path / "root" / "setuid").touch(mode=0o4755)
+    assert shift_ownership(tmp_path / "root", (100000, 65536), (200000, 65536)) == 4
+    for path in tmp_path.joinpath("root").iterdir():
+        assert (path.lstat().st_uid, path.lstat().st_gid) == (100000, 200000)
+    assert tmp_path.joinpath("root", "setuid").stat().st_mode & 0o7777 == 0o4755
+
+
+def test_containers_run_on_their_own_rootfs(gentainer, monkeypatch):
+    """Containers start as their user on a copy of their layer owned by its subordinate ids,
+    which is only created again when the layer is rebuilt"""
+    commands, traced_run = [], runner_module.traced_run
+
+    def record_run(args, **kwargs):
+        commands.append(args)
+        return traced_run(args, **kwargs)
+
+    monkeypatch.setattr(runner_module, "traced_run", record_run)
+    gentainer.run("container_1")
+    rootfs_dir = gentainer.get_runner().get_container_dir("container_1") / "rootfs"
+    layer_dir = gentainer.get_layer("container_1").layer_dir
+    assert rootfs_dir.stat().st_uid == 100000 and layer_dir.stat().st_uid == 0
+    assert ["runuser", "-u", "bench0", "--", "lxc-start"] == commands[-2][:5]
+
+    (rootfs_dir / "written").touch()
+    gentainer.run("container_1")
+    assert (rootfs_dir / "written").exists()
+    assert not (layer_dir / "written").exists()
+
+    gentainer.layer_manifest.set("container_1", "rebuilt")
+    gentainer.run("container_1")
+    assert not (rootfs_dir / "written").exists()
+
+
+def test_network_parameters(environment):
+    """Network parameters are written as the lxc.net keys LXC expects, unknown parameters are rejected"""
+    config_file, ip_route, netlink = environment
+    container_file = config_file.parent / "config" / "container_0.toml"
+    container_file.write_text(
+        container_file.read_text()
+        + 'ipv4 = ["10.0.0.2/24", "10.0.1.2/24"]\nipv4_gateway = "10.0.0.1"\nveth_pair = "ct0"\n'
+    )
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+    directives = gentainer.get_runner().generate_config("container_0")
+    assert "lxc.net.0.ipv4.address = 10.0.0.2/24" in directives
+    assert "lxc.net.0.ipv4.address = 10.0.1.2/24" in directives
+    assert "lxc.net.0.ipv4.gateway = 10.0.0.1" in directives
+    assert "lxc.net.0.veth.pair = ct0" in directives
+
+    container_file.write_text(container_file.read_text() + 'ipv4_netmask = "24"\n')
+    with pytest.raises(ValueError, match="Unknown parameters for network benchbr0"):
+        Gentainer(config=str(config_file), netlink=netlink)
+
+
+def test_configs_are_cached(gentainer, monkeypatch, capsys):
+    report = gentainer.run_all()
+    assert list(report) == ["container_1"] and report["container_1"]["status"] == "running"
+    assert "container_1" in capsys.readouterr().out
+
+    def generate_config(self, container):
+        pytest.fail("LXC config was generated again")
+
+    monkeypatch.setattr(ContainerRunner, "generate_config", generate_config)
+    gentainer.run("container_1")
+
+
+def test_failed_starts_are_reported(gentainer):
+    gentainer.get_layer("container_1").clean()
+    with pytest.raises(RuntimeError, match="Failed to start containers: container_1"):
+        gentainer.run_all(["container_0", "container_1"])
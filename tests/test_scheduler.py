@@ -0,0 +1,49 @@
+from threading import Lock
+
+import pytest
+
+from gentainer.scheduler import BuildScheduler
+
+CONTAINERS = {
+    "base": {},
+    "middle": {"base_image": "base"},
+    "app_a": {"base_image": "middle"},
+    "app_b": {"base_image": "middle"},
+    "other": {},
+}
+
+
+def test_resolve_deduplicates_base_images():
+    """Shared base images appear once in the resolved graph"""
+    graph = BuildScheduler(CONTAINERS, None).resolve(["app_a", "app_b"])
+    assert graph == {"app_a": "middle", "middle": "base", "base": None, "app_b": "middle"}
+
+
+def test_resolve_detects_loops():
+    containers = {"a": {"base_image": "b"}, "b": {"base_image": "a"}}
+    with pytest.raises(ValueError, match="Base image loop"):
+        BuildScheduler(containers, None).resolve(["a"])
+
+
+def test_run_builds_each_layer_once_after_its_base():
+    built, lock = [], Lock()
+
+    def build(container):
+        with lock:
+            assert CONTAINERS[container].get("base_image") in [None, *built]
+            built.append(container)
+
+    BuildScheduler(CONTAINERS, build, jobs=4).run(["app_a", "app_b", "other"])
+    assert sorted(built) == sorted(CONTAINERS)
+
+
+def test_run_skips_children_of_failed_layers():
+    def build(container):
+        if container == "middle":
+            raise RuntimeError("emerge failed")
+
+    scheduler = BuildScheduler(CONTAINERS, build, jobs=2)
+    with pytest.raises(RuntimeError, match="Failed to build layers: middle"):
+        scheduler.run(["app_a", "app_b", "other"])
+    assert sorted(scheduler.skipped) == ["app_a", "app_b"]
+    assert sorted(scheduler.built) == ["base", "other"]
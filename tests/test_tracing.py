@@ -0,0 +1,78 @@
+from json import loads
+
+import pytest
+
+from gentainer import Gentainer
+from gentainer.tracing import DISABLED_SPAN, Tracer, traced, traced_run, tracer
+
+
+@pytest.fixture
+def global_tracer():
+    tracer.enable()
+    yield tracer
+    tracer.enabled = False
+
+
+def test_disabled_tracer_records_nothing():
+    local_tracer = Tracer()
+    assert local_tracer.span("build") is DISABLED_SPAN
+    with local_tracer.span("build"):
+        pass
+    assert local_tracer.events == []
+
+
+def test_spans_are_exported_as_chrome_trace(tmp_path):
+    local_tracer = Tracer()
+    local_tracer.enable()
+    with local_tracer.span("build", container="app"):
+        with local_tracer.span("emerge", category="subprocess"):
+            pass
+
+    local_tracer.export_chrome(tmp_path / "trace.json")
+    trace_events = loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert trace_events[0]["ph"] == "M" and trace_events[0]["name"] == "thread_name"
+    emerge, build = trace_events[1:]
+    assert (build["name"], build["args"]) == ("build", {"container": "app"})
+    assert build["ts"] <= emerge["ts"] and emerge["ts"] + emerge["dur"] <= build["ts"] + build["dur"]
+
+
+def test_summary_groups_spans():
+    local_tracer = Tracer()
+    local_tracer.enable()
+    for _ in range(3):
+        with local_tracer.span("build"):
+            pass
+    summary = local_tracer.get_summary()
+    assert list(summary) == [("phase", "build")] and summary[("phase", "build")]["count"] == 3
+    assert local_tracer.format_summary().splitlines()[1].split()[:3] == ["phase", "build", "3"]
+
+
+def test_traced_helpers(global_tracer):
+    @traced("work")
+    def work():
+        return "done"
+
+    assert work() == "done"
+    traced_run(["true"], container="app")
+    assert [(event["cat"], event["name"]) for event in global_tracer.events] == [
+        ("phase", "work"),
+        ("subprocess", "true"),
+    ]
+    assert global_tracer.events[1]["args"] == {"command": "true", "container": "app"}
+
+
+def test_packages_are_traced(environment):
+    """Packages merged by emerge are recorded as package spans"""
+    config_file, ip_route, netlink = environment
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    tracer.enable()
+    try:
+        gentainer.build_all()
+    finally:
+        tracer.enabled = False
+
+    package_spans = [event for event in tracer.events if event["cat"] == "package"]
+    assert [(event["name"], event["args"]["container"]) for event in package_spans] == [
+        ("app-misc/bench-1.0", "container_0")
+    ]
+    assert package_spans[0]["args"]["status"] == "complete"
@@ -0,0 +1,75 @@
+from os import link, mkfifo, stat, symlink, utime
+
+import pytest
+
+from gentainer.treecopy import TreeCopier
+
+
+@pytest.fixture
+def source(tmp_path):
+    """A tree with nested directories, a hardlink, a symlink and a FIFO"""
+    source = tmp_path / "source"
+    (source / "etc" / "conf.d").mkdir(parents=True)
+    (source / "etc" / "conf.d" / "net").write_text("config")
+    (source / "etc" / "conf.d" / "net").chmod(0o640)
+    link(source / "etc" / "conf.d" / "net", source / "etc" / "net.link")
+    symlink("conf.d/net", source / "etc" / "net.symlink")
+    mkfifo(source / "fifo")
+    utime(source / "etc", ns=(1 << 30, 1 << 30))
+    return source
+
+
+def test_copy_preserves_tree(tmp_path, source):
+    report = TreeCopier(source, tmp_path / "destination").copy()
+    destination = tmp_path / "destination"
+
+    assert (destination / "etc" / "conf.d" / "net").read_text() == "config"
+    assert stat(destination / "etc" / "conf.d" / "net").st_mode & 0o777 == 0o640
+    assert stat(destination / "etc" / "net.link").st_ino == stat(destination / "etc" / "conf.d" / "net").st_ino
+    assert (destination / "etc" / "net.symlink").readlink().as_posix() == "conf.d/net"
+    assert (destination / "fifo").is_fifo()
+    assert stat(destination / "etc").st_mtime_ns == 1 << 30
+    counts = {key: report[key] for key in ["directories", "files", "hardlinks", "symlinks", "devices"]}
+    assert counts == {"directories": 3, "files": 1, "hardlinks": 1, "symlinks": 1, "devices": 1}
+
+
+def test_copy_preserves_holes(tmp_path):
+    """Sparse files are copied with their holes, only data bytes are written"""
+    source = tmp_path / "source"
+    source.mkdir()
+    sparse_file = source / "sparse"
+    with open(sparse_file, "wb") as f:
+        f.seek(4 << 20)
+        f.write(b"data")
+        f.truncate(8 << 20)
+    (source / "file").write_bytes(b"contents")
+
+    copier = TreeCopier(source, tmp_path / "destination")
+    copier.use_reflink = False
+    report = copier.copy()
+
+    copied_file = tmp_path / "destination" / "sparse"
+    assert copied_file.read_bytes() == sparse_file.read_bytes()
+    assert (tmp_path / "destination" / "file").read_bytes() == b"contents"
+    assert stat(copied_file).st_blocks <= stat(sparse_file).st_blocks
+    assert report["bytes_copied"] < 8 << 20
+
+
+def test_copy_through_userspace(tmp_path):
+    """Files are copied with pread/pwrite when reflinks and copy_file_range are not available"""
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "file").write_bytes(bytes(range(256)) * 4096)
+
+    copier = TreeCopier(source, tmp_path / "destination")
+    copier.use_reflink = copier.use_copy_file_range = False
+    report = copier.copy()
+
+    assert (tmp_path / "destination" / "file").read_bytes() == (source / "file").read_bytes()
+    assert report["bytes_copied"] == 256 * 4096
+
+
+def test_destination_must_not_exist(tmp_path, source):
+    (tmp_path / "destination").mkdir()
+    with pytest.raises(FileExistsError):
+        TreeCopier(source, tmp_path / "destination").copy()
@@ -0,0 +1,92 @@
+from fcntl import LOCK_EX, LOCK_NB, flock
+
+import pytest
+
+from gentainer.usernet import UsernetDB
+
+
+@pytest.fixture
+def usernet_file(tmp_path):
+    usernet_file = tmp_path / "lxc-usernet"
+    usernet_file.write_text("# lxc-usernet\n\nalice veth lxcbr0 2\n")
+    return usernet_file
+
+
+def test_entries_are_indexed(usernet_file):
+    with UsernetDB(usernet_file) as usernet_db:
+        assert usernet_db.get("alice", "veth", "lxcbr0") == 2
+        assert usernet_db.get("bob", "veth", "lxcbr0") is None
+
+
+def test_changes_keep_comments_and_order(usernet_file):
+    with UsernetDB(usernet_file) as usernet_db:
+        usernet_db.set("bob", "veth", "lxcbr0", 1)
+        usernet_db.set("alice", "veth", "lxcbr0", 4)
+    assert usernet_file.read_text() == "# lxc-usernet\n\nalice veth lxcbr0 4\nbob veth lxcbr0 1\n"
+    assert not usernet_file.with_name("lxc-usernet.tmp").exists()
+
+
+def test_nested_contexts_write_once(usernet_file, monkeypatch):
+    usernet_db = UsernetDB(usernet_file)
+    writes = []
+    commit = usernet_db.commit
+    monkeypatch.setattr(usernet_db, "commit", lambda: writes.append(usernet_db.depth) or commit())
+    with usernet_db:
+        with usernet_db:
+            usernet_db.set("bob", "veth", "lxcbr0", 1)
+        assert "bob" not in usernet_file.read_text()
+    assert writes == [0]
+    assert "bob veth lxcbr0 1" in usernet_file.read_text()
+
+
+def test_changes_are_dropped_on_error(usernet_file):
+    """Changes are not written if a context exits with an exception, even if an outer context handles it"""
+    usernet_db = UsernetDB(usernet_file)
+    with pytest.raises(RuntimeError):
+        with usernet_db:
+            usernet_db.set("bob", "veth", "lxcbr0", 1)
+            raise RuntimeError("Failed to prepare container")
+    with usernet_db:
+        try:
+            with usernet_db:
+                usernet_db.set("carol", "veth", "lxcbr0", 1)
+                raise RuntimeError("Failed to prepare container")
+        except RuntimeError:
+            pass
+    assert usernet_file.read_text() == "# lxc-usernet\n\nalice veth lxcbr0 2\n"
+    assert usernet_db.lock_fd is None
+
+    with usernet_db:
+        assert usernet_db.get("bob", "veth", "lxcbr0") is None
+        usernet_db.set("bob", "veth", "lxcbr0", 1)
+    assert "bob veth lxcbr0 1" in usernet_file.read_text()
+
+
+def test_file_is_locked_inside_context(usernet_file):
+    usernet_db = UsernetDB(usernet_file)
+    with usernet_db, open(usernet_db.lock_file, "w") as lock_fd:
+        with pytest.raises(BlockingIOError):
+            flock(lock_fd, LOCK_EX | LOCK_NB)
+    with open(usernet_db.lock_file, "w") as lock_fd:
+        flock(lock_fd, LOCK_EX | LOCK_NB)
+
+
+def test_set_requires_lock(usernet_file):
+    with pytest.raises(RuntimeError):
+        UsernetDB(usernet_file).set("bob", "veth", "lxcbr0", 1)
+
+
+def test_missing_file_is_created(tmp_path):
+    usernet_file = tmp_path / "lxc" / "lxc-usernet"
+    with UsernetDB(usernet_file) as usernet_db:
+        usernet_db.set("bob", "veth", "lxcbr0", 1)
+    assert usernet_file.read_text() == "bob veth lxcbr0 1\n"
+
+
+def test_invalid_entry_releases_lock(usernet_file):
+    usernet_file.write_text("alice veth\n")
+    usernet_db = UsernetDB(usernet_file)
+    with pytest.raises(ValueError, match="Invalid usernet entry"):
+        with usernet_db:
+            pass
+    assert usernet_db.lock_fd is None
@@ -0,0 +1,63 @@
+from os import getgid, getuid
+from pwd import struct_passwd
+
+import pytest
+
+from gentainer import users
+from gentainer.users import UserProvisioner, ensure_dir
+
+
+class FakeContainerConfig(dict):
+    def __init__(self, name, **config):
+        super().__init__(config)
+        self.name = name
+
+
+@pytest.fixture
+def passwd(tmp_path, monkeypatch):
+    """Fake passwd database, useradd adds users to it"""
+    passwd = {}
+
+    def useradd(username):
+        home = tmp_path / "home" / username
+        home.mkdir(parents=True)
+        passwd[username] = struct_passwd((username, "x", getuid(), getgid(), "", str(home), "/bin/sh"))
+        return ""
+
+    monkeypatch.setattr(users, "getpwall", lambda: list(passwd.values()))
+    monkeypatch.setattr(users, "useradd", useradd)
+    return passwd
+
+
+def test_ensure_dir(tmp_path):
+    assert ensure_dir(tmp_path / "lxc", getuid(), getgid()) == "created"
+    assert ensure_dir(tmp_path / "lxc", getuid(), getgid()) == "correct"
+
+
+def test_provisioner_creates_missing_users_once(tmp_path, passwd):
+    configs = [
+        FakeContainerConfig("web", username="lxc-web", usernet_allocation={"lxcbr0": 2}),
+        FakeContainerConfig("db", username="lxc-web"),
+        FakeContainerConfig("root-container"),
+    ]
+    report = UserProvisioner(configs, lxc_usernet_file=tmp_path / "lxc-usernet").prepare()
+
+    assert report["users_created"] == ["lxc-web"]
+    assert len(report["dirs_created"]) == 5  # .local, share, lxc, then one per container
+    assert (tmp_path / "home" / "lxc-web" / ".local" / "share" / "lxc" / "db").is_dir()
+    assert (tmp_path / "lxc-usernet").read_text() == "lxc-web veth lxcbr0 2\n"
+
+    report = UserProvisioner(configs, lxc_usernet_file=tmp_path / "lxc-usernet").prepare()
+    assert report["users_created"] == [] and report["users_existing"] == ["lxc-web"]
+    assert report["dirs_created"] == [] and len(report["dirs_correct"]) == 5
+
+
+def test_usernet_allocation_change_needs_force(tmp_path, passwd):
+    usernet_file = tmp_path / "lxc-usernet"
+    usernet_file.write_text("lxc-web veth lxcbr0 1\n")
+    configs = [FakeContainerConfig("web", username="lxc-web", usernet_allocation={"lxcbr0": 2})]
+
+    UserProvisioner(configs, lxc_usernet_file=usernet_file).prepare()
+    assert usernet_file.read_text() == "lxc-web veth lxcbr0 1\n"
+    UserProvisioner(configs, force=True, lxc_usernet_file=usernet_file).prepare()
+    assert usernet_file.read_text() == "lxc-web veth lxcbr0 2\n"
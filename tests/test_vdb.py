@@ -0,0 +1,50 @@
+import pytest
+
+from gentainer.builder import Builder
+from gentainer.vdb import VDB_PATH, VDBIndex
+
+
+def install_package(root, cpv, use="", iuse="", slot="0"):
+    """Writes the VDB entry of an installed package"""
+    package_dir = root / VDB_PATH / cpv
+    package_dir.mkdir(parents=True)
+    for name, value in {"SLOT": slot, "USE": use, "IUSE": iuse, "repository": "gentoo"}.items():
+        (package_dir / name).write_text(value + "\n")
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    """A root with two installed packages and an interrupted merge, configured USE is read from CONFIGURED_USE"""
+    root = tmp_path / "root"
+    install_package(root, "sys-libs/zlib-1.3-r1", use="static-libs", iuse="minizip static-libs")
+    install_package(root, "app-misc/bench-1.0", slot="0/1")
+    (root / VDB_PATH / "app-misc" / "-MERGING-other-1.0").mkdir()
+    configured_use = {"sys-libs/zlib-1.3-r1": {"static-libs", "amd64"}, "app-misc/bench-1.0": set()}
+    monkeypatch.setattr(VDBIndex, "get_configured_use", lambda self, cpv: configured_use.get(cpv))
+    return root, configured_use
+
+
+def test_index(root):
+    vdb = VDBIndex(root[0])
+    assert sorted(vdb.packages) == ["app-misc/bench", "sys-libs/zlib"]
+    zlib = vdb.packages["sys-libs/zlib"][0]
+    assert (zlib["cpv"], zlib["use"], zlib["iuse"]) == ("sys-libs/zlib-1.3-r1", {"static-libs"}, {"minizip", "static-libs"})
+    assert vdb.packages["app-misc/bench"][0]["slot"] == "0"
+
+
+def test_installed_packages_are_filtered(root):
+    packages = ["sys-libs/zlib", "app-misc/bench", "app-misc/other", "!app-misc/blocked", "@world"]
+    assert VDBIndex(root[0]).filter_installed(packages) == ["app-misc/other", "!app-misc/blocked", "@world"]
+
+
+def test_use_changes_are_rebuilt(root):
+    root, configured_use = root
+    configured_use["sys-libs/zlib-1.3-r1"] = {"minizip"}
+    assert VDBIndex(root).filter_installed(["sys-libs/zlib"]) == ["sys-libs/zlib"]
+    configured_use.pop("sys-libs/zlib-1.3-r1")
+    assert VDBIndex(root).filter_installed(["sys-libs/zlib"]) == ["sys-libs/zlib"]
+
+
+def test_build_skips_emerge(root, monkeypatch):
+    monkeypatch.setenv("PATH", "")  # emerge can't be run
+    Builder("app", root[0], ["sys-libs/zlib", "app-misc/bench"]).build()
@@ -0,0 +1,53 @@
+from gentainer import Gentainer
+from gentainer.watch import IN_CLOSE_WRITE, IN_Q_OVERFLOW, ConfigWatcher, Inotify
+
+
+class FakeInotify:
+    """Returns batches of events, then no events"""
+
+    def __init__(self, *batches):
+        self.batches = list(batches)
+
+    def read_events(self, timeout=None):
+        return self.batches.pop(0) if self.batches else []
+
+
+def test_inotify(tmp_path):
+    inotify = Inotify()
+    try:
+        inotify.add_watch(tmp_path)
+        (tmp_path / "container.toml").write_text("")
+        assert (tmp_path / "container.toml", IN_CLOSE_WRITE) in inotify.read_events(timeout=1)
+        assert inotify.read_events(timeout=0) == []
+    finally:
+        inotify.close()
+
+
+def test_events_are_debounced(environment):
+    config_file, ip_route, netlink = environment
+    watcher = ConfigWatcher(Gentainer(config=str(config_file), netlink=netlink), debounce=0.01)
+    config_dir = watcher.config_dir
+    inotify = FakeInotify(
+        [(config_dir / "container_0.toml", IN_CLOSE_WRITE), (config_dir / ".container_0.toml.swp", IN_CLOSE_WRITE)],
+        [(config_dir / "container_1.toml", IN_CLOSE_WRITE), (config_file, IN_CLOSE_WRITE)],
+    )
+    assert watcher.wait_for_changes(inotify) == {config_dir / "container_0.toml", config_dir / "container_1.toml"}
+
+    inotify = FakeInotify([(config_dir / "container_0.toml", IN_CLOSE_WRITE), (None, IN_Q_OVERFLOW)])
+    assert watcher.wait_for_changes(inotify) is None
+
+
+def test_changes_rebuild_descendants(environment, monkeypatch):
+    """A changed config rebuilds its layer and the layers built on it, other layers are not rebuilt"""
+    config_file, ip_route, netlink = environment
+    config_dir = config_file.parent / "config"
+    (config_dir / "container_2.toml").write_text('packages = ["app-misc/bench"]\n')
+    gentainer = Gentainer(config=str(config_file), netlink=netlink)
+    gentainer.build_all()
+
+    built = []
+    monkeypatch.setattr(gentainer, "build_all", built.append)
+    config = (config_dir / "container_0.toml").read_text()
+    (config_dir / "container_0.toml").write_text(config.replace('"benchbr0" = 2', '"benchbr0" = 3'))
+    ConfigWatcher(gentainer).apply_changes({config_dir / "container_0.toml"})
+    assert built == [["container_0", "container_1"]]